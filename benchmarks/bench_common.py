@@ -0,0 +1,47 @@
+"""Shared setup for the benchmarks: a throwaway config folder and percentile helpers"""
+import os
+import sys
+import tempfile
+
+import yaml
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def make_config_folder(telegram_base_url="http://127.0.0.1:9", overrides=None):
+    """Create a temp config folder with config.yaml, returns the folder path ending with /"""
+    config_folder = tempfile.mkdtemp(prefix="syslog_unifi_bench_") + "/"
+    config = {
+        "logs": {"level": "info", "syslog_log": "syslog-unifi", "monitor_log": "app", "prepend_timestamp": False, "append_new_line": True, "purge_after_days": 7},
+        "notifications": {"default_notify_type": 4, "do_not_disturb_start_hour": 0, "do_not_disturb_end_hour": 0},
+        "telegram": {"chat_id": 1, "api_token": "BENCH", "api_base_url": telegram_base_url, "min_interval_seconds": 0},
+        "client_name_lookup": None,
+    }
+    for section, values in (overrides or {}).items():
+        if isinstance(values, dict):
+            config.setdefault(section, {})
+            config[section] = dict(config[section] or {}, **values)
+        else:
+            config[section] = values
+    os.makedirs(config_folder + "logs")
+    with open(config_folder + "config.yaml", "w") as file_handle:
+        yaml.safe_dump(config, file_handle)
+    return config_folder
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    """Return {point: value} for the given percentiles of samples (seconds)"""
+    if not samples:
+        return {point: 0.0 for point in points}
+    ordered = sorted(samples)
+    return {point: ordered[min(len(ordered) - 1, int(len(ordered) * point / 100))] for point in points}
+
+def format_percentiles(samples):
+    values = percentiles(samples)
+    return ", ".join(f"p{point}: {value * 1e6:.1f}us" for point, value in values.items()) + f", n: {len(samples)}"
+
+def get_rss_bytes():
+    try:
+        with open("/proc/self/statm") as file_handle:
+            return int(file_handle.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
@@ -0,0 +1,106 @@
+"""End-to-end throughput benchmark: UDP load -> OpensyslogSyslog -> logs, state and a local Telegram stub
+
+    python benchmarks/bench_e2e.py --rate 5000 --duration 20 --dhcp-ratio 0.01 --new-mac-ratio 0.2
+    python benchmarks/bench_e2e.py --rate 0 --duration 10   # unthrottled, find the ceiling
+
+Reports sent vs logged (loss), receiver drop counters, sustained throughput, per-stage latency
+percentiles and RSS growth sampled every second.
+"""
+import argparse
+import collections
+import glob
+import threading
+import time
+
+from bench_common import make_config_folder, format_percentiles, get_rss_bytes
+from syslog_loadgen import SyslogLoadGenerator, replay_lines, send_lines
+from telegram_stub import TelegramStub
+
+import const
+from opensyslog_helper import OpensyslogHelper
+from opensyslog_syslog import OpensyslogSyslog
+
+def timed(samples, function):
+    """Wrap a bound method so every call appends its duration to samples"""
+    perf_counter = time.perf_counter
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            samples.append(perf_counter() - start)
+    return wrapper
+
+def run(args):
+    stub = TelegramStub(latency_seconds=args.telegram_latency_ms / 1000).start()
+    overrides = {"state": {"backend": args.backend}}
+    config_folder = make_config_folder(stub.base_url, overrides)
+    const.SYSLOG_SERVER_PORT = args.port
+
+    helper = OpensyslogHelper(config_folder)
+    syslog = OpensyslogSyslog(helper)
+    stage_samples = collections.defaultdict(list)
+    syslog.handle_incoming_data = timed(stage_samples["total per line"], syslog.handle_incoming_data)
+    helper.log_data = timed(stage_samples["log_data"], helper.log_data)
+    syslog.parser.parse = timed(stage_samples["parse"], syslog.parser.parse)
+    syslog.handle_event = timed(stage_samples["handle_event"], syslog.handle_event)
+    threading.Thread(target=syslog.monitor, name="bench-monitor", daemon=True).start()
+    while syslog.receiver is None:
+        time.sleep(0.05)
+
+    rss_samples = [get_rss_bytes()]
+    sampling = threading.Event()
+    def sample_rss():
+        while not sampling.wait(1):
+            rss_samples.append(get_rss_bytes())
+    threading.Thread(target=sample_rss, daemon=True).start()
+
+    if args.replay:
+        lines = replay_lines(args.replay)
+    else:
+        lines = iter(SyslogLoadGenerator(args.dhcp_ratio, args.new_mac_ratio, args.known_macs).next_line, None)
+    start = time.perf_counter()
+    sent = send_lines(lines, "127.0.0.1", args.port, args.rate, args.duration)
+    send_seconds = time.perf_counter() - start
+
+    # wait until the pipeline is idle
+    processed = stage_samples["total per line"]
+    previous = -1
+    while previous != len(processed) or syslog.receiver.queue.qsize() > 0:
+        previous = len(processed)
+        time.sleep(0.5)
+    total_seconds = time.perf_counter() - start - 0.5
+    sampling.set()
+    helper.syslog_log_sink.flush()
+    syslog.dhcpack_state.flush()
+    helper.telegram.close(timeout=10)
+
+    logged = 0
+    for file_name in glob.glob(config_folder + "logs/syslog-unifi-*.log"):
+        with open(file_name, "rb") as file_handle:
+            logged += sum(chunk.count(b"\n") for chunk in iter(lambda: file_handle.read(1 << 20), b""))
+    receiver = syslog.receiver
+    print(f"config folder: {config_folder}")
+    print(f"sent: {sent} in {send_seconds:.2f}s ({sent / send_seconds:.0f}/s offered)")
+    print(f"processed: {len(processed)} in {total_seconds:.2f}s ({len(processed) / total_seconds:.0f}/s sustained)")
+    print(f"logged: {logged}, lost: {sent - logged} ({(sent - logged) * 100 / max(sent, 1):.2f}%)")
+    print(f"receiver: {receiver.get_stats_string()}")
+    print(f"dedup suppressed: lines {syslog.line_dedup.duplicates_suppressed}, events {syslog.event_dedup.duplicates_suppressed}")
+    print(f"clients: {len(syslog.dhcp_ack_json)}, telegram messages: {len(stub.messages)} ({stub.requests_received} requests)")
+    for stage, samples in stage_samples.items():
+        print(f"{stage:>16}: {format_percentiles(samples)}")
+    print(f"rss MB: start {rss_samples[0] / 1e6:.1f}, end {rss_samples[-1] / 1e6:.1f}, peak {max(rss_samples) / 1e6:.1f}, samples {[round(rss / 1e6, 1) for rss in rss_samples[::max(1, len(rss_samples) // 10)]]}")
+    stub.stop()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="End-to-end syslog_unifi throughput benchmark")
+    parser.add_argument("--port", type=int, default=15142)
+    parser.add_argument("--rate", type=int, default=2000, help="lines per second, 0 = unthrottled")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--dhcp-ratio", type=float, default=0.01)
+    parser.add_argument("--new-mac-ratio", type=float, default=0.1)
+    parser.add_argument("--known-macs", type=int, default=200)
+    parser.add_argument("--replay", help="replay this syslog file instead of synthetic traffic")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--telegram-latency-ms", type=float, default=50)
+    run(parser.parse_args())
@@ -0,0 +1,81 @@
+"""Microbenchmarks for the per-line hot path and the web views
+
+    python benchmarks/bench_micro.py --clients 5000
+"""
+import argparse
+import itertools
+import time
+import tracemalloc
+
+from bench_common import make_config_folder
+
+from opensyslog_helper import OpensyslogHelper
+from opensyslog_syslog import OpensyslogSyslog
+import restful_server
+
+NOISE_LINE = b"<30>Oct 18 10:00:00 UCG-Ultra stahtd: stahtd[2534]: [STA-TRACKER].stahtd_dump_event(): {\"message_type\":\"STA_ASSOC_TRACKER\",\"mac\":\"aa:bb:cc:dd:ee:ff\",\"vap\":\"ra0\",\"event_type\":\"sta_roam\"}"
+
+def bench(name, function, number):
+    function() # warm up
+    start = time.perf_counter()
+    for _ in range(number):
+        function()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>40}: {elapsed / number * 1e6:10.2f} us/op ({number / elapsed:12.0f} ops/s)")
+
+def measure_table(name, load_table):
+    """Memory held by the client table load_table() returns, per client"""
+    tracemalloc.start()
+    table = load_table()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"{name:>40}: {size / max(1, len(table)):10.0f} bytes/client ({len(table)} clients, {size / 1024 / 1024:.1f} MB)")
+
+def dhcpack_lines(count):
+    for i in itertools.count():
+        n = i % count
+        yield f"<30>Oct 18 10:00:00 UCG-Ultra dnsmasq-dhcp[1812]: DHCPACK(br0) 10.{n >> 16 & 255}.{n >> 8 & 255}.{n & 255} 02:00:00:{n >> 16 & 255:02x}:{n >> 8 & 255:02x}:{n & 255:02x} host-{n}".encode()
+
+def run(args):
+    config_folder = make_config_folder(overrides={"notifications": {"default_notify_type": 1}})
+    helper = OpensyslogHelper(config_folder)
+    syslog = OpensyslogSyslog(helper)
+    syslog.event_dedup.window_seconds = 0 # every call takes the full path
+
+    print(f"config folder: {config_folder}")
+    bench("parser.parse (noise)", lambda: syslog.parser.parse(NOISE_LINE), args.number)
+    lines = dhcpack_lines(args.clients)
+    bench("parser.parse (DHCPACK)", lambda: syslog.parser.parse(next(lines)), args.number)
+    bench("parse_message_data (noise)", lambda: syslog.parse_message_data(NOISE_LINE), args.number)
+    bench("parse_message_data (DHCPACK)", lambda: syslog.parse_message_data(next(lines)), args.number)
+    events = itertools.cycle([syslog.parser.parse(next(lines), time.time()) for _ in range(args.clients)])
+    bench("handle_event (DHCPACK)", lambda: syslog.handle_event(next(events)), args.number)
+    bench("log_data", lambda: helper.log_data(NOISE_LINE), args.number)
+    bench("handle_incoming_data (noise)", lambda: syslog.handle_incoming_data(NOISE_LINE), args.number)
+    syslog.dhcpack_state.flush()
+    def flush_whole_table():
+        with syslog.dhcpack_state.lock:
+            syslog.dhcpack_state.mark_dirty()
+        syslog.dhcpack_state.flush()
+    bench("state flush (whole table)", flush_whole_table, 5)
+    measure_table("client table (dicts, JSON layout)", helper.load_dhcpack_status_json)
+    measure_table("client table (OpensyslogClient)", syslog.dhcpack_state.load_clients)
+
+    restful_server.restfulServerHelper = helper
+    restful_server.restfulServerState = syslog.dhcpack_state
+    client = restful_server.restfulServerApp.test_client()
+    print(f"web views with {len(syslog.dhcp_ack_json)} clients")
+    for url in ["/", "/datetime", "/ip", "/ip?limit=50&offset=100", "/api/clients?sort=ip", "/notifications?last=100"]:
+        def cold():
+            with syslog.dhcpack_state.lock:
+                syslog.dhcpack_state.mark_dirty() # new version, cache miss
+            return client.get(url).data
+        bench(f"GET {url} (changed)", cold, args.view_number)
+        bench(f"GET {url} (cached)", lambda: client.get(url).data, args.view_number)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="syslog_unifi microbenchmarks")
+    parser.add_argument("--clients", type=int, default=2000, help="distinct MACs in the DHCPACK lines and the client table")
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--view-number", type=int, default=50)
+    run(parser.parse_args())
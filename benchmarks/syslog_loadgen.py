@@ -0,0 +1,91 @@
+"""Unifi syslog traffic generator
+
+Sends synthetic (or replayed) syslog lines over UDP at a controlled rate:
+    python benchmarks/syslog_loadgen.py --rate 5000 --duration 30 --dhcp-ratio 0.01 --new-mac-ratio 0.2
+    python benchmarks/syslog_loadgen.py --replay logs/syslog-unifi-2024-01-01.log --rate 2000
+"""
+import argparse
+import itertools
+import random
+import socket
+import time
+
+NOISE_TEMPLATES = [
+    "<30>{ts} UCG-Ultra stahtd: stahtd[2534]: [STA-TRACKER].stahtd_dump_event(): {{\"message_type\":\"STA_ASSOC_TRACKER\",\"mac\":\"{mac}\",\"vap\":\"ra0\",\"event_type\":\"sta_roam\",\"seq\":\"{seq}\"}}",
+    "<14>{ts} UCG-Ultra kernel: [WAN_LOCAL-default-D]IN=eth4 OUT= MAC={mac}:08:00 SRC=203.0.113.{octet} DST=198.51.100.7 LEN=60 TOS=0x00 PROTO=TCP SPT={seq} DPT=443",
+    "<30>{ts} UCG-Ultra mcad: mcad[2212]: ace_reporter.reporter_send(): seq={seq} Sending inform to http://unifi:8080/inform",
+    "<27>{ts} UCG-Ultra dnsmasq[1812]: query[A] host{octet}.example.com from 192.168.1.{octet} seq={seq}",
+]
+DHCPACK_TEMPLATE = "<30>{ts} UCG-Ultra dnsmasq-dhcp[1812]: DHCPACK(br0) {ip} {mac} {host}"
+
+class SyslogLoadGenerator:
+    """Builds a mix of DHCPACK and noise lines, every line is unique so line dedup never hides loss"""
+    def __init__(self, dhcp_ratio=0.01, new_mac_ratio=0.1, known_macs=200, seed=1):
+        self.random = random.Random(seed)
+        self.dhcp_ratio = dhcp_ratio
+        self.new_mac_ratio = new_mac_ratio
+        self.known_macs = [self.random_mac() for _ in range(known_macs)]
+        self.sequence = itertools.count()
+
+    def random_mac(self):
+        return ":".join(f"{self.random.randrange(256):02x}" for _ in range(6))
+
+    def next_line(self):
+        seq = next(self.sequence)
+        ts = time.strftime("%b %d %H:%M:%S")
+        if self.random.random() < self.dhcp_ratio:
+            if self.random.random() < self.new_mac_ratio:
+                mac = self.random_mac()
+                self.known_macs.append(mac)
+            else:
+                mac = self.random.choice(self.known_macs)
+            ip = f"192.168.{self.random.randrange(1, 4)}.{self.random.randrange(2, 254)}"
+            return DHCPACK_TEMPLATE.format(ts=ts, ip=ip, mac=mac, host=f"dev-{mac[-5:].replace(':', '')}-{seq}")
+        return self.random.choice(NOISE_TEMPLATES).format(ts=ts, mac=self.random.choice(self.known_macs), seq=seq, octet=seq % 250 + 1)
+
+def replay_lines(file_name):
+    while True:
+        with open(file_name, "r", errors="replace") as file_handle:
+            for line in file_handle:
+                yield line.rstrip("\n")
+
+def send_lines(lines, host, port, rate, duration, max_lines=None):
+    """Send lines at rate per second (0 = as fast as possible) for duration seconds, returns lines sent"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    address = (host, port)
+    sent = 0
+    start = time.perf_counter()
+    deadline = start + duration
+    burst = max(1, rate // 1000) if rate else 64 # pace in ~1ms bursts
+    while True:
+        now = time.perf_counter()
+        if now >= deadline or (max_lines is not None and sent >= max_lines):
+            break
+        if rate:
+            ahead = sent / rate - (now - start)
+            if ahead > 0:
+                time.sleep(ahead)
+        for _ in range(burst):
+            sock.sendto(next(lines).encode("utf-8"), address)
+            sent += 1
+    sock.close()
+    return sent
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Unifi syslog UDP load generator")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5142)
+    parser.add_argument("--rate", type=int, default=1000, help="lines per second, 0 = unthrottled")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--dhcp-ratio", type=float, default=0.01, help="fraction of lines that are DHCPACK")
+    parser.add_argument("--new-mac-ratio", type=float, default=0.1, help="fraction of DHCPACKs from never seen MACs")
+    parser.add_argument("--known-macs", type=int, default=200)
+    parser.add_argument("--replay", help="send the lines of this syslog file instead of synthetic traffic")
+    args = parser.parse_args()
+    if args.replay:
+        lines = replay_lines(args.replay)
+    else:
+        generator = SyslogLoadGenerator(args.dhcp_ratio, args.new_mac_ratio, args.known_macs)
+        lines = iter(generator.next_line, None)
+    sent = send_lines(lines, args.host, args.port, args.rate, args.duration)
+    print(f"sent: {sent} lines in {args.duration}s ({sent / args.duration:.0f}/s)")
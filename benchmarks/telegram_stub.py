@@ -0,0 +1,78 @@
+"""Local stand-in for api.telegram.org used by the benchmarks
+
+Run standalone and point telegram: api_base_url at it:
+    python benchmarks/telegram_stub.py --port 18080 --latency-ms 200
+"""
+import argparse
+import http.server
+import json
+import threading
+import time
+import urllib.parse
+
+class TelegramStubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real API
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        fields = urllib.parse.parse_qs(self.rfile.read(length).decode("utf-8"))
+        stub = self.server.stub
+        if stub.latency_seconds > 0:
+            time.sleep(stub.latency_seconds)
+        with stub.lock:
+            stub.requests_received += 1
+            throttle = stub.throttle_every > 0 and stub.requests_received % stub.throttle_every == 0
+            if not throttle:
+                stub.messages.append((time.time(), fields.get("text", [""])[0]))
+        if throttle:
+            self.send_json(429, {"ok": False, "error_code": 429, "description": "Too Many Requests", "parameters": {"retry_after": 1}})
+        else:
+            self.send_json(200, {"ok": True, "result": {"message_id": stub.requests_received}})
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class TelegramStub:
+    """Threaded HTTP server answering sendMessage, optionally slow or throttling every Nth request"""
+    def __init__(self, port=0, latency_seconds=0.0, throttle_every=0):
+        self.latency_seconds = latency_seconds
+        self.throttle_every = throttle_every
+        self.lock = threading.Lock()
+        self.requests_received = 0
+        self.messages = [] # (receive time, text)
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), TelegramStubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.base_url = f"http://127.0.0.1:{self.port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="telegram-stub", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local Telegram sendMessage stub")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every Nth request with 429")
+    args = parser.parse_args()
+    stub = TelegramStub(args.port, args.latency_ms / 1000, args.throttle_every).start()
+    print(f"Telegram stub listening on {stub.base_url}")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"requests: {stub.requests_received}, messages: {len(stub.messages)}")
+    except KeyboardInterrupt:
+        stub.stop()
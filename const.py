@@ -9,21 +9,115 @@ NOTIFY_CONNECT_EACH_TIME_WITH_MAX_PER_DAY = 5
 NOTIFY_CONNECT_EACH_TIME_WITH_MAX_PER_DAY_WITH_INTERMITTENT = 6
 NOTIFY_CONNECT_DEVICE_NOT_IN_LOOKUP_FILE = 7
 
+# Event types produced by the syslog parser
+EVENT_DHCPACK = "DHCPACK"
+EVENT_DHCPNAK = "DHCPNAK"
+EVENT_DHCPRELEASE = "DHCPRELEASE"
+EVENT_WIFI_ASSOCIATED = "WIFI_ASSOCIATED"
+EVENT_WIFI_DISASSOCIATED = "WIFI_DISASSOCIATED"
+
 # Notifications related consts
 DEFAULT_NOTIFICATION_STRING = "Device got connected Name: {NAME}, IP: {IP}, MAC: {MAC}, Count: {COUNT}"
 DND_NOTIFY_START_HOUR = 22
 DND_NOTIFY_END_HOUR = 8
 MAX_NOTIFY_COUNT_PER_DAY = 5
 
+# Telegram dispatcher consts
+TELEGRAM_API_BASE_URL = "https://api.telegram.org"
+TELEGRAM_TIMEOUT_SECONDS = 30
+TELEGRAM_MIN_INTERVAL_SECONDS = 1 # Telegram allows about one message per second per chat
+TELEGRAM_MAX_RETRIES = 5
+TELEGRAM_MAX_BACKOFF_SECONDS = 60
+TELEGRAM_COALESCE_THRESHOLD = 3
+TELEGRAM_QUEUE_SIZE = 1000
+TELEGRAM_CLOSE_TIMEOUT_SECONDS = 5 # for the queued messages at exit, OpensyslogMonitor gives it what is left of the shutdown deadline
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+
 # Logs file purge details
 PURGE_LOGS_AFTER_DAYS = 7
 
+# log writer consts
+LOG_FLUSH_SIZE_KB = 64
+LOG_FLUSH_INTERVAL_SECONDS = 1
+LOG_BUFFER_MAX_SIZE_MB = 16 # unwritten data a log file that keeps failing (disk full) may hold, newer lines are dropped past it
+LOG_COMPRESSION_AUTO = "auto" # zstd if the zstandard module is installed, otherwise gzip
+LOG_COMPRESSION_GZIP = "gzip"
+LOG_COMPRESSION_ZSTD = "zstd"
+LOG_COMPRESSION_NONE = "none"
+LOG_COMPRESSION_LEVEL_GZIP = 6
+LOG_COMPRESSION_LEVEL_ZSTD = 10
+LOG_MAX_TOTAL_SIZE_MB = 0 # 0 = no size limit, only purge_after_days
+LOG_ARCHIVE_DELAY_SECONDS = 60 # after midnight, lets every writer roll over and flush first
+LOG_COMPRESSION_BLOCK_SIZE = 1024 * 1024 # files without a search index are compressed in blocks of this size
+
+# syslog search consts
+SEARCH_INDEX_BLOCK_SIZE_KB = 256 # lines are indexed and compressed in blocks of about this size
+SEARCH_INDEX_INTERVAL_SECONDS = 5
+SEARCH_MAX_SCAN_MB = 256 # a search stops after reading this much
+SEARCH_SCAN_CHUNK_SIZE = 1024 * 1024 # decompressed bytes read at a time from a file without an index
+SEARCH_CACHED_INDEX_FILES = 8
+SEARCH_INDEX_EXTENSION = ".idx"
+SEARCH_DEFAULT_LIMIT = 100
+SEARCH_MAX_LIMIT = 5000
+
+# device timeline consts
+TIMELINE_RETENTION_DAYS = 7 # hourly connect counts kept per device
+TIMELINE_FLAP_HALF_LIFE_HOURS = 3 # a connect counts half as much in the flap score after this long
+TIMELINE_IP_HISTORY_SIZE = 10
+TIMELINE_SAVE_INTERVAL_SECONDS = 60
+TIMELINE_EVENT_TYPES = (EVENT_DHCPACK, EVENT_WIFI_ASSOCIATED)
+TIMELINE_TOP_FLAPPERS = 20
+
+# replay consts
+REPLAY_READ_BUFFER_SIZE = 1024 * 1024 # read buffer of each replayed file
+
 # syslog consts
-SYSLOG_SOCKET_RECEIVE_BUFFER = 4096
+SYSLOG_SOCKET_RECEIVE_BUFFER = 4096 # default max datagram size
+SYSLOG_SOCKET_RCVBUF_KB = 4096 # default kernel socket buffer (SO_RCVBUF)
+SYSLOG_BATCH_SIZE = 64
+SYSLOG_QUEUE_SIZE = 1000 # in batches
+SYSLOG_STATS_INTERVAL_SECONDS = 60
+SYSLOG_WORKER_PROCESSES = 0 # 0 = receive, parse and apply state in this process
+SYSLOG_WORKER_HEALTH_CHECK_SECONDS = 5
+SYSLOG_WORKER_METRICS_INTERVAL_SECONDS = 5
 SYSLOG_SERVER_IP = "0.0.0.0"
 SYSLOG_SERVER_PORT = 5142
+SYSLOG_TCP_PORT = 0 # 0 = no TCP listener, 5142 or 6514 are common choices
+SYSLOG_TCP_MAX_CONNECTIONS = 256
+SYSLOG_TCP_MAX_MESSAGE_SIZE = 65536
+SYSLOG_TCP_READ_SIZE = 65536 # per connection and select round
+
+# shutdown consts
+SHUTDOWN_DEADLINE_SECONDS = 8 # docker stop sends SIGKILL 10s after SIGTERM, the whole stop sequence shares this
+SHUTDOWN_FLUSH_RESERVE_SECONDS = 2 # of the deadline kept for flushing the state and the logs after the ingest
+SHUTDOWN_DRAIN_TIMEOUT_SECONDS = 5 # for the syslog workers to forward what they still hold
+
+# duplicate suppression consts
+DEDUP_LINE_WINDOW_SECONDS = 5
+DEDUP_EVENT_WINDOW_SECONDS = 5
+DEDUP_MAX_ENTRIES = 10000
+
+# MAC lookup consts
+LOOKUP_RELOAD_INTERVAL_SECONDS = 10
+VENDOR_LOOKUP_COLUMN_FOR_PREFIX = "Assignment" # IEEE oui.csv
+VENDOR_LOOKUP_COLUMN_FOR_VENDOR = "Organization Name"
+
+# client state persistence consts
+STATE_FLUSH_INTERVAL_SECONDS = 5
+STATE_FLUSH_AFTER_CHANGES = 500
+STATE_BACKEND_JSON = "json"
+STATE_BACKEND_SQLITE = "sqlite"
+STATE_EVENT_RETENTION_DAYS = 90
+
+# notification history consts
+NOTIFICATION_HIST_ROTATE_SIZE_MB = 10
+NOTIFICATION_HIST_ROTATE_AFTER_DAYS = 1
+NOTIFICATION_HIST_RECENT_ENTRIES = 1000
 
 # file consts
 APP_CONFIG_FILE = 'config.yaml'
 JSON_FILE_UNIFI_DHCPACK_FILE = 'unifi_dhcpack_status.json'
-JSON_FILE_NOTIFICATION_HIST_FILE  = 'notification_history.json'
+JSON_FILE_DEVICE_TIMELINE_FILE = 'device_timeline.json'
+JSON_FILE_NOTIFICATION_HIST_FILE  = 'notification_history.json' # legacy format, migrated to JSONL_FILE_NOTIFICATION_HIST_FILE
+JSONL_FILE_NOTIFICATION_HIST_FILE = 'notification_history.jsonl'
+SQLITE_DB_FILE = 'syslog_unifi.db'
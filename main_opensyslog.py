@@ -1,31 +1,106 @@
+import argparse
+import datetime
+import os
+import signal
 import sys
+import threading
+import time
 import traceback
 
 from opensyslog_helper import OpensyslogHelper
-from opensyslog_syslog import OpensyslogSyslog
-import restful_server
+from opensyslog_replay import OpensyslogReplay
+from opensyslog_syslog import OpensyslogSyslog, start_receivers
+from opensyslog_workers import SHUTDOWN_SIGNALS, OpensyslogWorkers
+import const
 
 class OpensyslogMonitor:
     def __init__(self, config_folder):
-        self.helper = OpensyslogHelper(config_folder)
+        # blocked before any thread starts so they all inherit it, run() takes SIGTERM/SIGINT with sigwait()
+        signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+        start = time.time()
+        self.helper = OpensyslogHelper(config_folder, defer_components=True)
         self.helper.print(self.helper.log_level_info, "OpensyslogMonitor: Starting Monitor")
 
-        restful_server.restful_server_start(self.helper)
-        self.syslog = OpensyslogSyslog(self.helper)
-        while True:
+        # receive first, the socket buffer and the receive queue hold what arrives while the rest loads
+        self.workers = None
+        receivers = None
+        worker_processes = (self.helper.config.get("syslog") or {}).get("worker_processes", const.SYSLOG_WORKER_PROCESSES)
+        if worker_processes > 0:
+            self.workers = OpensyslogWorkers(self.helper, worker_processes)
+            self.workers.start()
+        else:
+            try:
+                receivers = start_receivers(self.helper)
+            except Exception as e:
+                # e.g. the port is still taken, OpensyslogSyslog.monitor() keeps retrying
+                self.helper.print(self.helper.log_level_error, f"OpensyslogMonitor: syslog receivers not started: {str(e)}")
+        import restful_server # flask takes longer to import than the rest of the startup, so only after the bind
+        self.restful_server = restful_server
+        self.helper.load_components()
+        self.syslog = OpensyslogSyslog(self.helper, receivers=receivers)
+        self.ingest = self.syslog
+        if self.workers is not None:
+            self.workers.syslog = self.syslog
+            self.ingest = self.workers
+        self.restful_server.restful_server_start(self.helper, self.syslog.dhcpack_state)
+        self.ingest_thread_handle = threading.Thread(target=self.ingest_thread, name="syslog-ingest", daemon=True)
+        self.ingest_thread_handle.start()
+        self.helper.print(self.helper.log_level_info, f"OpensyslogMonitor: started in {time.time() - start:.2f}s")
+
+    def ingest_thread(self):
+        while not self.ingest.stop_event.is_set():
             try:
                 self.helper.print(self.helper.log_level_debug, "OpensyslogMonitor: Start syslog monitor loop")
-                self.syslog.monitor()
+                self.ingest.monitor()
             except Exception as e:
                 exception_info = "OpensyslogMonitor:exception: {}\n Call Stack: {}".format(str(e), str(traceback.format_exc()))
                 self.helper.print(self.helper.log_level_error, exception_info)
 
+    def run(self):
+        """Wait for docker stop or Ctrl-C, then shut down"""
+        signal_number = signal.sigwait(SHUTDOWN_SIGNALS)
+        self.helper.print(self.helper.log_level_info, f"OpensyslogMonitor: {signal.Signals(signal_number).name} received, shutting down")
+        self.stop()
+
+    def stop(self):
+        """Drain the ingest queue, flush the client state and the logs, stop the web server"""
+        start = time.time()
+        # one deadline for every step, what is still running when docker sends SIGKILL is lost
+        deadline = time.monotonic() + const.SHUTDOWN_DEADLINE_SECONDS
+        self.ingest.stop()
+        self.ingest_thread_handle.join(timeout=max(0, deadline - const.SHUTDOWN_FLUSH_RESERVE_SECONDS - time.monotonic()))
+        if self.ingest_thread_handle.is_alive():
+            self.helper.print(self.helper.log_level_warning, "OpensyslogMonitor: syslog ingest did not finish, flushing what was applied")
+        self.restful_server.restful_server_stop()
+        self.syslog.dhcpack_state.close()
+        self.helper.print(self.helper.log_level_info, f"OpensyslogMonitor: stopped in {time.time() - start:.2f}s")
+        self.helper.close(deadline)
+
+def replay(root_path, args):
+    """Rebuild the client table (and the sqlite event history) from the archived syslog files, no notifications are sent"""
+    helper = OpensyslogHelper(root_path, defer_components=True)
+    # no archive, search or Telegram: the archive would compress and delete the files being replayed
+    helper.load_state_components(write_behind=False)
+    syslog = OpensyslogSyslog(helper, notifications_enabled=False, write_behind=False)
+    replayed = OpensyslogReplay(helper, syslog).run(args.jobs, args.from_date, args.to_date, args.reset)
+    helper.close()
+    sys.exit(0 if replayed else 1)
+
 if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        root_path = sys.argv[1]
-        if not root_path.endswith("/"):
-            root_path = root_path + "/"
-    else:
-        root_path = "/config/"
+    parser = argparse.ArgumentParser(description="Syslog server for the Unifi Network application")
+    parser.add_argument("config_folder", nargs="?", default="/config/")
+    parser.add_argument("--replay", action="store_true", help="replay the archived syslog files into the client table and exit, stop the running server first")
+    parser.add_argument("--from", dest="from_date", type=datetime.date.fromisoformat, help="first day to replay, YYYY-MM-DD")
+    parser.add_argument("--to", dest="to_date", type=datetime.date.fromisoformat, help="last day to replay, YYYY-MM-DD")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="files parsed in parallel (default: CPU count)")
+    parser.add_argument("--reset", action="store_true", help="start the replay from an empty client table")
+    args = parser.parse_args()
+    root_path = args.config_folder
+    if not root_path.endswith("/"):
+        root_path = root_path + "/"
     print("Config folder: " + root_path)
-    main_object = OpensyslogMonitor(root_path)
+    if args.replay:
+        replay(root_path, args)
+    else:
+        main_object = OpensyslogMonitor(root_path)
+        main_object.run()
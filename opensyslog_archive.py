@@ -0,0 +1,223 @@
+"""Module to compress closed daily log files and purge the log archive in the background"""
+import datetime
+import gzip
+import os
+import re
+import threading
+import time
+import traceback
+
+import const
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# <prefix>-YYYY-MM-DD.log, optionally compressed
+DAILY_FILE_PATTERN = re.compile(r"^(?P<prefix>.+)-(?P<date>\d{4}-\d{2}-\d{2})\.log(?P<extension>\.gz|\.zst)?$")
+# left behind by a compression (or its search index) that was interrupted, e.g. syslog-unifi-2024-10-18.log.gz.tmp
+TEMP_FILE_PATTERN = re.compile(r"^.+-\d{4}-\d{2}-\d{2}\.log(\.gz|\.zst)(\.idx)?\.tmp$")
+COMPRESSED_EXTENSIONS = {const.LOG_COMPRESSION_GZIP: ".gz", const.LOG_COMPRESSION_ZSTD: ".zst"}
+
+class OpensyslogArchiveFile:
+    """Index entry of one file in the log folder"""
+    def __init__(self, file_name_with_path, size, file_date, compressible=False):
+        self.file_name_with_path = file_name_with_path
+        self.size = size
+        self.file_date = file_date # datetime.date of the day the file covers
+        self.compressible = compressible # an uncompressed daily file
+
+class OpensyslogArchive:
+    """Keeps an index of the log folder, compresses yesterday's files after midnight and applies retention by age and size"""
+    def __init__(self, opensysloghelper, file_prefixes):
+        self.helper = opensysloghelper
+        self.file_prefixes = file_prefixes # full path prefixes of the daily files, e.g. .../logs/syslog-unifi
+        logs_config = self.helper.config["logs"]
+        self.compression = logs_config.get("compression", const.LOG_COMPRESSION_AUTO)
+        if self.compression == const.LOG_COMPRESSION_AUTO:
+            self.compression = const.LOG_COMPRESSION_ZSTD if zstandard is not None else const.LOG_COMPRESSION_GZIP
+        elif self.compression == const.LOG_COMPRESSION_ZSTD and zstandard is None:
+            self.helper.print(self.helper.log_level_warning, "OpensyslogArchive: zstandard module not installed, using gzip")
+            self.compression = const.LOG_COMPRESSION_GZIP
+        self.purge_after_days = self.helper.log_purge_after_days
+        self.max_total_size_bytes = logs_config.get("max_total_size_mb", const.LOG_MAX_TOTAL_SIZE_MB) * 1024 * 1024
+
+        self.lock = threading.Lock()
+        self.files = {} # file name with path -> OpensyslogArchiveFile
+        self.indexed_until = None # daily files up to and including this date are in the index
+        self.wake_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.helper.metrics.gauge("log_archive_bytes", "Size of the files in the log folder as of the last archive run", self.get_total_size)
+        self.helper.metrics.gauge("log_archive_files", "Files in the log folder as of the last archive run", lambda: len(self.files))
+        self.archive_thread_handle = threading.Thread(target=self.archive_thread, name="log-archive", daemon=True)
+        self.archive_thread_handle.start()
+
+    def archive_thread(self):
+        while not self.stop_event.is_set():
+            try:
+                self.run()
+            except Exception as e:
+                exception_info = f"OpensyslogArchive:archive_thread(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+            # a little after midnight, once every writer has rolled over to the new day's file and flushed the old one
+            tomorrow = datetime.date.today() + datetime.timedelta(days=1)
+            next_run = datetime.datetime.combine(tomorrow, datetime.time()).timestamp() + const.LOG_ARCHIVE_DELAY_SECONDS
+            self.wake_event.wait(max(1, next_run - time.time()))
+            self.wake_event.clear()
+
+    def run(self):
+        today = datetime.date.today()
+        if self.indexed_until is None:
+            self.scan_folder()
+        else:
+            self.index_new_files(today)
+        self.indexed_until = today
+        self.purge_by_age(today) # first, so nothing gets compressed just to be deleted
+        try:
+            for entry in self.get_entries():
+                if entry.file_date < today and entry.compressible:
+                    try:
+                        self.compress_file(entry)
+                    except Exception as e:
+                        # e.g. disk full, the file stays uncompressed until the next run
+                        exception_info = f"OpensyslogArchive: compressing {entry.file_name_with_path} failed: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                        self.helper.print(self.helper.log_level_error, exception_info)
+        finally:
+            # also after a failure, a full disk is when the size limit matters most
+            self.purge_by_size(today)
+            self.helper.purge_older_dhcp_events()
+
+    def scan_folder(self):
+        """Build the index with one listing of the log folder, only done at startup"""
+        with os.scandir(self.helper.log_folder) as directory_entries:
+            for directory_entry in directory_entries:
+                if not directory_entry.is_file() or directory_entry.name.endswith(const.SEARCH_INDEX_EXTENSION):
+                    continue
+                if TEMP_FILE_PATTERN.match(directory_entry.name):
+                    # nothing else writes these, the source file is still there and gets compressed again
+                    os.remove(directory_entry.path)
+                    self.helper.print(self.helper.log_level_info, f"OpensyslogArchive: removed the stale {directory_entry.path}")
+                    continue
+                self.add_file(directory_entry.path, directory_entry.stat())
+        self.helper.print(self.helper.log_level_debug, "OpensyslogArchive: indexed %s files", len(self.files))
+
+    def index_new_files(self, today):
+        """Add the daily files started since the last run, their names are known so nothing gets listed"""
+        date = self.indexed_until
+        while date <= today:
+            for file_prefix in self.file_prefixes:
+                file_name_with_path = file_prefix + "-" + date.strftime('%Y-%m-%d') + ".log"
+                try:
+                    self.add_file(file_name_with_path, os.stat(file_name_with_path))
+                except FileNotFoundError:
+                    pass
+            date += datetime.timedelta(days=1)
+
+    def add_file(self, file_name_with_path, stat):
+        match = DAILY_FILE_PATTERN.match(os.path.basename(file_name_with_path))
+        if match is not None:
+            entry = OpensyslogArchiveFile(file_name_with_path, stat.st_size, datetime.date.fromisoformat(match.group("date")), match.group("extension") is None)
+        else:
+            # not one of ours, aged by modification time and never compressed
+            entry = OpensyslogArchiveFile(file_name_with_path, stat.st_size, datetime.date.fromtimestamp(stat.st_mtime))
+        with self.lock:
+            self.files[file_name_with_path] = entry
+
+    def get_entries(self):
+        """Index entries sorted oldest first"""
+        with self.lock:
+            return sorted(self.files.values(), key=lambda entry: (entry.file_date, entry.file_name_with_path))
+
+    def compress_file(self, entry):
+        extension = COMPRESSED_EXTENSIONS.get(self.compression)
+        if extension is None:
+            return # compression: none
+        source = entry.file_name_with_path
+        target = source + extension
+        start = time.time()
+        # one gzip member / zstd frame per search index block, so /search can decompress just the blocks it needs
+        block_boundaries = self.helper.search.get_block_boundaries(source) if self.helper.search is not None else None
+        source_size = os.stat(source).st_size
+        if not block_boundaries:
+            block_boundaries = list(range(const.LOG_COMPRESSION_BLOCK_SIZE, source_size, const.LOG_COMPRESSION_BLOCK_SIZE)) + [source_size]
+        elif block_boundaries[-1] < source_size:
+            block_boundaries.append(source_size) # an unterminated last line
+        compressed_offsets = []
+        try:
+            with open(source, "rb") as source_handle, open(target + ".tmp", "wb") as target_handle:
+                block_start = 0
+                for block_end in block_boundaries:
+                    data = source_handle.read(block_end - block_start)
+                    block_start = block_end
+                    if self.compression == const.LOG_COMPRESSION_ZSTD:
+                        target_handle.write(zstandard.ZstdCompressor(level=const.LOG_COMPRESSION_LEVEL_ZSTD).compress(data))
+                    else:
+                        # mtime=0 keeps the output reproducible, the date is in the file name
+                        target_handle.write(gzip.compress(data, compresslevel=const.LOG_COMPRESSION_LEVEL_GZIP, mtime=0))
+                    compressed_offsets.append(target_handle.tell())
+                target_handle.flush()
+                os.fsync(target_handle.fileno())
+            os.replace(target + ".tmp", target)
+        except Exception:
+            try:
+                os.remove(target + ".tmp") # a partial file would only take more of a full disk
+            except FileNotFoundError:
+                pass
+            raise
+        if self.helper.search is not None:
+            self.helper.search.set_compressed(source, target, compressed_offsets)
+        os.remove(source)
+        compressed_size = os.stat(target).st_size
+        with self.lock:
+            self.files.pop(source, None)
+            self.files[target] = OpensyslogArchiveFile(target, compressed_size, entry.file_date)
+        msg_str = f"OpensyslogArchive: compressed {source} {source_size} -> {compressed_size} bytes in {time.time() - start:.1f}s"
+        self.helper.print(self.helper.log_level_info, msg_str)
+
+    def purge_by_age(self, today):
+        """Drop files older than purge_after_days"""
+        for entry in self.get_entries():
+            age_days = (today - entry.file_date).days
+            if age_days > self.purge_after_days:
+                self.remove_file(entry, f"age: {age_days}")
+
+    def purge_by_size(self, today):
+        """Drop the oldest files while the log folder is over max_total_size_mb"""
+        if self.max_total_size_bytes <= 0:
+            return
+        remaining = self.get_entries()
+        for entry in remaining:
+            if entry.file_date == today:
+                # still being written, refresh its size but never purge it
+                try:
+                    entry.size = os.stat(entry.file_name_with_path).st_size
+                except FileNotFoundError:
+                    entry.size = 0
+        total_size = sum(entry.size for entry in remaining)
+        for entry in remaining:
+            if total_size <= self.max_total_size_bytes or entry.file_date == today:
+                break
+            self.remove_file(entry, f"archive size: {total_size}")
+            total_size -= entry.size
+
+    def remove_file(self, entry, reason):
+        try:
+            os.remove(entry.file_name_with_path)
+            self.helper.print(self.helper.log_level_info, f"Purged file: {entry.file_name_with_path}, {reason}")
+        except FileNotFoundError:
+            pass
+        try:
+            os.remove(entry.file_name_with_path + const.SEARCH_INDEX_EXTENSION)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.files.pop(entry.file_name_with_path, None)
+
+    def get_total_size(self):
+        with self.lock:
+            return sum(entry.size for entry in self.files.values())
+
+    def close(self):
+        self.stop_event.set()
+        self.wake_event.set()
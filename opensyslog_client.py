@@ -0,0 +1,94 @@
+"""Module with the compact in-memory record of one DHCP client"""
+import datetime
+import json
+import operator
+import socket
+import sys
+import time
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+IP_SORT_KEY_NOT_IPV4 = 1 << 32 # after every 32 bit IPv4 number
+encode_json_string = json.encoder.encode_basestring_ascii # what json.dumps() uses for str, without its per call overhead
+
+CLIENT_FIELDS = ("ip", "name", "host_name", "reconnect_count_per_day", "last_connected", "notify")
+FIELD_IP, FIELD_NAME, FIELD_HOST_NAME, FIELD_RECONNECT_COUNT, FIELD_LAST_CONNECTED, FIELD_NOTIFY = range(len(CLIENT_FIELDS))
+# snapshots are tuples of these fields, made in C: the garbage collector soon untracks a tuple of ints and strings, a copied record it keeps scanning
+get_client_fields = operator.attrgetter(*CLIENT_FIELDS)
+
+def mac_to_int(mac_address):
+    """'AA:BB:CC:DD:EE:FF' -> 48 bit int, the key of the client table"""
+    return int(mac_address.replace(":", ""), 16)
+
+def int_to_mac(mac_number):
+    return mac_number.to_bytes(6, "big").hex(":").upper()
+
+def ip_to_int(ip_address):
+    """Dotted IPv4 -> 32 bit int, sorts like the address, anything else (None, IPv6, a typo) is kept as it is"""
+    try:
+        ip_number = int.from_bytes(socket.inet_aton(ip_address), "big")
+    except (OSError, TypeError):
+        return ip_address
+    # inet_aton() also takes "10.1", octal parts and trailing text, those would not be written back the same
+    return ip_number if int_to_ip(ip_number) == ip_address else ip_address
+
+def int_to_ip(ip_number):
+    """Text of an ip_to_int() value, one that was kept as it was comes back unchanged"""
+    if type(ip_number) is not int:
+        return ip_number
+    return socket.inet_ntoa(ip_number.to_bytes(4, "big"))
+
+def get_ip_sort_key(ip_number):
+    """IPv4 addresses in address order, the values kept as they were after them"""
+    return ip_number if type(ip_number) is int else IP_SORT_KEY_NOT_IPV4
+
+def intern_name(name):
+    # a few hundred distinct names are shared by tens of thousands of clients
+    return sys.intern(name) if isinstance(name, str) else name
+
+def format_time(epoch_seconds):
+    return time.strftime(TIME_FORMAT, time.localtime(epoch_seconds))
+
+def encode_json_value(value):
+    if isinstance(value, str):
+        return encode_json_string(value)
+    if type(value) is int:
+        return str(value)
+    return json.dumps(value) # None, bool
+
+def parse_time(time_str):
+    try:
+        return int(datetime.datetime.strptime(time_str, TIME_FORMAT).timestamp())
+    except (TypeError, ValueError):
+        return 0
+
+def client_fields_to_dict(fields):
+    """The unifi_dhcpack_status.json layout of a get_client_fields() tuple"""
+    ip, name, host_name, reconnect_count_per_day, last_connected, notify = fields
+    return {"ip": int_to_ip(ip), "name": name, "host_name": host_name, "reconnect_count_per_day": reconnect_count_per_day,
+            "last_connected": format_time(last_connected), "notify": notify}
+
+def client_fields_to_json_line(mac_address, fields):
+    """'"mac": {...}' as json.dumps() would write client_fields_to_dict(), one line of unifi_dhcpack_status.json"""
+    ip, name, host_name, reconnect_count_per_day, last_connected, notify = fields
+    return (f'{encode_json_string(mac_address)}: {{"ip": {encode_json_value(int_to_ip(ip))}, "name": {encode_json_value(name)}, "host_name": {encode_json_value(host_name)}, '
+            f'"reconnect_count_per_day": {reconnect_count_per_day}, "last_connected": "{format_time(last_connected)}", "notify": {encode_json_value(notify)}}}')
+
+class OpensyslogClient:
+    """One entry of the client table, unifi_dhcpack_status.json holds the same fields as strings"""
+    __slots__ = CLIENT_FIELDS
+
+    def __init__(self, ip, name, host_name, reconnect_count_per_day, last_connected, notify):
+        self.ip = ip # int, or the original value if it was not IPv4, see ip_to_int()
+        self.name = name
+        self.host_name = host_name
+        self.reconnect_count_per_day = reconnect_count_per_day
+        self.last_connected = last_connected # epoch seconds
+        self.notify = notify
+
+    def to_dict(self):
+        return client_fields_to_dict(get_client_fields(self))
+
+    @classmethod
+    def from_dict(cls, client):
+        return cls(ip_to_int(client.get("ip")), intern_name(client.get("name")), intern_name(client.get("host_name", client.get("name"))),
+                   int(client.get("reconnect_count_per_day") or 0), parse_time(client.get("last_connected")), client.get("notify"))
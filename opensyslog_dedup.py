@@ -0,0 +1,35 @@
+"""Module to suppress duplicate syslog lines and events within a time window"""
+import collections
+import time
+
+class OpensyslogDedup:
+    """Bounded LRU of recently seen keys, a key seen again within window_seconds is a duplicate"""
+    def __init__(self, window_seconds, max_entries):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.seen = collections.OrderedDict() # key -> last seen (monotonic seconds), oldest first
+        self.duplicates_suppressed = 0
+        self.evictions = 0
+
+    def is_duplicate(self, key, now=None):
+        """Record key and return True if it was already seen within the window"""
+        if self.window_seconds <= 0:
+            return False # disabled
+        if now is None:
+            now = time.monotonic()
+        last_seen = self.seen.get(key)
+        if last_seen is not None and now - last_seen <= self.window_seconds:
+            self.duplicates_suppressed += 1
+            return True # keep the first sighting as the window start so a steady retransmit can't suppress forever
+        self.seen[key] = now
+        self.seen.move_to_end(key)
+        # drop expired keys from the old end, stops at the first live one
+        while self.seen:
+            oldest_key = next(iter(self.seen))
+            if now - self.seen[oldest_key] <= self.window_seconds:
+                break
+            del self.seen[oldest_key]
+        while len(self.seen) > self.max_entries:
+            self.seen.popitem(last=False)
+            self.evictions += 1
+        return False
@@ -1,12 +1,20 @@
 import datetime
 import os
+import time
 import json
-import csv
 import traceback
 import yaml
-import requests
 
 import const
+from opensyslog_archive import OpensyslogArchive
+from opensyslog_client import client_fields_to_dict, client_fields_to_json_line, int_to_mac
+from opensyslog_history import OpensyslogHistory
+from opensyslog_logsink import OpensyslogLogSink
+from opensyslog_lookup import OpensyslogLookup
+from opensyslog_metrics import OpensyslogMetrics
+from opensyslog_search import OpensyslogSearch
+from opensyslog_timeline import OpensyslogTimeline
+from opensyslog_sqlite import OpensyslogSqliteStore
 
 class OpensyslogHelper:
     log_level_debug = 1
@@ -14,124 +22,185 @@ class OpensyslogHelper:
     log_level_warning = 3
     log_level_error = 4
     log_level_critical = 5
-
-    def __init__(self, config_folder):
-        self.mac_to_name_lookup_dict = {}
+    log_level_names = {"debug": 1, "info": 2, "warning": 3, "error": 4, "critical": 5}
+    log_level_prefixes = {1: ":debug: ", 2: ":info: ", 3: ":warn: ", 4: ":error: ", 5: ":critical: "}
+
+    def __init__(self, config_folder, worker_index=None, defer_components=False):
+        # worker_index is set in SO_REUSEPORT worker processes, they only receive, log and parse
+        # defer_components: OpensyslogMonitor binds the syslog socket before it calls load_components()
+        self.telegram = None
+        self.lookup = None
+        self.notification_history = None
+        self.search = None
+        self.timeline = None
+        self.archive = None
         self.config_folder = config_folder
+        self.worker_index = worker_index
+        self.sqlite_store = None
+        self.metrics = OpensyslogMetrics()
         self.config = yaml.safe_load(open(self.config_folder + const.APP_CONFIG_FILE))
 
-        self.log_level = 2
-        if self.config["logs"]["level"] == "debug":
-            self.log_level = 1
-        elif self.config["logs"]["level"] == "info":
-            self.log_level = 2
-        elif self.config["logs"]["level"] == "warning":
-            self.log_level = 3
-        elif self.config["logs"]["level"] == "error":
-            self.log_level = 4
-        elif self.config["logs"]["level"] == "critical":
-            self.log_level = 5
+        # hot paths test debug_enabled before building a debug message, print() also checks log_level
+        self.shared_log_level = None # multiprocessing.Value set by OpensyslogWorkers so workers follow runtime changes
+        self.set_log_level(self.log_level_names.get(self.config["logs"]["level"], self.log_level_info))
+        self.timestamp_cache = (None, "") # (epoch second, HH:MM:SS), one tuple so threads never see a torn update
+        self.prepend_timestamp = self.config["logs"]["prepend_timestamp"] == True
+        self.append_new_line = self.config["logs"]["append_new_line"] == True
 
         self.log_folder = self.config_folder + "logs/"
         self.syslog_log = self.log_folder + self.config["logs"]["syslog_log"]
         self.monitor_log = self.log_folder + self.config["logs"]["monitor_log"]
         self.log_purge_after_days = self.config["logs"]["purge_after_days"]
-        
-        self.bot_token = self.config['telegram']['api_token']
-        self.bot_chat_id = self.config['telegram']['chat_id']
-        self.base_url = "https://api.telegram.org/bot" + self.bot_token
-        if self.log_level == 1:
-            self.notify_telegram("Unifi syslog got started!")
+        log_flush_size_bytes = self.config["logs"].get("flush_size_kb", const.LOG_FLUSH_SIZE_KB) * 1024
+        log_flush_interval_seconds = self.config["logs"].get("flush_interval_seconds", const.LOG_FLUSH_INTERVAL_SECONDS)
+        # all workers append to the same daily file, compression and purge run in the state owner (OpensyslogArchive)
+        self.syslog_log_sink = OpensyslogLogSink(self, self.syslog_log, log_flush_size_bytes, log_flush_interval_seconds)
+        self.monitor_log_sink = OpensyslogLogSink(self, self.monitor_log, log_flush_size_bytes, log_flush_interval_seconds)
 
         if not os.path.exists(self.log_folder):
-            os.makedirs(self.config_folder + "logs")
+            os.makedirs(self.log_folder, exist_ok=True)
             self.print(self.log_level_info, "OpensyslogHelper:__init__(): Creating folder: " + self.log_folder)
+        if worker_index is not None or defer_components:
+            return
+        self.load_components()
 
-        self.setup_lookup_csv_file()
+    def load_components(self):
+        """Load the lookup files, notification history, stores and indexes of the state owner"""
+        from opensyslog_telegram import OpensyslogTelegram # requests is slow to import, workers and the pre-bind startup skip it
+        self.telegram = OpensyslogTelegram(self)
+        if self.log_level == 1:
+            self.notify_telegram("Unifi syslog got started!")
+
+        self.notification_history = OpensyslogHistory(self)
+        self.load_state_components()
+        self.search = OpensyslogSearch(self)
+        self.archive = OpensyslogArchive(self, [self.syslog_log, self.monitor_log])
+
+    def load_state_components(self, write_behind=True):
+        """Lookup files, stores and timeline, all that applying events needs, --replay loads only these"""
+        self.lookup = OpensyslogLookup(self)
+        state_config = self.config.get("state") or {}
+        self.dhcp_event_retention_days = state_config.get("event_retention_days", const.STATE_EVENT_RETENTION_DAYS)
+        if state_config.get("backend", const.STATE_BACKEND_JSON) == const.STATE_BACKEND_SQLITE:
+            self.sqlite_store = OpensyslogSqliteStore(self)
+        self.timeline = OpensyslogTimeline(self, write_behind)
+
+    def close(self, deadline=None):
+        """Stop the background threads and write out the buffered logs, the client state is flushed by its owner first"""
+        # the logs go out before waiting on Telegram, which may be down
+        for log_sink in (self.syslog_log_sink, self.monitor_log_sink):
+            try:
+                log_sink.flush()
+            except Exception as e:
+                self.print(self.log_level_error, f"OpensyslogHelper:close(): {log_sink.file_prefix}: exception: {str(e)}")
+        for component in (self.archive, self.search, self.lookup, self.timeline, self.notification_history):
+            if component is not None:
+                component.close()
+        if self.telegram is not None:
+            # what the dispatcher could not send by the deadline is dropped
+            self.telegram.close(const.TELEGRAM_CLOSE_TIMEOUT_SECONDS if deadline is None else max(0, deadline - time.monotonic()))
+        self.syslog_log_sink.close()
+        self.monitor_log_sink.close()
+
+    def set_log_level(self, log_level):
+        """Change the log level at runtime, e.g. from the /log_level REST endpoint"""
+        self.log_level = log_level
+        self.debug_enabled = log_level <= self.log_level_debug
+        if self.shared_log_level is not None:
+            self.shared_log_level.value = log_level
+
+    def get_log_level_name(self):
+        for name, log_level in self.log_level_names.items():
+            if log_level == self.log_level:
+                return name
+        return str(self.log_level)
 
     def get_log_level_to_string(self, log_level):
-        log_level_str = ": "
-        if log_level == self.log_level_debug:
-            log_level_str = ":debug: "
-        elif log_level == self.log_level_info:
-            log_level_str = ":info: "
-        elif log_level == self.log_level_warning:
-            log_level_str = ":warn: "
-        elif log_level == self.log_level_error:
-            log_level_str = ":error: "
-        elif log_level == self.log_level_critical:
-            log_level_str = ":critical: "
-        return log_level_str
+        return self.log_level_prefixes.get(log_level, ": ")
+
+    def get_timestamp(self, now):
+        """HH:MM:SS for the epoch time now, strftime runs once per second"""
+        second = int(now)
+        cached_second, timestamp = self.timestamp_cache
+        if second != cached_second:
+            timestamp = time.strftime('%H:%M:%S', time.localtime(second))
+            self.timestamp_cache = (second, timestamp)
+        return timestamp
 
     def log_data(self, message_data):
-        self.print(self.log_level_debug, "OpensyslogHelper:ld(): enter")
+        if self.debug_enabled:
+            self.print(self.log_level_debug, "OpensyslogHelper:ld(): enter")
         try:
-            log_file_name = self.syslog_log + "-" + datetime.datetime.now().strftime('%Y-%m-%d') + ".log"
-            log_str = ""
-            if self.config["logs"]["prepend_timestamp"] == True:
-                log_str = datetime.datetime.now().strftime('%H:%M:%S') + "::: "
-            log_str = log_str + message_data
-            if self.config["logs"]["append_new_line"] == True:
-                log_str = log_str + "\n"
-
-            # just check exist or not and set flag, and once written and closed that file then call purge to avoid recursive loop
-            need_to_purge_files = not os.path.isfile(log_file_name)
-            with open(log_file_name, "a") as log_file:
-                log_file.write(log_str)
-                if need_to_purge_files:
-                    self.purge_older_files()
+            if isinstance(message_data, str):
+                message_data = message_data.encode('utf-8')
+            log_str = message_data
+            if self.prepend_timestamp:
+                log_str = (self.get_timestamp(time.time()) + "::: ").encode('utf-8') + log_str
+            if self.append_new_line:
+                log_str = log_str + b"\n"
+
+            # the sink rolls over to a new daily file at midnight, OpensyslogArchive compresses and purges the older ones
+            self.syslog_log_sink.write(log_str)
 
         except Exception as e:
             self.print(self.log_level_error, "ErxHelper:log_data():Exception:" + str(e))
-        self.print(self.log_level_debug, "OpensyslogHelper:ld(): exit")
+        if self.debug_enabled:
+            self.print(self.log_level_debug, "OpensyslogHelper:ld(): exit")
 
-    def print(self, log_level, str_print):
+    def print(self, log_level, str_print, *args):
+        """Log str_print, formatted with % args only when log_level is enabled"""
         if self.log_level > log_level:
             return
         try:
-            log_file_name = self.monitor_log + "-" + datetime.datetime.now().strftime('%Y-%m-%d') + ".log"
-            log_str = datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3] + \
-                      self.get_log_level_to_string(log_level) + str_print
+            if args:
+                str_print = str_print % args
+            now = time.time()
+            log_str = f"{self.get_timestamp(now)}.{int(now * 1000) % 1000:03d}{self.log_level_prefixes.get(log_level, ': ')}{str_print}"
 
             print(log_str)
-            with open(log_file_name, "a") as log_file:
-                log_file.write(log_str + "\n")
+            self.monitor_log_sink.write((log_str + "\n").encode('utf-8'))
         except Exception as e:
             print(datetime.datetime.now().strftime('%H:%M:%S.%f')[:-3] + " : OpensyslogHelper:print():Exception: " +
                   str(e))
 
-    def purge_older_files(self):
-        current_date = datetime.datetime.today()
-        self.print(self.log_level_debug, "About to call purge")
-        for root, directories, files in os.walk(self.log_folder, topdown=False):
-            for name in files:
-                file_date = os.stat(os.path.join(root, name))[8]
-                file_age = current_date - \
-                    datetime.datetime.fromtimestamp(file_date)
-                if file_age.days > self.log_purge_after_days:
-                    file_name_with_path = os.path.join(root, name)
-                    str_print = f"Purged file: {file_name_with_path}, age: {file_age.days}"
-                    self.print(self.log_level_info, str_print)
-                    os.remove(file_name_with_path)
-        self.print(self.log_level_debug, "Finished purging older files")
+    def purge_older_dhcp_events(self):
+        """Called by OpensyslogArchive once a day, log files are purged there"""
+        if self.sqlite_store is not None:
+            current_date = datetime.datetime.today()
+            older_than = (current_date - datetime.timedelta(days=self.dhcp_event_retention_days)).strftime("%Y-%m-%d %H:%M:%S")
+            self.print(self.log_level_info, f"Purged {self.sqlite_store.purge_events(older_than)} DHCP events before {older_than}")
 
     def load_dhcpack_status_json(self):
+        if self.sqlite_store is not None:
+            if self.sqlite_store.is_empty():
+                # first start on the sqlite backend, import the existing JSON file
+                dhcp_ack_json = self.load_json_file(self.config_folder + const.JSON_FILE_UNIFI_DHCPACK_FILE)
+                if len(dhcp_ack_json) > 0:
+                    self.sqlite_store.save_clients(dhcp_ack_json)
+                    self.print(self.log_level_info, f"Imported {len(dhcp_ack_json)} clients from {const.JSON_FILE_UNIFI_DHCPACK_FILE}")
+                return dhcp_ack_json
+            return self.sqlite_store.load_clients()
         return self.load_json_file(self.config_folder + const.JSON_FILE_UNIFI_DHCPACK_FILE)
 
-    def save_dhcpack_status_json(self, dhcp_ack_json):
-        self.save_json_file(self.config_folder + const.JSON_FILE_UNIFI_DHCPACK_FILE, dhcp_ack_json)
+    def save_dhcpack_status_json(self, clients):
+        """Persist [(mac int, get_client_fields() tuple)], OpensyslogState passes only the changed ones for the sqlite backend"""
+        if self.sqlite_store is not None:
+            return self.sqlite_store.save_clients({int_to_mac(mac): client_fields_to_dict(fields) for mac, fields in clients})
+        # the JSON file is always written whole, one client per line so it stays easy to edit by hand (notify)
+        json_str = ",\n    ".join(client_fields_to_json_line(int_to_mac(mac), fields) for mac, fields in clients)
+        return self.save_text_file(self.config_folder + const.JSON_FILE_UNIFI_DHCPACK_FILE, "{\n    " + json_str + "\n}\n")
 
-    def load_notification_history_json(self):
-        return self.load_json_file(self.config_folder + const.JSON_FILE_NOTIFICATION_HIST_FILE)
+    def save_dhcp_events(self, dhcp_events):
+        # only the sqlite backend keeps per event history
+        if self.sqlite_store is not None:
+            return self.sqlite_store.save_events(dhcp_events)
+        return True
 
-    def append_notification_history(self, notification_text):
-        history_json = self.load_json_file(self.config_folder + const.JSON_FILE_NOTIFICATION_HIST_FILE)
-        date_time_now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-        history_json[date_time_now] = notification_text
-        self.save_notification_history(history_json)
+    def load_notification_history(self, count):
+        return self.notification_history.recent(count)
 
-    def save_notification_history(self, notification_history_json):
-        self.save_json_file(self.config_folder + const.JSON_FILE_NOTIFICATION_HIST_FILE, notification_history_json)
+    def append_notification_history(self, notification_text):
+        self.notification_history.append(notification_text)
 
     def load_json_file(self, file_with_path):
         json_data = {}
@@ -145,47 +214,34 @@ class OpensyslogHelper:
         return json_data
 
     def save_json_file(self, file_with_path, json_data):
+        return self.save_text_file(file_with_path, json.dumps(json_data, indent=4))
+
+    def save_text_file(self, file_with_path, text):
+        # write to a temp file and rename it over the original so a crash never leaves a truncated file
+        temp_file_with_path = file_with_path + ".tmp"
         try:
-            with open(file_with_path, 'w') as file_handle_write:
-                file_handle_write.write(json.dumps(json_data, indent=4))
+            with open(temp_file_with_path, 'w') as file_handle_write:
+                file_handle_write.write(text)
+                file_handle_write.flush()
+                os.fsync(file_handle_write.fileno())
+            os.replace(temp_file_with_path, file_with_path)
+            return True
         except IOError as e:
-            exception_info = f"save_json_file: {file_with_path}: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            exception_info = f"save_text_file: {file_with_path}: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
             self.print(self.log_level_error, exception_info)
+        return False
 
     def notify_telegram(self, message_data):
         try:
-            # telegram API: https://core.telegram.org/bots/api#sendmessage
-            telegram_message_url = self.base_url + "/sendMessage"
             if message_data != "":
-                data = {"chat_id": self.bot_chat_id, 'text': message_data, 'parse_mode' : 'HTML'}
-                resp = requests.post(telegram_message_url, data=data, timeout=30)
-                if resp.status_code == 200:
-                    self.print(self.log_level_debug, "Sent message successfully")
-                else:
-                    err = f"sendMessage error: failed to send, status: {resp.status_code}, reason: {resp.reason}, text: {resp.text}"
-                    self.print(self.log_level_error, err)
+                self.telegram.send(message_data) # delivered by the dispatcher thread
         except Exception as e:
             exception_info = f"notify_telegram: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
             self.print(self.log_level_error, exception_info)
 
-    def setup_lookup_csv_file(self):
-        self.mac_to_name_lookup_dict = {}
-        try:
-            lookup_key = self.config.get("client_name_lookup", "")
-            if lookup_key is not None:
-                file_name = self.config["client_name_lookup"].get("csv_file_name", "").strip()
-                if file_name is not None and len(file_name) > 0:
-                    file_name_with_path = self.config_folder + file_name
-                    if os.path.exists(file_name_with_path):
-                        with open(file_name_with_path, "r") as csv_file:
-                            self.mac_to_name_lookup_col_for_mac = self.config["client_name_lookup"].get("column_for_mac", "").strip()
-                            self.mac_to_name_lookup_col_for_name = self.config["client_name_lookup"].get("column_for_name", "").strip()
-                            for row in csv.DictReader(csv_file):
-                                self.mac_to_name_lookup_dict[row[self.mac_to_name_lookup_col_for_mac].upper()] = row[self.mac_to_name_lookup_col_for_name]
-                            self.print(self.log_level_info, f"Successfully loaded CSV lookup file with {len(self.mac_to_name_lookup_dict)} rows")
-        except Exception as e:
-            exception_info = f"setup_lookup_csv_file: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
-            self.print(self.log_level_error, exception_info)
-
     def lookup_device_name_from_csv(self, mac_address):
-        return self.mac_to_name_lookup_dict.get(mac_address.upper(), None)
+        """mac_address must be normalized (upper case, colon separated) like the parser emits it"""
+        return self.lookup.get_name(mac_address)
+
+    def lookup_vendor_from_csv(self, mac_address):
+        return self.lookup.get_vendor(mac_address)
@@ -0,0 +1,160 @@
+"""Module to keep the notification history as an append-only JSON Lines file"""
+import collections
+import datetime
+import glob
+import json
+import os
+import threading
+import time
+import traceback
+
+import const
+
+class OpensyslogHistory:
+    """Append-only notification history with rotation, retention and an in-memory ring of recent entries"""
+    def __init__(self, opensysloghelper):
+        self.helper = opensysloghelper
+        history_config = self.helper.config.get("notification_history") or {}
+        self.rotate_size_bytes = history_config.get("rotate_size_mb", const.NOTIFICATION_HIST_ROTATE_SIZE_MB) * 1024 * 1024
+        self.rotate_after_days = history_config.get("rotate_after_days", const.NOTIFICATION_HIST_ROTATE_AFTER_DAYS)
+        self.retention_days = self.helper.log_purge_after_days
+        self.recent_entries = collections.deque(maxlen=history_config.get("recent_entries", const.NOTIFICATION_HIST_RECENT_ENTRIES))
+
+        self.file_with_path = self.helper.config_folder + const.JSONL_FILE_NOTIFICATION_HIST_FILE
+        self.file_base_name, self.file_extension = os.path.splitext(self.file_with_path)
+        self.lock = threading.Lock()
+        self.file_handle = None
+        self.file_started = time.time()
+        self.total_count = 0
+        self.version = 0 # bumped on every append, used by the web server to invalidate its caches
+
+        self.migrate_legacy_json()
+        self.load_existing()
+
+    def migrate_legacy_json(self):
+        """Convert notification_history.json written by older versions into the JSON Lines file once"""
+        legacy_file_with_path = self.helper.config_folder + const.JSON_FILE_NOTIFICATION_HIST_FILE
+        if not os.path.exists(legacy_file_with_path) or os.path.exists(self.file_with_path):
+            return
+        try:
+            legacy_json = self.helper.load_json_file(legacy_file_with_path)
+            with open(self.file_with_path, "w") as file_handle_write:
+                for date_time, notification_text in sorted(legacy_json.items()):
+                    file_handle_write.write(json.dumps({"datetime": date_time, "notification": notification_text}) + "\n")
+            os.replace(legacy_file_with_path, legacy_file_with_path + ".migrated")
+            self.helper.print(self.helper.log_level_info, f"OpensyslogHistory: migrated {len(legacy_json)} entries from {legacy_file_with_path}")
+        except Exception as e:
+            exception_info = f"OpensyslogHistory:migrate_legacy_json(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+
+    def load_existing(self):
+        """Fill the recent ring from the current file and count retained entries"""
+        try:
+            for file_with_path in self.get_rotated_files():
+                with open(file_with_path, "rb") as file_handle_read:
+                    self.total_count += sum(chunk.count(b"\n") for chunk in iter(lambda: file_handle_read.read(1024 * 1024), b""))
+            if os.path.exists(self.file_with_path):
+                current_count = 0
+                with open(self.file_with_path, "r") as file_handle_read:
+                    for entry in map(self.decode_line, file_handle_read):
+                        if entry is not None:
+                            if current_count == 0:
+                                self.file_started = self.get_entry_timestamp(entry, self.file_started)
+                            self.recent_entries.append(entry)
+                            current_count += 1
+                self.total_count += current_count
+        except Exception as e:
+            exception_info = f"OpensyslogHistory:load_existing(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+
+    def append(self, notification_text):
+        """Append one notification to the history"""
+        date_time_now = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        entry = (date_time_now, notification_text)
+        line = json.dumps({"datetime": date_time_now, "notification": notification_text}) + "\n"
+        with self.lock:
+            self.recent_entries.append(entry)
+            self.total_count += 1
+            self.version += 1
+            try:
+                if self.file_handle is None:
+                    self.file_handle = open(self.file_with_path, "a")
+                self.file_handle.write(line)
+                self.file_handle.flush()
+                if self.file_handle.tell() >= self.rotate_size_bytes or time.time() - self.file_started >= self.rotate_after_days * 86400:
+                    self.rotate()
+            except IOError as e:
+                exception_info = f"OpensyslogHistory:append(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+
+    def rotate(self):
+        """Move the current file aside and drop rotated files past retention, caller must hold self.lock"""
+        self.file_handle.close()
+        self.file_handle = None
+        rotated_file_with_path = self.file_base_name + "-" + datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + self.file_extension
+        os.replace(self.file_with_path, rotated_file_with_path)
+        self.file_started = time.time()
+        self.helper.print(self.helper.log_level_info, f"OpensyslogHistory: rotated notification history to {rotated_file_with_path}")
+
+        retention_cutoff = time.time() - self.retention_days * 86400
+        for file_with_path in self.get_rotated_files():
+            if os.stat(file_with_path).st_mtime < retention_cutoff:
+                with open(file_with_path, "rb") as file_handle_read:
+                    self.total_count -= sum(chunk.count(b"\n") for chunk in iter(lambda: file_handle_read.read(1024 * 1024), b""))
+                os.remove(file_with_path)
+                self.helper.print(self.helper.log_level_info, f"Purged file: {file_with_path}")
+
+    def get_rotated_files(self):
+        """Rotated history files, newest first"""
+        return sorted(glob.glob(glob.escape(self.file_base_name) + "-*" + self.file_extension), reverse=True)
+
+    def recent(self, count):
+        """Return up to count (datetime, notification) tuples, newest first"""
+        return list(self.iter_recent(count))
+
+    def iter_recent(self, count=None):
+        """Yield up to count (None: all) (datetime, notification) tuples newest first, served from the recent ring when it holds them"""
+        with self.lock:
+            entries = list(self.recent_entries)
+            all_in_ring = len(entries) == self.total_count
+        if all_in_ring or (count is not None and count <= len(entries)):
+            entries.reverse()
+            yield from entries[:count]
+            return
+        yield from self.read_files(count)
+
+    def read_files(self, count):
+        """Yield entries from the history files newest first, one file is read only once the caller got through the newer ones"""
+        remaining = count
+        for file_with_path in [self.file_with_path] + self.get_rotated_files():
+            try:
+                with open(file_with_path, "r") as file_handle_read:
+                    file_entries = [entry for entry in map(self.decode_line, file_handle_read) if entry is not None]
+            except FileNotFoundError:
+                continue # not written yet, or purged by a rotation since get_rotated_files()
+            file_entries.reverse()
+            if remaining is not None:
+                del file_entries[remaining:]
+                remaining -= len(file_entries)
+            yield from file_entries
+            if remaining == 0:
+                return
+
+    def decode_line(self, line):
+        try:
+            record = json.loads(line)
+            return (record["datetime"], record["notification"])
+        except (ValueError, KeyError):
+            return None
+
+    def get_entry_timestamp(self, entry, default):
+        try:
+            return datetime.datetime.strptime(entry[0], '%Y-%m-%d %H:%M:%S.%f').timestamp()
+        except ValueError:
+            return default
+
+    def close(self):
+        with self.lock:
+            if self.file_handle is not None:
+                self.file_handle.close()
+                self.file_handle = None
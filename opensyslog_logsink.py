@@ -0,0 +1,98 @@
+"""Module to write dated log files through a persistent, buffered file handle"""
+import atexit
+import datetime
+import threading
+import time
+import traceback
+
+import const
+
+class OpensyslogLogSink:
+    """Buffered writer for <prefix>-YYYY-MM-DD.log files which rotates at the date boundary"""
+    def __init__(self, opensysloghelper, file_prefix, flush_size_bytes, flush_interval_seconds):
+        self.helper = opensysloghelper
+        self.file_prefix = file_prefix
+        self.flush_size_bytes = flush_size_bytes
+        self.flush_interval_seconds = flush_interval_seconds
+
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.buffer_size = 0
+        self.max_buffer_size = const.LOG_BUFFER_MAX_SIZE_MB * 1024 * 1024
+        self.write_failed = False # the last write raised, only the flush thread retries until one succeeds
+        self.dropped_bytes = 0 # over max_buffer_size while writes kept failing
+        self.file_handle = None
+        self.file_name = None
+        self.next_rollover = 0.0 # epoch of the next local midnight, so the hot path only compares two floats
+
+        self.stop_event = threading.Event()
+        self.flush_thread_handle = threading.Thread(target=self.flush_thread, name="logsink-flush", daemon=True)
+        self.flush_thread_handle.start()
+        atexit.register(self.close)
+
+    def write(self, data):
+        """Queue bytes for the current day's file"""
+        with self.lock:
+            if time.time() >= self.next_rollover:
+                self.rollover()
+            if self.buffer_size >= self.max_buffer_size:
+                self.dropped_bytes += len(data)
+                return
+            self.buffer.append(data)
+            self.buffer_size += len(data)
+            if self.buffer_size >= self.flush_size_bytes and not self.write_failed:
+                self.flush_buffer()
+
+    def rollover(self):
+        """Flush into the old file and open the file for today, caller must hold self.lock"""
+        self.flush_buffer()
+        if self.file_handle is not None:
+            self.file_handle.close()
+        today = datetime.date.today()
+        self.next_rollover = datetime.datetime.combine(today + datetime.timedelta(days=1), datetime.time()).timestamp()
+        self.file_name = self.file_prefix + "-" + today.strftime('%Y-%m-%d') + ".log"
+        self.file_handle = open(self.file_name, "ab", buffering=0) # the buffering is done here, so a failed write is known exactly
+
+    def flush_buffer(self):
+        """Write out buffered data, caller must hold self.lock, whatever did not make it to the file stays buffered"""
+        if self.buffer_size == 0 or self.file_handle is None:
+            return
+        data = b"".join(self.buffer)
+        self.buffer = [data]
+        try:
+            while data:
+                written = self.file_handle.write(data) # raises (ENOSPC, EIO) when nothing was written
+                data = data[written:]
+                self.buffer = [data] if data else []
+                self.buffer_size = len(data)
+        except OSError:
+            self.write_failed = True
+            raise
+        self.write_failed = False
+
+    def flush(self):
+        with self.lock:
+            self.flush_buffer()
+            dropped_bytes = self.dropped_bytes
+            self.dropped_bytes = 0
+        if dropped_bytes:
+            # outside the lock, the monitor log is written through this very sink
+            self.helper.print(self.helper.log_level_error, f"OpensyslogLogSink: {self.file_prefix}: dropped {dropped_bytes} bytes while the file could not be written")
+
+    def flush_thread(self):
+        while not self.stop_event.wait(self.flush_interval_seconds):
+            try:
+                self.flush()
+            except Exception as e:
+                # a failing monitor log sink keeps this buffered, print() still shows it on the console
+                exception_info = f"OpensyslogLogSink:flush_thread(): {self.file_prefix}: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+
+    def close(self):
+        self.stop_event.set()
+        with self.lock:
+            self.flush_buffer()
+            if self.file_handle is not None:
+                self.file_handle.close()
+                self.file_handle = None
+            self.next_rollover = 0.0
@@ -0,0 +1,117 @@
+"""Module to keep the MAC lookup tables in memory and reload them when their CSV file changes"""
+import csv
+import os
+import threading
+import traceback
+
+import const
+
+HEX_DIGITS = frozenset("0123456789ABCDEF")
+
+def normalize_mac(text):
+    """AA:BB:CC:DD:EE:FF for aa-bb-cc-dd-ee-ff, aabb.ccdd.eeff or aabbccddeeff, anything else is only upper cased"""
+    text = text.strip().upper()
+    hex_digits = text.replace(":", "").replace("-", "").replace(".", "")
+    if len(hex_digits) != 12 or not HEX_DIGITS.issuperset(hex_digits):
+        return text
+    return ":".join(hex_digits[i:i + 2] for i in range(0, 12, 2))
+
+def normalize_oui(text):
+    """AA:BB:CC for an OUI (vendor prefix) like AABBCC, aa-bb-cc or a full MAC address"""
+    hex_digits = text.strip().upper().replace(":", "").replace("-", "").replace(".", "")[:6]
+    if len(hex_digits) != 6 or not HEX_DIGITS.issuperset(hex_digits):
+        return None
+    return ":".join(hex_digits[i:i + 2] for i in range(0, 6, 2))
+
+class OpensyslogLookupTable:
+    """One CSV key -> value table, built off the hot path and swapped in with a single assignment"""
+    def __init__(self, opensysloghelper, description, file_name_with_path, column_for_key, column_for_value, normalize_key):
+        self.helper = opensysloghelper
+        self.description = description
+        self.file_name_with_path = file_name_with_path
+        self.column_for_key = column_for_key
+        self.column_for_value = column_for_value
+        self.normalize_key = normalize_key
+        self.entries = {} # readers only ever see a complete dict
+        self.file_signature = None # (mtime_ns, size) of the loaded file
+
+    def check(self):
+        """Reload the table if the file's mtime or size changed, returns True if it was reloaded"""
+        try:
+            stat = os.stat(self.file_name_with_path)
+        except FileNotFoundError:
+            return False # keep the last table, the file may be in the middle of being replaced
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self.file_signature:
+            return False
+        # signature is taken before reading, so a write during the load gets picked up by the next check
+        entries = self.load_file()
+        self.entries = entries
+        self.file_signature = signature
+        self.helper.print(self.helper.log_level_info, f"Successfully loaded {self.description} file with {len(entries)} rows")
+        return True
+
+    def load_file(self):
+        entries = {}
+        with open(self.file_name_with_path, "r", newline="", errors="replace") as csv_file:
+            for row in csv.DictReader(csv_file):
+                key = self.normalize_key(row.get(self.column_for_key) or "")
+                if key:
+                    entries[key] = row.get(self.column_for_value)
+        return entries
+
+class OpensyslogLookup:
+    """Client name and vendor lookup tables, a background thread reloads them when their files change"""
+    def __init__(self, opensysloghelper):
+        self.helper = opensysloghelper
+        self.names = None
+        self.vendors = None
+
+        name_config = self.helper.config.get("client_name_lookup") or {}
+        file_name = (name_config.get("csv_file_name") or "").strip()
+        if len(file_name) > 0:
+            self.names = OpensyslogLookupTable(self.helper, "CSV lookup", self.helper.config_folder + file_name,
+                                               name_config.get("column_for_mac", "").strip(), name_config.get("column_for_name", "").strip(), normalize_mac)
+        vendor_config = self.helper.config.get("vendor_lookup") or {}
+        file_name = (vendor_config.get("csv_file_name") or "").strip()
+        if len(file_name) > 0:
+            self.vendors = OpensyslogLookupTable(self.helper, "vendor lookup", self.helper.config_folder + file_name,
+                                                 vendor_config.get("column_for_prefix", const.VENDOR_LOOKUP_COLUMN_FOR_PREFIX).strip(),
+                                                 vendor_config.get("column_for_vendor", const.VENDOR_LOOKUP_COLUMN_FOR_VENDOR).strip(), normalize_oui)
+        self.reload_interval_seconds = name_config.get("reload_interval_seconds", const.LOOKUP_RELOAD_INTERVAL_SECONDS)
+
+        # the name table is small and decides notifications, have it before the first packet
+        self.check_table(self.names)
+        self.stop_event = threading.Event()
+        if self.names is not None or self.vendors is not None:
+            threading.Thread(target=self.reload_thread, name="lookup-reload", daemon=True).start()
+
+    def get_name(self, mac_address):
+        """Client name for a normalized (upper case, colon separated) MAC address"""
+        if self.names is None:
+            return None
+        return self.names.entries.get(mac_address)
+
+    def get_vendor(self, mac_address):
+        if self.vendors is None:
+            return None
+        return self.vendors.entries.get(mac_address[:8])
+
+    def check_table(self, table):
+        if table is None:
+            return
+        try:
+            table.check()
+        except Exception as e:
+            exception_info = f"OpensyslogLookup:check_table(): {table.description}: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+
+    def reload_thread(self):
+        # the vendor table can have tens of thousands of rows, its first load happens here and not at startup
+        self.check_table(self.vendors)
+        while not self.stop_event.wait(self.reload_interval_seconds):
+            self.check_table(self.names)
+            self.check_table(self.vendors)
+
+    def close(self):
+        self.stop_event.set()
@@ -0,0 +1,143 @@
+"""Module providing low overhead counters and histograms exposed in the Prometheus text format"""
+import bisect
+import threading
+import time
+
+# latency buckets in seconds, from 100us up to the 30s Telegram timeout
+DEFAULT_BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels) + "}"
+
+class Counter:
+    """Counter incremented in place, or read from read_value() at scrape time so the hot path pays nothing"""
+    metric_type = "counter"
+
+    def __init__(self, name, help_text, label_name=None, read_value=None):
+        self.name = name
+        self.help_text = help_text
+        self.label_name = label_name
+        self.read_value = read_value # returns a number, or {label value: number} when label_name is set
+        self.value = 0
+        self.labelled_values = {}
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def inc_label(self, label_value, amount=1):
+        self.labelled_values[label_value] = self.labelled_values.get(label_value, 0) + amount
+
+    def get_samples(self):
+        """Return {label value or None: value}"""
+        if self.read_value is not None:
+            value = self.read_value()
+            return dict(value) if isinstance(value, dict) else {None: value}
+        if self.label_name is None:
+            return {None: self.value}
+        return dict(self.labelled_values)
+
+    def render(self, lines, worker_samples):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} {self.metric_type}")
+        self.render_samples(lines, self.get_samples(), ())
+        for worker_index, samples in worker_samples:
+            self.render_samples(lines, samples, (("worker", worker_index),))
+
+    def render_samples(self, lines, samples, labels):
+        for label_value, value in sorted(samples.items(), key=lambda item: str(item[0])):
+            sample_labels = labels if label_value is None else ((self.label_name, label_value),) + labels
+            lines.append(f"{self.name}{format_labels(sample_labels)} {value}")
+
+class Gauge(Counter):
+    """Current value read at scrape time"""
+    metric_type = "gauge"
+
+class Histogram:
+    """Fixed bucket histogram, observe() is one bisect and three adds"""
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1) # last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, lines, worker_samples):
+        lines.append(f"# HELP {self.name} {self.help_text}")
+        lines.append(f"# TYPE {self.name} histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative += bucket_count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+
+class OpensyslogMetrics:
+    """Registry of the metrics of this process, nothing gets formatted until /metrics is scraped"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {} # name -> metric, registering a name again replaces the old one
+        self.worker_samples = {} # worker index -> get_samples() of that SO_REUSEPORT worker
+        self.start_time = time.time()
+
+        # incremented on the processing path, everything else is read from the component counters at scrape time
+        self.decode_failures = self.counter("syslog_decode_failures_total", "Events with fields that are not valid UTF-8")
+        self.events_parsed = self.counter("syslog_events_parsed_total", "Events extracted from syslog lines", label_name="event_type")
+        self.notifications_sent = self.counter("notifications_sent_total", "Notifications handed to the Telegram dispatcher")
+        self.notifications_suppressed = self.counter("notifications_suppressed_total", "Notifications not sent", label_name="reason")
+        self.telegram_latency = self.histogram("telegram_request_seconds", "Telegram sendMessage request latency")
+        self.state_flush_duration = self.histogram("state_flush_seconds", "Time to write the client state to the backend")
+
+    def counter(self, name, help_text, label_name=None, read_value=None):
+        return self.register(Counter(name, help_text, label_name, read_value))
+
+    def gauge(self, name, help_text, read_value, label_name=None):
+        return self.register(Gauge(name, help_text, label_name, read_value))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def get_samples(self):
+        """Counter and gauge samples of this process, a worker sends these to the state owner"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {metric.name: (metric.metric_type, metric.label_name, metric.get_samples()) for metric in metrics if isinstance(metric, Counter)}
+
+    def update_worker(self, worker_index, samples):
+        self.worker_samples[worker_index] = samples
+
+    def render(self):
+        """Return all metrics in the Prometheus text exposition format"""
+        with self.lock:
+            metrics = list(self.metrics.values())
+        worker_samples = sorted(self.worker_samples.items())
+        lines = []
+        for metric in metrics:
+            metric.render(lines, [(worker_index, samples[metric.name][2]) for worker_index, samples in worker_samples if metric.name in samples])
+        # metrics only the workers have, e.g. the receiver counters when the state owner does not receive itself
+        local_names = {metric.name for metric in metrics}
+        worker_only = {}
+        for worker_index, samples in worker_samples:
+            for name, (metric_type, label_name, values) in samples.items():
+                if name not in local_names:
+                    worker_only.setdefault(name, (metric_type, label_name, []))[2].append((worker_index, values))
+        for name, (metric_type, label_name, values) in sorted(worker_only.items()):
+            metric_class = Gauge if metric_type == Gauge.metric_type else Counter
+            metric_class(name, "Reported by the syslog worker processes", label_name, read_value=dict).render(lines, values)
+        lines.append("# HELP process_start_time_seconds Start time of the process since unix epoch in seconds")
+        lines.append("# TYPE process_start_time_seconds gauge")
+        lines.append(f"process_start_time_seconds {self.start_time}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,55 @@
+"""Module to recognise and extract events from raw syslog datagrams"""
+import re
+import typing
+
+import const
+
+class SyslogEvent(typing.NamedTuple):
+    """Event extracted from one syslog line"""
+    event_type: str
+    mac_address: str # upper case, colon separated
+    ip_address: typing.Optional[str] = None
+    host_name: typing.Optional[str] = None
+    timestamp: typing.Optional[float] = None # epoch seconds the line was received, or logged when replaying
+
+# dnsmasq: "DHCPACK(br0) 192.168.1.10 aa:bb:cc:dd:ee:ff hostname", host name is optional
+DHCP_PATTERN = rb"DHCP(ACK|NAK|RELEASE)(?:\([^)]*\))?\s+(\d{1,3}(?:\.\d{1,3}){3})\s+([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})(?:\s+(\S+))?"
+# hostapd: "ra0: STA aa:bb:cc:dd:ee:ff IEEE 802.11: associated (aid 3)"
+WIFI_PATTERN = rb": STA ([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5}) IEEE 802\.11: (associated|disassociated)"
+
+def build_dhcp_event(match, timestamp):
+    event_type = "DHCP" + match.group(1).decode('ascii')
+    host_name = match.group(4)
+    if host_name is not None and event_type == const.EVENT_DHCPACK:
+        host_name = host_name.decode('utf-8', 'replace')
+    else:
+        host_name = None # DHCPNAK carries a reason text in that position
+    return SyslogEvent(event_type, match.group(3).upper().decode('ascii'), match.group(2).decode('ascii'), host_name, timestamp)
+
+def build_wifi_event(match, timestamp):
+    event_type = const.EVENT_WIFI_ASSOCIATED if match.group(2) == b"associated" else const.EVENT_WIFI_DISASSOCIATED
+    return SyslogEvent(event_type, match.group(1).upper().decode('ascii'), timestamp=timestamp)
+
+class OpensyslogParser:
+    """Cheap literal pre-filter on raw bytes followed by one precompiled extractor per event family"""
+    def __init__(self):
+        self.extractors = {} # anchor bytes -> list of (compiled pattern, build function)
+        self.register(b"DHCP", DHCP_PATTERN, build_dhcp_event)
+        self.register(b": STA ", WIFI_PATTERN, build_wifi_event)
+
+    def register(self, anchor, pattern, build_event):
+        """Add an extractor, pattern must match starting at the literal anchor, build_event(match, timestamp) returns the SyslogEvent"""
+        self.extractors.setdefault(anchor, []).append((re.compile(pattern), build_event))
+        self.anchors = tuple(self.extractors.items())
+
+    def parse(self, data, timestamp=None):
+        """Return a SyslogEvent for the first recognised event in data (bytes), otherwise None"""
+        for anchor, extractors in self.anchors:
+            position = data.find(anchor)
+            while position >= 0:
+                for pattern, build_event in extractors:
+                    match = pattern.match(data, position)
+                    if match is not None:
+                        return build_event(match, timestamp)
+                position = data.find(anchor, position + 1)
+        return None
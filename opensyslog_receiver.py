@@ -0,0 +1,137 @@
+"""Module to receive syslog datagrams on a dedicated thread"""
+import queue
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+
+import const
+
+# Linux only: ancillary data with the number of datagrams the kernel dropped on this socket
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40 if sys.platform.startswith("linux") else None)
+
+class OpensyslogReceiver:
+    """Drains the syslog UDP socket in batches into a bounded queue so processing never blocks the socket"""
+    def __init__(self, opensysloghelper, reuse_port=False):
+        self.helper = opensysloghelper
+        self.reuse_port = reuse_port
+        syslog_config = self.helper.config.get("syslog") or {}
+        self.receive_buffer_bytes = syslog_config.get("receive_buffer_kb", const.SYSLOG_SOCKET_RCVBUF_KB) * 1024
+        self.datagram_size = syslog_config.get("datagram_size", const.SYSLOG_SOCKET_RECEIVE_BUFFER)
+        self.batch_size = syslog_config.get("batch_size", const.SYSLOG_BATCH_SIZE)
+        self.queue = queue.Queue(maxsize=syslog_config.get("queue_size", const.SYSLOG_QUEUE_SIZE))
+        self.stats_interval_seconds = syslog_config.get("stats_interval_seconds", const.SYSLOG_STATS_INTERVAL_SECONDS)
+
+        self.sock = None
+        self.ancillary_size = socket.CMSG_SPACE(4) if SO_RXQ_OVFL is not None else 0
+        self.stop_event = threading.Event()
+        self.receive_thread_handle = None
+
+        self.datagrams_received = 0
+        self.bytes_received = 0
+        self.datagrams_dropped = 0 # queue was full, processing is behind
+        self.datagrams_truncated = 0 # datagram larger than datagram_size
+        self.kernel_drops = 0 # socket buffer overruns reported by the kernel
+        self.queue_high_water = 0
+
+        metrics = self.helper.metrics
+        metrics.counter("syslog_datagrams_received_total", "Syslog datagrams received", read_value=lambda: self.datagrams_received)
+        metrics.counter("syslog_bytes_received_total", "Syslog bytes received", read_value=lambda: self.bytes_received)
+        metrics.counter("syslog_datagrams_dropped_total", "Datagrams dropped because the processing queue was full", read_value=lambda: self.datagrams_dropped)
+        metrics.counter("syslog_datagrams_truncated_total", "Datagrams longer than datagram_size", read_value=lambda: self.datagrams_truncated)
+        metrics.counter("syslog_kernel_drops_total", "Datagrams dropped by the kernel because the socket buffer was full", read_value=lambda: self.kernel_drops)
+        metrics.gauge("syslog_queue_depth", "Receive batches waiting to be processed", self.queue.qsize)
+        metrics.gauge("syslog_queue_high_water", "Highest receive queue depth seen", lambda: self.queue_high_water)
+
+    def bind(self):
+        """Create and bind the UDP socket"""
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer_bytes)
+        if SO_RXQ_OVFL is not None:
+            try:
+                self.sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            except OSError:
+                pass
+        self.sock.bind((const.SYSLOG_SERVER_IP, const.SYSLOG_SERVER_PORT))
+        self.sock.setblocking(False)
+        effective_buffer_bytes = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        msg_str = f"OpensyslogReceiver: bound {const.SYSLOG_SERVER_IP}:{const.SYSLOG_SERVER_PORT}, SO_RCVBUF requested: {self.receive_buffer_bytes}, effective: {effective_buffer_bytes}, datagram_size: {self.datagram_size}, batch_size: {self.batch_size}"
+        self.helper.print(self.helper.log_level_info, msg_str)
+
+    def start(self):
+        if self.sock is None:
+            self.bind()
+        self.receive_thread_handle = threading.Thread(target=self.receive_thread, name="syslog-receiver", daemon=True)
+        self.receive_thread_handle.start()
+
+    def receive_thread(self):
+        poller = select.poll()
+        poller.register(self.sock.fileno(), select.POLLIN)
+        next_stats_time = time.time() + self.stats_interval_seconds
+        reported = (0, 0, 0)
+        while not self.stop_event.is_set():
+            try:
+                if not poller.poll(1000):
+                    continue
+                batch = self.read_batch()
+                if not batch:
+                    continue
+                self.queue_batch(batch)
+
+                if time.time() >= next_stats_time:
+                    next_stats_time = time.time() + self.stats_interval_seconds
+                    current = (self.datagrams_dropped, self.datagrams_truncated, self.kernel_drops)
+                    if current != reported:
+                        reported = current
+                        self.helper.print(self.helper.log_level_warning, "OpensyslogReceiver: " + self.get_stats_string())
+            except Exception as e:
+                exception_info = f"OpensyslogReceiver:receive_thread(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+
+    def read_batch(self):
+        """Up to batch_size datagrams, without blocking"""
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                data, ancillary_data, flags, address = self.sock.recvmsg(self.datagram_size, self.ancillary_size)
+            except BlockingIOError:
+                break
+            batch.append(data)
+            self.bytes_received += len(data)
+            if flags & socket.MSG_TRUNC:
+                self.datagrams_truncated += 1
+            for cmsg_level, cmsg_type, cmsg_data in ancillary_data:
+                if cmsg_level == socket.SOL_SOCKET and cmsg_type == SO_RXQ_OVFL and len(cmsg_data) >= 4:
+                    self.kernel_drops = struct.unpack("I", cmsg_data[:4])[0]
+        return batch
+
+    def queue_batch(self, batch):
+        self.datagrams_received += len(batch)
+        try:
+            self.queue.put_nowait(batch)
+        except queue.Full:
+            self.datagrams_dropped += len(batch)
+        queue_depth = self.queue.qsize()
+        if queue_depth > self.queue_high_water:
+            self.queue_high_water = queue_depth
+
+    def get_stats_string(self):
+        return f"received: {self.datagrams_received}, bytes: {self.bytes_received}, dropped(queue full): {self.datagrams_dropped}, truncated: {self.datagrams_truncated}, kernel drops: {self.kernel_drops}, queue depth: {self.queue.qsize()}, queue high water: {self.queue_high_water}"
+
+    def stop(self):
+        self.stop_event.set()
+        if self.receive_thread_handle is not None:
+            self.receive_thread_handle.join(timeout=2)
+        if self.sock is not None:
+            # what the kernel still buffers would be lost with the socket
+            batch = self.read_batch()
+            while batch:
+                self.queue_batch(batch)
+                batch = self.read_batch()
+            self.sock.close()
+            self.sock = None
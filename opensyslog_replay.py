@@ -0,0 +1,149 @@
+"""Module to rebuild the client table and event history by replaying the archived syslog files"""
+import collections
+import datetime
+import gzip
+import io
+import multiprocessing
+import os
+import time
+import traceback
+
+import const
+from opensyslog_client import mac_to_int
+from opensyslog_parser import OpensyslogParser, SyslogEvent
+from opensyslog_search import DAILY_FILE_PATTERN, get_line_time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+def read_log_lines(file_name_with_path):
+    """Yield the lines of a daily syslog file one at a time, plain, .gz or .zst"""
+    if file_name_with_path.endswith(".gz"):
+        file_handle = gzip.open(file_name_with_path, "rb") # reads every member of a block compressed file
+    elif file_name_with_path.endswith(".zst"):
+        file_handle = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(file_name_with_path, "rb"), read_across_frames=True), const.REPLAY_READ_BUFFER_SIZE)
+    else:
+        file_handle = open(file_name_with_path, "rb", buffering=const.REPLAY_READ_BUFFER_SIZE)
+    with file_handle:
+        yield from file_handle
+
+def read_events(file_name_with_path, file_date, parser, line_count):
+    """Yield the events of one file in line order, stamped with the time of their line"""
+    # a line without a recognised time gets the one before it, so the event times never depend on when the replay runs
+    line_time = datetime.datetime.combine(file_date, datetime.time()).timestamp()
+    for line in read_log_lines(file_name_with_path):
+        line_count[0] += 1
+        parsed_time = get_line_time(line, file_date)
+        if parsed_time is not None:
+            line_time = parsed_time
+        event = parser.parse(line, line_time)
+        if event is not None:
+            yield event
+
+def parse_file(file_name_with_path, file_date):
+    """Runs in a replay worker process: (line count, events as plain tuples) of one file"""
+    line_count = [0]
+    events = [tuple(event) for event in read_events(file_name_with_path, file_date, OpensyslogParser(), line_count)]
+    return line_count[0], events
+
+class OpensyslogReplay:
+    """Streams the archived syslog files through OpensyslogSyslog with notifications off, files are parsed in parallel and applied in order"""
+    def __init__(self, opensysloghelper, opensyslogsyslog):
+        self.helper = opensysloghelper
+        self.syslog = opensyslogsyslog
+        self.file_prefix = os.path.basename(self.helper.syslog_log)
+        self.line_count = 0
+        self.event_count = 0
+
+    def find_files(self, from_date=None, to_date=None):
+        """(date, file name with path) of the daily syslog files in the log folder, oldest first"""
+        files = {}
+        with os.scandir(self.helper.log_folder) as directory_entries:
+            for directory_entry in directory_entries:
+                match = DAILY_FILE_PATTERN.search(directory_entry.name)
+                if match is None or directory_entry.name[:match.start()] != self.file_prefix:
+                    continue
+                file_date = datetime.date.fromisoformat(match.group(1))
+                if (from_date is not None and file_date < from_date) or (to_date is not None and file_date > to_date):
+                    continue
+                if file_date not in files or match.group(2) is None:
+                    files[file_date] = directory_entry.path # the plain file wins over a leftover compressed copy of the same day
+        return sorted(files.items())
+
+    def parse_files(self, files, jobs):
+        """Yield (file name with path, line count, events) in file order, up to 2 * jobs files are parsed ahead"""
+        if jobs <= 1:
+            for file_date, file_name_with_path in files:
+                yield (file_name_with_path, *parse_file(file_name_with_path, file_date))
+            return
+        # spawn, not fork: the helper already runs background threads
+        with multiprocessing.get_context("spawn").Pool(jobs) as pool:
+            pending = collections.deque()
+            for file_date, file_name_with_path in files:
+                pending.append((file_name_with_path, pool.apply_async(parse_file, (file_name_with_path, file_date))))
+                if len(pending) >= jobs * 2:
+                    file_name_with_path, result = pending.popleft()
+                    yield (file_name_with_path, *result.get())
+            while pending:
+                file_name_with_path, result = pending.popleft()
+                yield (file_name_with_path, *result.get())
+
+    def run(self, jobs, from_date=None, to_date=None, reset=False):
+        """Apply the archived events, the client table, timeline and event history are written only if every file was read"""
+        files = self.find_files(from_date, to_date)
+        if not files:
+            self.helper.print(self.helper.log_level_warning, f"OpensyslogReplay: no {self.file_prefix}-YYYY-MM-DD.log files in {self.helper.log_folder}")
+            return False
+        start = time.time()
+        state = self.syslog.dhcpack_state
+        kept_settings = {}
+        if reset:
+            with state.lock:
+                # hand edited per client settings survive the reset: muted devices stay muted
+                kept_settings = {mac_address: (client.notify, client.name) for mac_address, client in state.clients.items()}
+                self.syslog.dhcp_ack_json.clear()
+                state.mark_dirty()
+            self.helper.timeline.clear()
+        # without --reset the table already holds what the server saw live, a client only gets the events after its last_connected
+        applied_until = {mac_address: client.last_connected for mac_address, client in state.clients.items()}
+        skipped_count = 0
+        msg_str = f"OpensyslogReplay: replaying {len(files)} files from {files[0][0]} to {files[-1][0]}, jobs: {jobs}, reset: {reset}"
+        self.helper.print(self.helper.log_level_info, msg_str)
+
+        try:
+            for file_index, (file_name_with_path, line_count, events) in enumerate(self.parse_files(files, jobs), 1):
+                for event in events:
+                    event = SyslogEvent(*event)
+                    if applied_until and event.timestamp <= applied_until.get(mac_to_int(event.mac_address), -1):
+                        skipped_count += 1
+                        continue
+                    self.syslog.handle_event(event)
+                self.line_count += line_count
+                self.event_count += len(events)
+                msg_str = f"OpensyslogReplay: ({file_index}/{len(files)}) {file_name_with_path}, lines: {line_count}, events: {len(events)}"
+                self.helper.print(self.helper.log_level_info, msg_str)
+        except Exception as e:
+            exception_info = f"OpensyslogReplay: failed, nothing was written: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+            return False
+
+        with state.lock:
+            for mac_address, client in state.clients.items():
+                settings = kept_settings.get(mac_address)
+                if settings is not None:
+                    client.notify, client.name = settings
+        if reset and self.helper.sqlite_store is not None:
+            # the replayed days get their events again, keep them once
+            self.helper.sqlite_store.delete_clients()
+            deleted_count = self.helper.sqlite_store.delete_events(f"{files[0][0]} 00:00:00", f"{files[-1][0] + datetime.timedelta(days=1)} 00:00:00")
+            self.helper.print(self.helper.log_level_info, f"OpensyslogReplay: removed {deleted_count} events of the replayed days")
+        state.flush()
+        if state.flushed_version != state.version:
+            self.helper.print(self.helper.log_level_error, "OpensyslogReplay: the client table could not be written")
+            return False
+        self.helper.timeline.save()
+        msg_str = f"OpensyslogReplay: done in {time.time() - start:.1f}s, lines: {self.line_count}, events: {self.event_count}, skipped as already applied: {skipped_count}, clients: {len(self.syslog.dhcp_ack_json)}"
+        self.helper.print(self.helper.log_level_info, msg_str)
+        return True
@@ -0,0 +1,345 @@
+"""Module to index the daily syslog files and search them by MAC, IP, host name, time range or text"""
+import datetime
+import functools
+import gzip
+import json
+import os
+import re
+import threading
+import traceback
+import zlib
+
+import const
+from opensyslog_lookup import normalize_mac
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# MAC addresses, IPv4 addresses and DHCPACK host names are the index keys
+KEY_PATTERN = re.compile(rb"(?<![0-9A-Fa-f:])([0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})(?![0-9A-Fa-f:])"
+                         rb"|(?<![\d.])(\d{1,3}(?:\.\d{1,3}){3})(?![\d.])")
+HOST_PATTERN = re.compile(rb"DHCPACK(?:\([^)]*\))?\s+\S+\s+\S+\s+(\S+)") # separate, it would swallow the IP and MAC of the line
+# "<30>Oct 18 10:00:00 ..." as sent by Unifi, or "10:00:00::: ..." with logs: prepend_timestamp
+SYSLOG_TIME_PATTERN = re.compile(rb"(?:<\d{1,3}>)?([A-Z][a-z]{2}) +(\d{1,2}) (\d{2}):(\d{2}):(\d{2}) ")
+PREPENDED_TIME_PATTERN = re.compile(rb"(\d{2}):(\d{2}):(\d{2})::: ")
+MONTHS = {name.encode(): number for number, name in enumerate(["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"], 1)}
+DAILY_FILE_PATTERN = re.compile(r"-(\d{4}-\d{2}-\d{2})\.log(\.gz|\.zst)?$")
+
+def get_host_key(host_name):
+    return "host:" + host_name.lower()
+
+def get_line_time(line, file_date):
+    """Epoch seconds of a syslog line, None when the line has no recognised timestamp"""
+    try:
+        match = SYSLOG_TIME_PATTERN.match(line)
+        if match is not None:
+            month = MONTHS.get(match.group(1))
+            if month is None:
+                return None
+            year = file_date.year - 1 if month == 12 and file_date.month == 1 else file_date.year # Dec 31 lines in the Jan 1 file
+            return datetime.datetime(year, month, int(match.group(2)), int(match.group(3)), int(match.group(4)), int(match.group(5))).timestamp()
+        match = PREPENDED_TIME_PATTERN.match(line)
+        if match is not None:
+            return datetime.datetime(file_date.year, file_date.month, file_date.day, int(match.group(1)), int(match.group(2)), int(match.group(3))).timestamp()
+    except ValueError:
+        pass
+    return None
+
+def read_block(file_handle, block, compression):
+    """Uncompressed bytes of one index block, compressed files hold one gzip member or zstd frame per block"""
+    start, end, first_time, compressed_start, compressed_end = block
+    if compression is None:
+        file_handle.seek(start)
+        return file_handle.read(end - start)
+    file_handle.seek(compressed_start)
+    data = file_handle.read(compressed_end - compressed_start)
+    if compression == ".zst":
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data, wbits=31)
+
+class OpensyslogFileIndex:
+    """Sparse index of one daily file: blocks of whole lines and, per key, the blocks it appears in"""
+    def __init__(self, file_name_with_path, file_date):
+        self.file_name_with_path = file_name_with_path
+        self.file_date = file_date
+        self.compression = None # None, ".gz" or ".zst"
+        self.blocks = [] # [start, end, first line time, compressed start, compressed end]
+        self.keys = {} # key -> ascending block numbers
+        self.indexed_size = 0 # uncompressed bytes covered by blocks
+        self.seekable = True # False for compressed files without an index, those get scanned
+
+    def index_new_data(self, file_handle, block_size):
+        """Index complete lines appended since the last call"""
+        file_handle.seek(self.indexed_size)
+        pending = b""
+        while True:
+            data = file_handle.read(block_size)
+            if not data:
+                break
+            data = pending + data
+            end = data.rfind(b"\n") + 1
+            if end == 0:
+                pending = data
+                continue
+            self.add_lines(data[:end], block_size)
+            pending = data[end:]
+
+    def add_lines(self, data, block_size):
+        start = self.indexed_size
+        if self.blocks and self.blocks[-1][1] - self.blocks[-1][0] + len(data) <= block_size:
+            # the live file grows a few KB at a time, keep filling the last block instead of making tiny ones
+            block_number = len(self.blocks) - 1
+            self.blocks[-1][1] = start + len(data)
+        else:
+            block_number = len(self.blocks)
+            self.blocks.append([start, start + len(data), get_line_time(data, self.file_date), None, None])
+        for match in KEY_PATTERN.finditer(data):
+            mac_address, ip_address = match.groups()
+            self.add_key(mac_address.decode('ascii').upper() if mac_address is not None else ip_address.decode('ascii'), block_number)
+        for match in HOST_PATTERN.finditer(data):
+            self.add_key(get_host_key(match.group(1).decode('utf-8', 'replace')), block_number)
+        self.indexed_size = start + len(data)
+
+    def add_key(self, key, block_number):
+        block_numbers = self.keys.get(key)
+        if block_numbers is None:
+            self.keys[key] = [block_number]
+        elif block_numbers[-1] != block_number:
+            block_numbers.append(block_number)
+
+    def to_json(self):
+        return {"version": 1, "indexed_size": self.indexed_size, "blocks": self.blocks, "keys": self.keys}
+
+    @classmethod
+    def from_json(cls, file_name_with_path, file_date, compression, data):
+        file_index = cls(file_name_with_path, file_date)
+        file_index.compression = compression
+        file_index.indexed_size = data["indexed_size"]
+        file_index.blocks = data["blocks"]
+        file_index.keys = data["keys"]
+        return file_index
+
+@functools.lru_cache(maxsize=const.SEARCH_CACHED_INDEX_FILES)
+def load_index_file(file_name_with_path, file_date, compression, index_mtime):
+    """Index of a compressed file from its sidecar, index_mtime is only part of the cache key"""
+    with open(file_name_with_path + const.SEARCH_INDEX_EXTENSION, "r") as file_handle:
+        return OpensyslogFileIndex.from_json(file_name_with_path, file_date, compression, json.load(file_handle))
+
+class OpensyslogSearch:
+    """Keeps the daily syslog files indexed from a background thread and answers /search queries"""
+    def __init__(self, opensysloghelper):
+        self.helper = opensysloghelper
+        search_config = self.helper.config.get("search") or {}
+        self.block_size = search_config.get("block_size_kb", const.SEARCH_INDEX_BLOCK_SIZE_KB) * 1024
+        self.index_interval_seconds = search_config.get("index_interval_seconds", const.SEARCH_INDEX_INTERVAL_SECONDS)
+        self.max_scan_bytes = search_config.get("max_scan_mb", const.SEARCH_MAX_SCAN_MB) * 1024 * 1024
+        self.file_prefix = os.path.basename(self.helper.syslog_log)
+
+        self.lock = threading.Lock()
+        self.index_lock = threading.Lock() # serializes index_file() between the index and archive threads
+        self.files = {} # datetime.date -> OpensyslogFileIndex (uncompressed files) or file name with path (compressed)
+        self.stop_event = threading.Event()
+        self.index_thread_handle = threading.Thread(target=self.index_thread, name="search-index", daemon=True)
+        self.index_thread_handle.start()
+
+    def index_thread(self):
+        try:
+            self.scan_folder()
+        except Exception as e:
+            exception_info = f"OpensyslogSearch:scan_folder(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+        while True:
+            try:
+                today = datetime.date.today()
+                self.index_file(self.helper.syslog_log + "-" + today.strftime('%Y-%m-%d') + ".log", today)
+            except Exception as e:
+                exception_info = f"OpensyslogSearch:index_thread(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+            if self.stop_event.wait(self.index_interval_seconds):
+                break
+
+    def scan_folder(self):
+        """Register the files already in the log folder, once at startup"""
+        found = []
+        with os.scandir(self.helper.log_folder) as directory_entries:
+            for directory_entry in directory_entries:
+                match = DAILY_FILE_PATTERN.search(directory_entry.name)
+                if match is not None and directory_entry.name.startswith(self.file_prefix + "-") and len(directory_entry.name) == len(self.file_prefix) + len(match.group(0)):
+                    found.append((datetime.date.fromisoformat(match.group(1)), directory_entry.path, match.group(2)))
+        for file_date, file_name_with_path, compression in sorted(found, reverse=True):
+            if compression is None:
+                self.index_file(file_name_with_path, file_date)
+            else:
+                with self.lock:
+                    self.files.setdefault(file_date, file_name_with_path)
+        self.helper.print(self.helper.log_level_debug, "OpensyslogSearch: registered %s files", len(found))
+
+    def index_file(self, file_name_with_path, file_date):
+        """Bring the index of an uncompressed daily file up to date, returns it (None if the file does not exist)"""
+        with self.index_lock:
+            with self.lock:
+                file_index = self.files.get(file_date)
+            if not isinstance(file_index, OpensyslogFileIndex) or file_index.file_name_with_path != file_name_with_path:
+                file_index = OpensyslogFileIndex(file_name_with_path, file_date)
+            try:
+                with open(file_name_with_path, "rb") as file_handle:
+                    file_index.index_new_data(file_handle, self.block_size)
+            except FileNotFoundError:
+                return None
+            with self.lock:
+                self.files[file_date] = file_index
+            return file_index
+
+    def get_block_boundaries(self, file_name_with_path):
+        """Block end offsets for OpensyslogArchive, None if this is not an indexed syslog file"""
+        match = DAILY_FILE_PATTERN.search(file_name_with_path)
+        if match is None or not os.path.basename(file_name_with_path).startswith(self.file_prefix + "-") or match.group(2) is not None:
+            return None
+        file_index = self.index_file(file_name_with_path, datetime.date.fromisoformat(match.group(1)))
+        if file_index is None:
+            return None
+        return [block[1] for block in file_index.blocks]
+
+    def set_compressed(self, file_name_with_path, compressed_file_name_with_path, compressed_offsets):
+        """OpensyslogArchive compressed an indexed file block by block, compressed_offsets[i] is where block i ends"""
+        file_date = datetime.date.fromisoformat(DAILY_FILE_PATTERN.search(file_name_with_path).group(1))
+        with self.lock:
+            file_index = self.files.get(file_date)
+        if not isinstance(file_index, OpensyslogFileIndex):
+            return
+        compressed_start = 0
+        for block, compressed_end in zip(file_index.blocks, compressed_offsets):
+            block[3] = compressed_start
+            block[4] = compressed_end
+            compressed_start = compressed_end
+        index_file_name = compressed_file_name_with_path + const.SEARCH_INDEX_EXTENSION
+        # without the index the compressed file is still searched, by decompressing all of it
+        self.helper.save_text_file(index_file_name, json.dumps(file_index.to_json(), separators=(",", ":")))
+        with self.lock:
+            self.files[file_date] = compressed_file_name_with_path
+
+    def get_file_index(self, file_date):
+        with self.lock:
+            file_index = self.files.get(file_date)
+        if isinstance(file_index, OpensyslogFileIndex) or file_index is None:
+            return file_index
+        compression = os.path.splitext(file_index)[1]
+        try:
+            index_mtime = os.stat(file_index + const.SEARCH_INDEX_EXTENSION).st_mtime
+        except FileNotFoundError:
+            # compressed before indexing existed, searched by decompressing the whole file
+            file_index = OpensyslogFileIndex(file_index, file_date)
+            file_index.compression = compression
+            file_index.seekable = False
+            return file_index
+        return load_index_file(file_index, file_date, compression, index_mtime)
+
+    def search(self, mac_address=None, ip_address=None, host_name=None, text=None, start_time=None, end_time=None, limit=100):
+        """Matching lines newest first as (file date, line time or None, line), and whether the scan limit cut it short"""
+        line_filters = []
+        keys = []
+        if mac_address:
+            mac_address = normalize_mac(mac_address) # the log lines and index keys are AA:BB:CC:DD:EE:FF
+            keys.append(mac_address)
+            line_filters.append(re.compile(re.escape(mac_address.encode()), re.IGNORECASE).search)
+        if ip_address:
+            ip_address = ip_address.strip()
+            keys.append(ip_address)
+            line_filters.append(re.compile(rb"(?<![\d.])" + re.escape(ip_address.encode()) + rb"(?![\d.])").search)
+        if host_name:
+            host_name = host_name.strip()
+            keys.append(get_host_key(host_name))
+            line_filters.append(re.compile(re.escape(host_name.encode()), re.IGNORECASE).search)
+        if text:
+            line_filters.append(re.compile(re.escape(text.encode()), re.IGNORECASE).search)
+
+        with self.lock:
+            file_dates = sorted(self.files, reverse=True)
+        results = []
+        scan_budget = [self.max_scan_bytes] # bytes left to read, shared by all files of this search
+        for file_date in file_dates:
+            if (start_time is not None and file_date < datetime.date.fromtimestamp(start_time)) or \
+               (end_time is not None and file_date > datetime.date.fromtimestamp(end_time)):
+                continue
+            file_index = self.get_file_index(file_date)
+            if file_index is None:
+                continue
+            try:
+                for line_time, line in self.search_file(file_index, keys, line_filters, start_time, end_time, scan_budget):
+                    results.append((file_date, line_time, line))
+                    if len(results) >= limit:
+                        return results, False
+            except FileNotFoundError:
+                with self.lock:
+                    # purged by OpensyslogArchive, unless it was just compressed and the entry already points at the new file
+                    entry = self.files.get(file_date)
+                    if entry is file_index or entry == file_index.file_name_with_path:
+                        del self.files[file_date]
+                continue
+            if scan_budget[0] <= 0:
+                return results, True
+        return results, False
+
+    def search_file(self, file_index, keys, line_filters, start_time, end_time, scan_budget):
+        """Yield (line time, line) of matching lines of one file, newest first"""
+        with open(file_index.file_name_with_path, "rb") as file_handle:
+            if not file_index.seekable:
+                yield from self.scan_unindexed_file(file_index, file_handle, line_filters, start_time, end_time, scan_budget)
+                return
+            blocks = file_index.blocks
+            if keys:
+                block_numbers = None
+                for key in keys:
+                    key_blocks = set(file_index.keys.get(key, ()))
+                    block_numbers = key_blocks if block_numbers is None else block_numbers & key_blocks
+                block_numbers = sorted(block_numbers, reverse=True)
+            else:
+                block_numbers = range(len(blocks) - 1, -1, -1)
+            for block_number in block_numbers:
+                block_start_time = blocks[block_number][2]
+                next_block_time = blocks[block_number + 1][2] if block_number + 1 < len(blocks) else None
+                if end_time is not None and block_start_time is not None and block_start_time > end_time:
+                    continue
+                if start_time is not None and next_block_time is not None and next_block_time < start_time:
+                    continue
+                if scan_budget[0] <= 0:
+                    return
+                data = read_block(file_handle, blocks[block_number], file_index.compression)
+                scan_budget[0] -= len(data)
+                yield from self.filter_lines(data.split(b"\n")[::-1], file_index.file_date, line_filters, start_time, end_time)
+
+    def scan_unindexed_file(self, file_index, file_handle, line_filters, start_time, end_time, scan_budget):
+        """Decompress the file in chunks, across all gzip members or zstd frames, only the matching lines are kept"""
+        if scan_budget[0] <= 0:
+            return
+        if file_index.compression == ".zst":
+            reader = zstandard.ZstdDecompressor().stream_reader(file_handle, read_across_frames=True)
+        else:
+            reader = gzip.GzipFile(fileobj=file_handle, mode="rb")
+        matches = []
+        rest = b""
+        with reader:
+            while scan_budget[0] > 0:
+                data = reader.read(min(const.SEARCH_SCAN_CHUNK_SIZE, scan_budget[0]))
+                if not data:
+                    break
+                scan_budget[0] -= len(data)
+                lines = (rest + data).split(b"\n")
+                rest = lines.pop() # incomplete last line, completed by the next chunk
+                matches.extend(self.filter_lines(lines, file_index.file_date, line_filters, start_time, end_time))
+        matches.extend(self.filter_lines([rest], file_index.file_date, line_filters, start_time, end_time))
+        yield from reversed(matches)
+
+    def filter_lines(self, lines, file_date, line_filters, start_time, end_time):
+        for line in lines:
+            if not line or not all(line_filter(line) for line_filter in line_filters):
+                continue
+            line_time = get_line_time(line, file_date)
+            if line_time is not None and ((start_time is not None and line_time < start_time) or (end_time is not None and line_time > end_time)):
+                continue
+            yield line_time, line.decode('utf-8', 'replace')
+
+    def close(self):
+        self.stop_event.set()
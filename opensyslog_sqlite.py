@@ -0,0 +1,142 @@
+"""Module providing the optional SQLite storage backend for clients and DHCP events"""
+import ipaddress
+import sqlite3
+import threading
+import traceback
+
+import const
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS clients (
+    mac TEXT PRIMARY KEY,
+    ip TEXT,
+    ip_num INTEGER,
+    name TEXT,
+    host_name TEXT,
+    reconnect_count_per_day INTEGER,
+    last_connected TEXT,
+    notify INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_clients_last_connected ON clients (last_connected, reconnect_count_per_day);
+CREATE INDEX IF NOT EXISTS idx_clients_reconnect_count ON clients (reconnect_count_per_day);
+CREATE INDEX IF NOT EXISTS idx_clients_ip_num ON clients (ip_num);
+CREATE TABLE IF NOT EXISTS dhcp_events (
+    id INTEGER PRIMARY KEY,
+    event_time TEXT,
+    event_type TEXT,
+    mac TEXT,
+    ip TEXT,
+    host_name TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_dhcp_events_mac ON dhcp_events (mac, event_time);
+CREATE INDEX IF NOT EXISTS idx_dhcp_events_time ON dhcp_events (event_time);
+"""
+
+CLIENT_COLUMNS = "mac, ip, name, host_name, reconnect_count_per_day, last_connected, notify"
+
+# sort order name -> ORDER BY clause, each one is served by an index
+CLIENT_SORT_ORDERS = {
+    "reconnect": "reconnect_count_per_day DESC",
+    "datetime": "last_connected DESC, reconnect_count_per_day DESC",
+    "ip": "ip_num ASC",
+}
+
+def get_ip_num(ip_address):
+    try:
+        return int(ipaddress.IPv4Address(ip_address))
+    except (ValueError, TypeError):
+        return None
+
+class OpensyslogSqliteStore:
+    """SQLite (WAL) store for the client table and an append-only DHCP event history"""
+    def __init__(self, opensysloghelper):
+        self.helper = opensysloghelper
+        self.db_file_with_path = self.helper.config_folder + const.SQLITE_DB_FILE
+        self.local = threading.local() # one connection per thread, WAL lets the web server read while the flusher writes
+        connection = self.get_connection()
+        connection.executescript(SCHEMA)
+        connection.commit()
+        self.helper.print(self.helper.log_level_info, f"OpensyslogSqliteStore: using {self.db_file_with_path}")
+
+    def get_connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_file_with_path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def is_empty(self):
+        return self.get_connection().execute("SELECT 1 FROM clients LIMIT 1").fetchone() is None
+
+    def load_clients(self):
+        """Return the client table in the unifi_dhcpack_status.json layout"""
+        cursor = self.get_connection().execute(f"SELECT {CLIENT_COLUMNS} FROM clients")
+        return dict(self.row_to_client(row) for row in cursor)
+
+    def save_clients(self, clients, changed_macs=None):
+        """Upsert the given clients (only changed_macs when known) in one transaction"""
+        macs = clients.keys() if changed_macs is None else changed_macs
+        rows = []
+        for mac in macs:
+            client = clients.get(mac)
+            if client is not None:
+                rows.append((mac, client["ip"], get_ip_num(client["ip"]), client["name"], client.get("host_name"), client["reconnect_count_per_day"], client["last_connected"], client["notify"]))
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.executemany("INSERT OR REPLACE INTO clients (mac, ip, ip_num, name, host_name, reconnect_count_per_day, last_connected, notify) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            return True
+        except sqlite3.Error as e:
+            exception_info = f"OpensyslogSqliteStore:save_clients(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+        return False
+
+    def save_events(self, events):
+        """Append (event_time, event_type, mac, ip, host_name) tuples in one transaction"""
+        try:
+            connection = self.get_connection()
+            with connection:
+                connection.executemany("INSERT INTO dhcp_events (event_time, event_type, mac, ip, host_name) VALUES (?, ?, ?, ?, ?)", events)
+            return True
+        except sqlite3.Error as e:
+            exception_info = f"OpensyslogSqliteStore:save_events(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+        return False
+
+    def query_clients(self, sort_order, limit=-1, offset=0):
+        """Return [(mac, client)] ordered through the matching index"""
+        cursor = self.get_connection().execute(f"SELECT {CLIENT_COLUMNS} FROM clients ORDER BY {CLIENT_SORT_ORDERS[sort_order]} LIMIT ? OFFSET ?", (limit, offset))
+        return [self.row_to_client(row) for row in cursor]
+
+    def count_clients(self):
+        return self.get_connection().execute("SELECT COUNT(*) FROM clients").fetchone()[0]
+
+    def query_events(self, mac_address=None, limit=100):
+        """Return the newest events, optionally for one MAC, as (event_time, event_type, mac, ip, host_name)"""
+        if mac_address:
+            cursor = self.get_connection().execute("SELECT event_time, event_type, mac, ip, host_name FROM dhcp_events WHERE mac = ? ORDER BY event_time DESC, id DESC LIMIT ?", (mac_address, limit))
+        else:
+            cursor = self.get_connection().execute("SELECT event_time, event_type, mac, ip, host_name FROM dhcp_events ORDER BY event_time DESC, id DESC LIMIT ?", (limit,))
+        return cursor.fetchall()
+
+    def purge_events(self, older_than):
+        """Drop events with event_time before older_than ('%Y-%m-%d %H:%M:%S')"""
+        connection = self.get_connection()
+        with connection:
+            return connection.execute("DELETE FROM dhcp_events WHERE event_time < ?", (older_than,)).rowcount
+
+    def delete_clients(self):
+        connection = self.get_connection()
+        with connection:
+            connection.execute("DELETE FROM clients")
+
+    def delete_events(self, start_time, end_time):
+        """Drop events with start_time <= event_time < end_time ('%Y-%m-%d %H:%M:%S'), before they get replayed"""
+        connection = self.get_connection()
+        with connection:
+            return connection.execute("DELETE FROM dhcp_events WHERE event_time >= ? AND event_time < ?", (start_time, end_time)).rowcount
+
+    def row_to_client(self, row):
+        return row[0], {"ip": row[1], "name": row[2], "host_name": row[3], "reconnect_count_per_day": row[4], "last_connected": row[5], "notify": row[6]}
@@ -0,0 +1,126 @@
+"""Module to keep the DHCP client table in memory and persist it in the background"""
+import atexit
+import threading
+import time
+import traceback
+
+import const
+from opensyslog_client import OpensyslogClient, format_time, get_client_fields, mac_to_int
+
+class OpensyslogState:
+    """Authoritative in-memory DHCP client table with write-behind persistence"""
+    def __init__(self, opensysloghelper, write_behind=True):
+        # write_behind=False (--replay): no background or exit flushes, the caller flushes once it succeeded
+        self.helper = opensysloghelper
+        state_config = self.helper.config.get("state") or {}
+        self.flush_interval_seconds = state_config.get("flush_interval_seconds", const.STATE_FLUSH_INTERVAL_SECONDS)
+        self.flush_after_changes = state_config.get("flush_after_changes", const.STATE_FLUSH_AFTER_CHANGES)
+
+        # lock guards clients/version/dirty_count, flush_lock serializes writers to the file
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.clients = self.load_clients() # mac int -> OpensyslogClient
+        self.version = 0
+        self.flushed_version = 0 # version of the table as last written to the backend
+        self.dirty_count = 0
+        self.changed_macs = set()
+        self.record_events = self.helper.sqlite_store is not None
+        self.pending_events = []
+        metrics = self.helper.metrics
+        metrics.gauge("state_clients", "Clients in the DHCP client table", lambda: len(self.clients))
+        metrics.gauge("state_pending_changes", "Changes not yet written to the backend", lambda: self.dirty_count)
+        self.flush_duration = metrics.state_flush_duration
+
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
+        if write_behind:
+            self.flush_thread_handle = threading.Thread(target=self.flush_thread, name="state-flush", daemon=True)
+            self.flush_thread_handle.start()
+            atexit.register(self.close)
+        msg_str = f"OpensyslogState: loaded {len(self.clients)} clients, flush_interval_seconds: {self.flush_interval_seconds}, flush_after_changes: {self.flush_after_changes}"
+        self.helper.print(self.helper.log_level_debug, msg_str)
+
+    def load_clients(self):
+        clients = {}
+        for mac_address, client in self.helper.load_dhcpack_status_json().items():
+            try:
+                clients[mac_to_int(mac_address)] = OpensyslogClient.from_dict(client)
+            except (ValueError, AttributeError, TypeError) as e:
+                self.helper.print(self.helper.log_level_warning, f"OpensyslogState: skipped client {mac_address}: {str(e)}")
+        return clients
+
+    def get_client(self, mac_address):
+        """Client of one 'AA:BB:CC:DD:EE:FF' as a unifi_dhcpack_status.json dict, None if unknown"""
+        with self.lock:
+            client = self.clients.get(mac_to_int(mac_address))
+            return None if client is None else client.to_dict()
+
+    def mark_dirty(self, mac_address=None):
+        """Record one change to the client table, caller must hold self.lock"""
+        self.version += 1
+        self.dirty_count += 1
+        if mac_address is not None:
+            self.changed_macs.add(mac_address)
+        if self.dirty_count >= self.flush_after_changes:
+            self.flush_event.set()
+
+    def add_event(self, event_time, event_type, mac_address, ip_address, host_name):
+        """Queue one event (event_time in epoch seconds) for the event history (sqlite backend only), caller must hold self.lock"""
+        if self.record_events:
+            self.pending_events.append((format_time(event_time), event_type, mac_address, ip_address, host_name))
+            self.dirty_count += 1
+
+    def snapshot(self):
+        """Return [(mac int, get_client_fields() tuple)] which is safe to use outside the lock"""
+        with self.lock:
+            return list(zip(self.clients.keys(), map(get_client_fields, self.clients.values())))
+
+    def flush(self):
+        """Write the client table to disk if it changed since the last flush"""
+        with self.flush_lock:
+            with self.lock:
+                dirty_count = self.dirty_count
+                if dirty_count == 0:
+                    return
+                version = self.version
+                # field tuples under the lock, formatting them for the backend happens outside of it
+                if self.helper.sqlite_store is not None:
+                    clients = [(mac, get_client_fields(self.clients[mac])) for mac in self.changed_macs if mac in self.clients]
+                else:
+                    clients = list(zip(self.clients.keys(), map(get_client_fields, self.clients.values())))
+                changed_macs = self.changed_macs
+                pending_events = self.pending_events
+                self.dirty_count = 0
+                self.changed_macs = set()
+                self.pending_events = []
+            flush_start = time.perf_counter()
+            saved = self.helper.save_dhcpack_status_json(clients)
+            if saved and pending_events:
+                saved = self.helper.save_dhcp_events(pending_events)
+                if not saved:
+                    changed_macs = set() # clients made it, only the events need a retry
+            self.flush_duration.observe(time.perf_counter() - flush_start)
+            if not saved:
+                with self.lock:
+                    # keep it dirty so next flush retries
+                    self.dirty_count += dirty_count
+                    self.changed_macs.update(changed_macs)
+                    self.pending_events[:0] = pending_events
+            else:
+                self.flushed_version = version
+
+    def flush_thread(self):
+        while not self.stop_event.is_set():
+            self.flush_event.wait(self.flush_interval_seconds)
+            self.flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                exception_info = f"OpensyslogState:flush_thread(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+
+    def close(self):
+        """Stop background flushing and write any pending changes"""
+        self.stop_event.set()
+        self.flush_event.set()
+        self.flush()
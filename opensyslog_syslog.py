@@ -1,16 +1,57 @@
 """Module to process incoming syslog data from othe Uniti router"""
-import socket
+import queue
+import threading
 import time
 import datetime
 import traceback
 
 import const
+from opensyslog_client import OpensyslogClient, intern_name, ip_to_int, mac_to_int
+from opensyslog_state import OpensyslogState
+from opensyslog_receiver import OpensyslogReceiver
+from opensyslog_tcp import OpensyslogTcpReceiver
+from opensyslog_parser import OpensyslogParser
+from opensyslog_dedup import OpensyslogDedup
+
+def start_receivers(opensysloghelper, reuse_port=False):
+    """Bind and start the UDP receiver and the optional TCP listener, returns (receiver, tcp receiver or None)"""
+    receiver = OpensyslogReceiver(opensysloghelper, reuse_port=reuse_port)
+    receiver.start()
+    tcp_receiver = None
+    if (opensysloghelper.config.get("syslog") or {}).get("tcp_port", const.SYSLOG_TCP_PORT):
+        # TCP frames share the UDP batch queue, so both go through the same dedup/log/parse path
+        tcp_receiver = OpensyslogTcpReceiver(opensysloghelper, receiver.queue, reuse_port=reuse_port)
+        try:
+            tcp_receiver.start()
+        except Exception:
+            receiver.stop() # a retry binds both again
+            raise
+    return receiver, tcp_receiver
 
 class OpensyslogSyslog:
     """Class to handle incoming syslog data from the Unifi router"""
-    def __init__(self, opensysloghelper):
-        self.dhcp_ack_json = {}
+    def __init__(self, opensysloghelper, event_sink=None, notifications_enabled=True, receivers=None, write_behind=True):
         self.helper = opensysloghelper
+        self.notifications_enabled = notifications_enabled # off when replaying archived logs
+        # in a worker process parsed events go to event_sink and the state owner process applies them
+        self.event_sink = event_sink
+        self.dhcpack_state = None
+        if self.event_sink is None:
+            self.dhcpack_state = OpensyslogState(self.helper, write_behind)
+            self.dhcp_ack_json = self.dhcpack_state.clients # mac int -> OpensyslogClient
+        self.day_range = (0, 0) # [start, end) epoch seconds of the local day of the last DHCPACK
+        # OpensyslogMonitor passes receivers it started before loading the state, monitor() starts them otherwise
+        self.receiver, self.tcp_receiver = receivers if receivers is not None else (None, None)
+        self.stop_event = threading.Event()
+        self.parser = OpensyslogParser()
+        self.event_handlers = {const.EVENT_DHCPACK: self.handle_dhcpack}
+        dedup_config = self.helper.config.get("dedup") or {}
+        dedup_max_entries = dedup_config.get("max_entries", const.DEDUP_MAX_ENTRIES)
+        self.line_dedup = OpensyslogDedup(dedup_config.get("line_window_seconds", const.DEDUP_LINE_WINDOW_SECONDS), dedup_max_entries)
+        self.event_dedup = OpensyslogDedup(dedup_config.get("event_window_seconds", const.DEDUP_EVENT_WINDOW_SECONDS), dedup_max_entries)
+        self.metrics = self.helper.metrics
+        self.metrics.counter("syslog_duplicates_dropped_total", "Duplicate lines or events dropped", label_name="kind",
+                             read_value=lambda: {"line": self.line_dedup.duplicates_suppressed, "event": self.event_dedup.duplicates_suppressed})
         self.default_notification_string = self.helper.config["notifications"].get("notification_string", const.DEFAULT_NOTIFICATION_STRING)
         self.default_notify_type = self.helper.config["notifications"].get("default_notify_type", const.NOTIFY_CONNECT_EACH_TIME_WITH_MAX_PER_DAY_WITH_INTERMITTENT)
         self.max_notify_count_per_device_per_day = self.helper.config["notifications"].get("max_notify_count_per_device_per_day", const.MAX_NOTIFY_COUNT_PER_DAY)
@@ -19,96 +60,179 @@ class OpensyslogSyslog:
         msg_str = f"max_notify_count_per_device_per_day: {self.max_notify_count_per_device_per_day}, do_not_disturb_start_hour: {self.dnd_start_hour}, do_not_disturb_end_hour: {self.dnd_end_hour}"
         self.helper.print(self.helper.log_level_debug, msg_str)
 
-    def monitor(self):
+    def monitor(self, reuse_port=False):
         """Read syslog data"""
         self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:monitor(): enter")
-        previous_string_data = ""
 
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.bind((const.SYSLOG_SERVER_IP, const.SYSLOG_SERVER_PORT))
+            if self.receiver is None:
+                self.receiver, self.tcp_receiver = start_receivers(self.helper, reuse_port)
+            while not self.stop_event.is_set():
+                # the receiver thread keeps draining the socket while this thread processes a batch
+                try:
+                    batch = self.receiver.queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                self.handle_batch(batch)
+            # stopping: close the sockets first, then apply what the receivers had already queued
+            self.stop_receivers()
             while True:
                 try:
-                    data, address = sock.recvfrom(const.SYSLOG_SOCKET_RECEIVE_BUFFER)
-                    string_data = data.decode('utf-8')
-                    if previous_string_data != string_data:
-                        previous_string_data = string_data
-                        self.handle_incoming_data(string_data)
-                except Exception as e:
-                    exception_info = f"OpensyslogSyslog:monitor():loop: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
-                    self.helper.print(self.helper.log_level_error, exception_info)
+                    batch = self.receiver.queue.get_nowait()
+                except queue.Empty:
+                    break
+                self.handle_batch(batch)
         except Exception as e:
             exception_info = f"OpensyslogSyslog:monitor(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
             self.helper.print(self.helper.log_level_error, exception_info)
-            time.sleep(60)
+            self.stop_event.wait(60)
         self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:monitor(): exit")
 
-    def handle_incoming_data(self, string_data):
-        """Log syslog data"""
-        self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:hid(): enter")
+    def handle_batch(self, batch):
+        for data in batch:
+            try:
+                # retransmitted lines are dropped before logging, like the old previous-line check
+                if not self.line_dedup.is_duplicate(hash(data.rstrip())):
+                    self.handle_incoming_data(data)
+            except Exception as e:
+                exception_info = f"OpensyslogSyslog:monitor():loop: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+        if self.event_sink is not None:
+            self.event_sink.flush()
+
+    def stop(self):
+        """Make monitor() stop the receivers, apply the queued batches and return"""
+        self.stop_event.set()
+
+    def stop_receivers(self):
+        # both threads wake up from their 1s poll at the same time
+        if self.tcp_receiver is not None:
+            self.tcp_receiver.stop_event.set()
+        self.receiver.stop_event.set()
+        if self.tcp_receiver is not None:
+            self.tcp_receiver.stop()
+        self.receiver.stop()
+        msg_str = f"OpensyslogSyslog: receivers stopped, {self.receiver.queue.qsize()} batches left to apply"
+        self.helper.print(self.helper.log_level_info, msg_str)
+
+    def handle_incoming_data(self, data):
+        """Log syslog data, raw bytes are kept as received and only the extracted fields get decoded"""
+        if self.helper.debug_enabled:
+            self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:hid(): enter")
 
-        string_data = string_data.replace('\n', '')
-        self.helper.log_data(string_data)
-        self.parse_message_data(string_data)
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        data = data.replace(b'\n', b'')
+        self.helper.log_data(data)
+        self.parse_message_data(data)
 
-        self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:hid(): exit")
+        if self.helper.debug_enabled:
+            self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:hid(): exit")
 
-    def parse_message_data(self, message_data):
-        """Process syslog data"""
-        self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:pmd(): enter")
+    def parse_message_data(self, message_data, timestamp=None):
+        """Process syslog data, timestamp defaults to now"""
+        if self.helper.debug_enabled:
+            self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:pmd(): enter")
 
         try:
-            index = -1
-            data = message_data.split()
-            for i, sub_data in enumerate(data):
-                if "DHCPACK" in sub_data:
-                    index = i
-                    break
-            if index == -1:
+            event = self.parser.parse(message_data, time.time() if timestamp is None else timestamp)
+            if event is None:
+                return
+            self.metrics.events_parsed.inc_label(event.event_type)
+            if event.host_name is not None and "\ufffd" in event.host_name:
+                self.metrics.decode_failures.inc()
+            if self.event_sink is not None:
+                self.event_sink.add(event)
+            else:
+                self.handle_event(event)
+        except Exception as e:
+            exception_info = f"parse_message_data:exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
+
+    def handle_event(self, event):
+        """Apply one parsed event to the client state, runs in the state owner"""
+        try:
+            # the same event reported by several APs or retransmitted between other lines
+            if self.event_dedup.is_duplicate((event.mac_address, event.ip_address, event.event_type), event.timestamp):
+                self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:pmd(): duplicate: %s", event)
                 return
+            self.helper.timeline.add_event(event)
+            with self.dhcpack_state.lock:
+                self.dhcpack_state.add_event(event.timestamp, event.event_type, event.mac_address, event.ip_address, event.host_name)
+            handler = self.event_handlers.get(event.event_type)
+            if handler is None:
+                self.helper.print(self.helper.log_level_debug, "OpensyslogSyslog:pmd(): no handler for: %s", event)
+                return
+            handler(event)
+        except Exception as e:
+            exception_info = f"handle_event:exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            self.helper.print(self.helper.log_level_error, exception_info)
 
-            self.dhcp_ack_json = self.helper.load_dhcpack_status_json()
-            host_name = None
-            ip_address = data[index+1]
-            mac_address = data[index+2].upper()
-            if len(data) >= index+4:
-                host_name = data[index+3]
+    def handle_dhcpack(self, event):
+        """Update the client table for a DHCPACK and notify"""
+        try:
+            host_name = intern_name(event.host_name)
+            ip_address = event.ip_address
+            mac_address = event.mac_address
             client_name = self.helper.lookup_device_name_from_csv(mac_address)
             if client_name is None:
                 client_name = host_name
-            json_data = self.dhcp_ack_json.get(mac_address)
-            date_time_now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            first_time_seen = False
-            if json_data is None:
-                first_time_seen = True
-                self.dhcp_ack_json[mac_address] = {"ip": ip_address, "name": client_name, "host_name": host_name, "reconnect_count_per_day": 1, "last_connected": date_time_now, "notify": self.default_notify_type}
-            else:
-                # This block is to auto correct unifi_dhcpack_status.json
-                self.dhcp_ack_json[mac_address]["name"] = client_name # auto correct from the lookup file!
-                self.dhcp_ack_json[mac_address]["host_name"] = host_name # auto correct from the lookup file!
-                if isinstance(self.dhcp_ack_json[mac_address]["notify"], bool):
-                    self.dhcp_ack_json[mac_address]["notify"] = self.default_notify_type # auto correct from the lookup file!
-                # End auto correct
-                if self.dhcp_ack_json[mac_address]["last_connected"].split()[0] != date_time_now.split()[0]:
-                    self.dhcp_ack_json[mac_address]["reconnect_count_per_day"] = 1
+            if client_name is None:
+                client_name = self.helper.lookup_vendor_from_csv(mac_address)
+            client_name = intern_name(client_name)
+            mac_number = mac_to_int(mac_address)
+            ip_number = ip_to_int(ip_address)
+            event_time = int(event.timestamp)
+            with self.dhcpack_state.lock:
+                client = self.dhcp_ack_json.get(mac_number)
+                first_time_seen = False
+                if client is None:
+                    first_time_seen = True
+                    client = OpensyslogClient(ip_number, client_name, host_name, 1, event_time, self.default_notify_type)
+                    self.dhcp_ack_json[mac_number] = client
                 else:
-                    self.dhcp_ack_json[mac_address]["reconnect_count_per_day"] += 1
-            self.notify(mac_address, ip_address, first_time_seen)
-            self.dhcp_ack_json[mac_address]["ip"] = ip_address
-            self.dhcp_ack_json[mac_address]["last_connected"] = date_time_now
-            self.helper.save_dhcpack_status_json(self.dhcp_ack_json)
+                    # This block is to auto correct unifi_dhcpack_status.json
+                    client.name = client_name # auto correct from the lookup file!
+                    client.host_name = host_name # auto correct from the lookup file!
+                    if isinstance(client.notify, bool):
+                        client.notify = self.default_notify_type # auto correct from the lookup file!
+                    # End auto correct
+                    if self.is_same_day(client.last_connected, event_time):
+                        client.reconnect_count_per_day += 1
+                    else:
+                        client.reconnect_count_per_day = 1
+                if self.notifications_enabled:
+                    self.notify(mac_address, client, ip_address, ip_number, first_time_seen, datetime.datetime.fromtimestamp(event.timestamp))
+                client.ip = ip_number
+                client.last_connected = event_time
+                self.dhcpack_state.mark_dirty(mac_number)
         except Exception as e:
-            exception_info = f"parse_message_data:exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            exception_info = f"handle_dhcpack:exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
             self.helper.print(self.helper.log_level_error, exception_info)
 
-    def notify(self, mac_address, ip_address, first_time_seen):
-        """Notify user of this event"""
+    def is_same_day(self, last_connected, event_time):
+        """Whether both epoch times fall on the same local day, the day of the last event is cached"""
+        day_start, day_end = self.day_range
+        if not day_start <= event_time < day_end:
+            event_date = datetime.date.fromtimestamp(event_time)
+            day_start = int(datetime.datetime.combine(event_date, datetime.time()).timestamp())
+            day_end = int(datetime.datetime.combine(event_date + datetime.timedelta(days=1), datetime.time()).timestamp())
+            self.day_range = (day_start, day_end)
+        return day_start <= last_connected < day_end
+
+    def notify(self, mac_address, client, ip_address, ip_number, first_time_seen, event_datetime=None):
+        """Notify user of this event, client still holds the previous IP"""
         notified = False
         try:
-            notify_msg = self.build_notification_string(mac_address, ip_address, first_time_seen)
-            if self.is_notification_needed(mac_address, ip_address, first_time_seen) and self.is_currnet_time_outside_dnd():
+            notify_msg = self.build_notification_string(mac_address, client, ip_address, ip_number, first_time_seen)
+            if not self.is_notification_needed(mac_address, client, ip_number, first_time_seen):
+                self.metrics.notifications_suppressed.inc_label(self.get_suppressed_reason(client))
+            elif not self.is_currnet_time_outside_dnd(event_datetime):
+                self.metrics.notifications_suppressed.inc_label("dnd")
+            else:
                 self.helper.notify_telegram(notify_msg)
-                self.helper.print(self.helper.log_level_debug, "Notified: " + notify_msg)
+                self.helper.print(self.helper.log_level_debug, "Notified: %s", notify_msg)
+                self.metrics.notifications_sent.inc()
                 notified = True
             self.helper.append_notification_history(notify_msg + ", Notified: " + str(notified))
         except Exception as e:
@@ -116,46 +240,52 @@ class OpensyslogSyslog:
             self.helper.print(self.helper.log_level_error, exception_info)
         return notified
 
-    def build_notification_string(self, mac_address, ip_address, first_time_seen):
+    def build_notification_string(self, mac_address, client, ip_address, ip_number, first_time_seen):
         """Build string for notification"""
         notify_string = self.default_notification_string.replace("{MAC}", str(mac_address))
         notify_string = notify_string.replace("{IP}", str(ip_address))
-        notify_string = notify_string.replace("{NAME}", str(self.dhcp_ack_json[mac_address]["name"]))
-        notify_string = notify_string.replace("{COUNT}", str(self.dhcp_ack_json[mac_address]["reconnect_count_per_day"]))
+        notify_string = notify_string.replace("{NAME}", str(client.name))
+        notify_string = notify_string.replace("{COUNT}", str(client.reconnect_count_per_day))
         first_time_seen = f'{"<b>(New)</b> " if first_time_seen else ""}'
-        ip_changed = f'{"<b>(IP-Changed)</b> " if self.dhcp_ack_json[mac_address]["ip"] != ip_address else ""}'
+        ip_changed = f'{"<b>(IP-Changed)</b> " if client.ip != ip_number else ""}'
         return first_time_seen + ip_changed + notify_string
 
-    def is_notification_needed(self, mac_address, ip_address, first_time_seen):
+    def is_notification_needed(self, mac_address, client, ip_number, first_time_seen):
         """Check if notification needs to be sent"""
-        match self.dhcp_ack_json[mac_address]["notify"]:
+        match client.notify:
             case const.NOTIFY_NEVER:
                 return False
             case const.NOTIFY_CONNECT_FIRST_TIME:
                 return first_time_seen
             case const.NOTIFY_CONNECT_FIRST_TIME_OR_IP_HOPE:
-                return first_time_seen or self.dhcp_ack_json[mac_address]["ip"] != ip_address
+                return first_time_seen or client.ip != ip_number
             case const.NOTIFY_CONNECT_EACH_TIME:
                 return True
             case const.NOTIFY_CONNECT_EACH_TIME_WITH_MAX_PER_DAY:
-                return self.dhcp_ack_json[mac_address]["reconnect_count_per_day"] <= self.max_notify_count_per_device_per_day
+                return client.reconnect_count_per_day <= self.max_notify_count_per_device_per_day
             case const.NOTIFY_CONNECT_EACH_TIME_WITH_MAX_PER_DAY_WITH_INTERMITTENT:
-                return (self.dhcp_ack_json[mac_address]["reconnect_count_per_day"] <= self.max_notify_count_per_device_per_day) or \
-                    self.dhcp_ack_json[mac_address]["reconnect_count_per_day"] % 10 == 1
+                return (client.reconnect_count_per_day <= self.max_notify_count_per_device_per_day) or \
+                    client.reconnect_count_per_day % 10 == 1
             case const.NOTIFY_CONNECT_DEVICE_NOT_IN_LOOKUP_FILE:
                 return not self.helper.lookup_device_name_from_csv(mac_address)
             case _:
                 return False
 
-    def is_currnet_time_outside_dnd(self):
-        """Check if current datetime falls withing DND range"""
-        current_datetime = datetime.datetime.now()
+    def get_suppressed_reason(self, client):
+        """Metrics label for why is_notification_needed() said no"""
+        if client.notify in (const.NOTIFY_CONNECT_EACH_TIME_WITH_MAX_PER_DAY, const.NOTIFY_CONNECT_EACH_TIME_WITH_MAX_PER_DAY_WITH_INTERMITTENT):
+            return "max_per_day"
+        return "notify_type"
+
+    def is_currnet_time_outside_dnd(self, current_datetime=None):
+        """Check if current (or the given event) datetime falls withing DND range"""
+        if current_datetime is None:
+            current_datetime = datetime.datetime.now()
         dnd_start_datetime = datetime.datetime(current_datetime.year, current_datetime.month, current_datetime.day, self.dnd_start_hour, 0)
         dnd_end_datetime = datetime.datetime(current_datetime.year, current_datetime.month, current_datetime.day, self.dnd_end_hour, 0)
         if dnd_start_datetime <= dnd_end_datetime:
             status = dnd_start_datetime <= current_datetime <= dnd_end_datetime
         else:
             status = dnd_start_datetime <= current_datetime or current_datetime <= dnd_end_datetime
-        msg_str = f"Current: {current_datetime}, start: {dnd_start_datetime}, end: {dnd_end_datetime}, outside: {not status}"
-        self.helper.print(self.helper.log_level_debug, msg_str)
+        self.helper.print(self.helper.log_level_debug, "Current: %s, start: %s, end: %s, outside: %s", current_datetime, dnd_start_datetime, dnd_end_datetime, not status)
         return not status
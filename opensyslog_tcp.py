@@ -0,0 +1,219 @@
+"""Module to receive syslog over TCP with RFC 6587 octet-counting or newline framing"""
+import queue
+import re
+import selectors
+import socket
+import threading
+import time
+import traceback
+
+import const
+
+OCTET_COUNT_PATTERN = re.compile(rb"([0-9]{1,10}) ") # RFC 6587 "MSG-LEN SP", a line like "2024-10-18T..." or "10.0.0.1 ..." does not match
+
+class OpensyslogTcpConnection:
+    """Receive buffer and framing state of one sender"""
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.buffer = bytearray()
+        self.skip_bytes = 0 # rest of an oversized octet-counted frame still to be discarded
+        self.skip_line = False # rest of an oversized newline framed line still to be discarded
+
+class OpensyslogTcpReceiver:
+    """Selector loop for many sender connections, frames go into the same queue as the UDP datagrams"""
+    def __init__(self, opensysloghelper, output_queue, reuse_port=False):
+        self.helper = opensysloghelper
+        self.output_queue = output_queue
+        self.reuse_port = reuse_port
+        syslog_config = self.helper.config.get("syslog") or {}
+        self.port = syslog_config.get("tcp_port", const.SYSLOG_TCP_PORT)
+        self.max_connections = syslog_config.get("tcp_max_connections", const.SYSLOG_TCP_MAX_CONNECTIONS)
+        self.max_message_size = syslog_config.get("tcp_max_message_size", const.SYSLOG_TCP_MAX_MESSAGE_SIZE)
+        self.batch_size = syslog_config.get("batch_size", const.SYSLOG_BATCH_SIZE)
+
+        self.selector = None
+        self.listen_sock = None
+        self.connections = {} # fileno -> OpensyslogTcpConnection
+        self.batch = []
+        self.stop_event = threading.Event()
+        self.receive_thread_handle = None
+
+        self.connections_accepted = 0
+        self.connections_rejected = 0 # over max_connections
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.frames_truncated = 0 # longer than max_message_size
+        self.backpressure_waits = 0 # times reading paused because the processing queue was full
+
+        metrics = self.helper.metrics
+        metrics.counter("syslog_tcp_connections_accepted_total", "TCP syslog connections accepted", read_value=lambda: self.connections_accepted)
+        metrics.counter("syslog_tcp_connections_rejected_total", "TCP syslog connections refused over tcp_max_connections", read_value=lambda: self.connections_rejected)
+        metrics.gauge("syslog_tcp_connections", "Open TCP syslog connections", lambda: len(self.connections))
+        metrics.counter("syslog_tcp_frames_received_total", "Syslog messages received over TCP", read_value=lambda: self.frames_received)
+        metrics.counter("syslog_tcp_bytes_received_total", "Syslog bytes received over TCP", read_value=lambda: self.bytes_received)
+        metrics.counter("syslog_tcp_frames_truncated_total", "TCP syslog messages longer than tcp_max_message_size", read_value=lambda: self.frames_truncated)
+        metrics.counter("syslog_tcp_backpressure_waits_total", "Times TCP reading paused because processing was behind", read_value=lambda: self.backpressure_waits)
+
+    def bind(self):
+        self.listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.listen_sock.bind((const.SYSLOG_SERVER_IP, self.port))
+        self.listen_sock.listen(128)
+        self.listen_sock.setblocking(False)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.listen_sock, selectors.EVENT_READ)
+        msg_str = f"OpensyslogTcpReceiver: listening {const.SYSLOG_SERVER_IP}:{self.port}, max_connections: {self.max_connections}, max_message_size: {self.max_message_size}"
+        self.helper.print(self.helper.log_level_info, msg_str)
+
+    def start(self):
+        if self.listen_sock is None:
+            self.bind()
+        self.receive_thread_handle = threading.Thread(target=self.receive_thread, name="syslog-tcp-receiver", daemon=True)
+        self.receive_thread_handle.start()
+
+    def receive_thread(self):
+        while not self.stop_event.is_set():
+            try:
+                if self.batch and not self.put_batch():
+                    # processing is behind: stop reading so the kernel buffers fill and TCP slows the senders down
+                    self.backpressure_waits += 1
+                    time.sleep(0.05)
+                    continue
+                for key, mask in self.selector.select(timeout=1):
+                    if key.fileobj is self.listen_sock:
+                        self.accept()
+                    else:
+                        self.read(key.data)
+                    if len(self.batch) >= self.batch_size and not self.put_batch():
+                        break
+            except Exception as e:
+                exception_info = f"OpensyslogTcpReceiver:receive_thread(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+                time.sleep(1)
+
+    def put_batch(self):
+        try:
+            self.output_queue.put_nowait(self.batch)
+        except queue.Full:
+            return False
+        self.batch = []
+        return True
+
+    def accept(self):
+        try:
+            sock, address = self.listen_sock.accept()
+        except BlockingIOError:
+            return
+        if len(self.connections) >= self.max_connections:
+            self.connections_rejected += 1
+            sock.close()
+            return
+        sock.setblocking(False)
+        connection = OpensyslogTcpConnection(sock, address)
+        self.connections[sock.fileno()] = connection
+        self.selector.register(sock, selectors.EVENT_READ, connection)
+        self.connections_accepted += 1
+        self.helper.print(self.helper.log_level_debug, "OpensyslogTcpReceiver: connection from %s:%s", *address)
+
+    def read(self, connection):
+        # one recv per connection and select round, a busy sender can not starve the others
+        try:
+            data = connection.sock.recv(const.SYSLOG_TCP_READ_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.helper.print(self.helper.log_level_warning, f"OpensyslogTcpReceiver: {connection.address[0]}:{connection.address[1]}: {str(e)}")
+            data = b""
+        if not data:
+            self.close_connection(connection)
+            return
+        self.bytes_received += len(data)
+        connection.buffer += data
+        self.extract_frames(connection)
+
+    def extract_frames(self, connection):
+        """Move complete frames from the connection buffer to the batch"""
+        buffer = connection.buffer
+        position = 0
+        while position < len(buffer):
+            if connection.skip_bytes:
+                skipped = min(connection.skip_bytes, len(buffer) - position)
+                connection.skip_bytes -= skipped
+                position += skipped
+                continue
+            if connection.skip_line:
+                end = buffer.find(b"\n", position)
+                if end < 0:
+                    position = len(buffer)
+                    break
+                connection.skip_line = False
+                position = end + 1
+                continue
+            octet_count = None
+            if 48 <= buffer[position] <= 57: # digit: octet-counting "MSG-LEN SP SYSLOG-MSG" or a newline framed line
+                octet_count = OCTET_COUNT_PATTERN.match(buffer, position)
+                if octet_count is None and len(buffer) - position <= 10 and buffer[position:].isdigit():
+                    break # length not complete yet
+            if octet_count is not None:
+                frame_length = int(octet_count.group(1))
+                frame_start = octet_count.end()
+                if frame_length > self.max_message_size:
+                    if len(buffer) - frame_start < self.max_message_size:
+                        break
+                    self.add_frame(bytes(buffer[frame_start:frame_start + self.max_message_size]), truncated=True)
+                    position = frame_start + self.max_message_size
+                    connection.skip_bytes = frame_length - self.max_message_size
+                    continue
+                if len(buffer) - frame_start < frame_length:
+                    break
+                if frame_length > 0:
+                    self.add_frame(bytes(buffer[frame_start:frame_start + frame_length]))
+                position = frame_start + frame_length
+            else: # non-transparent framing, one message per line
+                end = buffer.find(b"\n", position)
+                if end < 0:
+                    if len(buffer) - position > self.max_message_size:
+                        self.add_frame(bytes(buffer[position:position + self.max_message_size]), truncated=True)
+                        connection.skip_line = True
+                        position = len(buffer)
+                    break
+                if end - position > self.max_message_size:
+                    self.add_frame(bytes(buffer[position:position + self.max_message_size]), truncated=True)
+                elif end > position:
+                    self.add_frame(bytes(buffer[position:end]).rstrip(b"\r"))
+                position = end + 1
+        del buffer[:position]
+
+    def add_frame(self, frame, truncated=False):
+        self.frames_received += 1
+        if truncated:
+            self.frames_truncated += 1
+        self.batch.append(frame)
+
+    def close_connection(self, connection):
+        if connection.buffer and not connection.skip_bytes and not connection.skip_line:
+            self.add_frame(bytes(connection.buffer).rstrip(b"\r\n")) # last line without a newline
+        self.selector.unregister(connection.sock)
+        self.connections.pop(connection.sock.fileno(), None)
+        connection.sock.close()
+
+    def get_stats_string(self):
+        return f"tcp connections: {len(self.connections)}, accepted: {self.connections_accepted}, rejected: {self.connections_rejected}, frames: {self.frames_received}, bytes: {self.bytes_received}, truncated: {self.frames_truncated}, backpressure waits: {self.backpressure_waits}"
+
+    def stop(self):
+        self.stop_event.set()
+        if self.receive_thread_handle is not None:
+            self.receive_thread_handle.join(timeout=2)
+        if self.selector is not None:
+            for connection in list(self.connections.values()):
+                self.close_connection(connection)
+            self.selector.close()
+            self.selector = None
+        if self.batch and not self.put_batch():
+            self.helper.print(self.helper.log_level_warning, f"OpensyslogTcpReceiver: processing queue full, dropped the last {len(self.batch)} frames")
+        if self.listen_sock is not None:
+            self.listen_sock.close()
+            self.listen_sock = None
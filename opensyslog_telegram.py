@@ -0,0 +1,135 @@
+"""Module to deliver Telegram notifications from a background thread"""
+import queue
+import threading
+import time
+import traceback
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import const
+
+class OpensyslogTelegram:
+    """Queue based Telegram sender with a keep-alive session, per-chat rate limit, ordered retries and burst coalescing"""
+    def __init__(self, opensysloghelper):
+        self.helper = opensysloghelper
+        telegram_config = self.helper.config["telegram"]
+        self.bot_chat_id = telegram_config["chat_id"]
+        api_base_url = telegram_config.get("api_base_url", const.TELEGRAM_API_BASE_URL).rstrip("/")
+        # telegram API: https://core.telegram.org/bots/api#sendmessage
+        self.send_message_url = api_base_url + "/bot" + str(telegram_config["api_token"]) + "/sendMessage"
+        self.min_interval_seconds = telegram_config.get("min_interval_seconds", const.TELEGRAM_MIN_INTERVAL_SECONDS)
+        self.max_retries = telegram_config.get("max_retries", const.TELEGRAM_MAX_RETRIES)
+        self.coalesce_threshold = telegram_config.get("coalesce_threshold", const.TELEGRAM_COALESCE_THRESHOLD)
+        self.queue = queue.Queue(maxsize=telegram_config.get("queue_size", const.TELEGRAM_QUEUE_SIZE))
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.next_send_time = 0.0
+        self.messages_sent = 0
+        self.messages_failed = 0
+        self.messages_dropped = 0
+        self.messages_coalesced = 0
+        metrics = self.helper.metrics
+        metrics.counter("telegram_messages_sent_total", "Telegram messages delivered", read_value=lambda: self.messages_sent)
+        metrics.counter("telegram_messages_failed_total", "Telegram messages given up after retries", read_value=lambda: self.messages_failed)
+        metrics.counter("telegram_messages_dropped_total", "Telegram messages dropped because the queue was full", read_value=lambda: self.messages_dropped)
+        metrics.counter("telegram_messages_coalesced_total", "Notifications sent as part of a digest", read_value=lambda: self.messages_coalesced)
+        metrics.gauge("telegram_queue_depth", "Notifications waiting for the Telegram dispatcher", self.queue.qsize)
+        self.request_latency = metrics.telegram_latency
+
+        self.stop_event = threading.Event()
+        self.dispatch_thread_handle = threading.Thread(target=self.dispatch_thread, name="telegram-dispatch", daemon=True)
+        self.dispatch_thread_handle.start()
+
+    def send(self, message_data):
+        """Queue a message, never blocks the caller"""
+        try:
+            self.queue.put_nowait(message_data)
+        except queue.Full:
+            self.messages_dropped += 1
+            self.helper.print(self.helper.log_level_error, f"OpensyslogTelegram: queue full, dropped message: {message_data}")
+
+    def dispatch_thread(self):
+        while not (self.stop_event.is_set() and self.queue.empty()):
+            try:
+                message_data = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                messages = [message_data]
+                while True:
+                    try:
+                        messages.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if len(messages) >= self.coalesce_threshold:
+                    self.messages_coalesced += len(messages)
+                    messages = self.build_digests(messages)
+                for message in messages:
+                    self.deliver(message)
+            except Exception as e:
+                exception_info = f"OpensyslogTelegram:dispatch_thread(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+
+    def build_digests(self, messages):
+        """Join a burst of messages into as few Telegram messages as the size limit allows"""
+        digests = []
+        header = f"<b>{len(messages)} notifications:</b>"
+        current = header
+        for message in messages:
+            if len(current) + 1 + len(message) > const.TELEGRAM_MAX_MESSAGE_LENGTH:
+                digests.append(current)
+                current = message
+            else:
+                current += "\n" + message
+        digests.append(current)
+        return digests
+
+    def deliver(self, message_data):
+        """Send one message, retrying with backoff so later messages stay behind it"""
+        data = {"chat_id": self.bot_chat_id, 'text': message_data, 'parse_mode' : 'HTML'}
+        for attempt in range(self.max_retries + 1):
+            wait_seconds = self.next_send_time - time.monotonic()
+            if wait_seconds > 0:
+                self.stop_event.wait(wait_seconds) # returns at once on close(), the queued messages get one try each
+            if attempt > 0 and self.stop_event.is_set():
+                break # shutting down, no retries
+            self.next_send_time = time.monotonic() + self.min_interval_seconds
+            retry_after = min(2 ** attempt, const.TELEGRAM_MAX_BACKOFF_SECONDS)
+            request_start = time.perf_counter()
+            try:
+                resp = self.session.post(self.send_message_url, data=data, timeout=const.TELEGRAM_TIMEOUT_SECONDS)
+                self.request_latency.observe(time.perf_counter() - request_start)
+                if resp.status_code == 200:
+                    self.messages_sent += 1
+                    self.helper.print(self.helper.log_level_debug, "Sent message successfully")
+                    return True
+                err = f"sendMessage error: failed to send, attempt: {attempt + 1}, status: {resp.status_code}, reason: {resp.reason}, text: {resp.text}"
+                self.helper.print(self.helper.log_level_error, err)
+                if resp.status_code == 429:
+                    retry_after = self.get_retry_after(resp, retry_after)
+                elif resp.status_code < 500:
+                    break # bad request, token or chat id, retrying will not help
+            except requests.RequestException as e:
+                self.request_latency.observe(time.perf_counter() - request_start)
+                self.helper.print(self.helper.log_level_error, f"notify_telegram: attempt: {attempt + 1}, exception: {str(e)}")
+            if attempt < self.max_retries:
+                self.next_send_time = time.monotonic() + retry_after
+        self.messages_failed += 1
+        return False
+
+    def get_retry_after(self, resp, default):
+        try:
+            return resp.json()["parameters"]["retry_after"]
+        except (ValueError, KeyError, TypeError):
+            return default
+
+    def close(self, timeout=const.TELEGRAM_CLOSE_TIMEOUT_SECONDS):
+        """Stop accepting work and give queued messages a chance to go out"""
+        self.stop_event.set()
+        self.dispatch_thread_handle.join(timeout=timeout)
+        self.session.close()
@@ -0,0 +1,196 @@
+"""Module to keep a per device connection timeline, IP history and flap score"""
+import array
+import atexit
+import heapq
+import json
+import math
+import threading
+import time
+import traceback
+
+import const
+
+class OpensyslogDeviceTimeline:
+    """Hourly connect counts of one MAC in a ring of slot_count hours, plus its IP history and flap score"""
+    def __init__(self, slot_count):
+        self.counts = array.array('H', bytes(2 * slot_count)) # slot = epoch hour % slot_count
+        self.last_hour = None # newest epoch hour in the ring, slots after it hold counts of slot_count hours ago
+        self.ip_history = [] # [ip, first seen, last seen] in epoch seconds, oldest first
+        self.flap_score = 0.0 # decayed connect count as of flap_time
+        self.flap_time = 0.0
+
+    def add_count(self, hour):
+        counts = self.counts
+        slot_count = len(counts)
+        if self.last_hour is None or hour > self.last_hour:
+            if self.last_hour is not None:
+                # clear the slots of the hours without events since the last one, at most one full turn
+                for skipped_hour in range(self.last_hour + 1, min(hour, self.last_hour + slot_count) + 1):
+                    counts[skipped_hour % slot_count] = 0
+            self.last_hour = hour
+        elif hour <= self.last_hour - slot_count:
+            return # older than the retention
+        slot = hour % slot_count
+        if counts[slot] < 65535:
+            counts[slot] += 1
+
+    def get_hourly_counts(self, current_hour):
+        """Counts of the slot_count hours up to current_hour, oldest first"""
+        slot_count = len(self.counts)
+        last_hour = -1 if self.last_hour is None else self.last_hour
+        return [self.counts[hour % slot_count] if hour <= last_hour else 0 for hour in range(current_hour - slot_count + 1, current_hour + 1)]
+
+    def add_ip(self, ip_address, timestamp, history_size):
+        if self.ip_history and self.ip_history[-1][0] == ip_address:
+            self.ip_history[-1][2] = max(self.ip_history[-1][2], timestamp)
+            return
+        self.ip_history.append([ip_address, timestamp, timestamp])
+        if len(self.ip_history) > history_size:
+            del self.ip_history[0]
+
+    def add_flap(self, timestamp, half_life_seconds):
+        # exponential decay, a device reconnecting every few minutes all day climbs, a daily reconnect stays near 1
+        if timestamp >= self.flap_time:
+            self.flap_score = self.flap_score * 2 ** ((self.flap_time - timestamp) / half_life_seconds) + 1
+            self.flap_time = timestamp
+        else:
+            self.flap_score += 2 ** ((timestamp - self.flap_time) / half_life_seconds) # replayed or late event
+
+    def get_flap_score(self, now, half_life_seconds):
+        return self.flap_score * 2 ** (min(0, self.flap_time - now) / half_life_seconds)
+
+    def get_flap_key(self, half_life_seconds):
+        """Ranking key, all scores decay at the same rate so the order of the keys never changes with time"""
+        return math.log2(self.flap_score) + self.flap_time / half_life_seconds if self.flap_score > 0 else -math.inf
+
+class OpensyslogTimeline:
+    """Timelines of all devices, updated as events are applied, with a heap of flap scores for the top flappers"""
+    def __init__(self, opensysloghelper, write_behind=True):
+        # write_behind=False (--replay): no background or exit saves, the caller saves once it succeeded
+        self.helper = opensysloghelper
+        self.write_behind = write_behind
+        timeline_config = self.helper.config.get("device_timeline") or {}
+        self.retention_days = timeline_config.get("retention_days", const.TIMELINE_RETENTION_DAYS)
+        self.slot_count = self.retention_days * 24
+        self.half_life_seconds = timeline_config.get("flap_half_life_hours", const.TIMELINE_FLAP_HALF_LIFE_HOURS) * 3600
+        self.ip_history_size = timeline_config.get("ip_history_size", const.TIMELINE_IP_HISTORY_SIZE)
+        self.file_with_path = self.helper.config_folder + const.JSON_FILE_DEVICE_TIMELINE_FILE
+
+        self.lock = threading.Lock()
+        self.devices = {} # mac -> OpensyslogDeviceTimeline
+        # max-heap of (-flap key, mac), an entry whose key is no longer the one in ranking_keys is stale and skipped
+        self.ranking = []
+        self.ranking_keys = {} # mac -> current flap key
+        self.version = 0
+        self.saved_version = 0
+        self.load()
+        self.stop_event = threading.Event()
+        if write_behind:
+            self.save_thread_handle = threading.Thread(target=self.save_thread, name="timeline-save", daemon=True)
+            self.save_thread_handle.start()
+            atexit.register(self.close)
+
+    def add_event(self, event):
+        """Count a connect event (DHCPACK, WiFi association) of event.mac_address at event.timestamp"""
+        if event.event_type not in const.TIMELINE_EVENT_TYPES:
+            return
+        with self.lock:
+            device = self.devices.get(event.mac_address)
+            if device is None:
+                device = self.devices[event.mac_address] = OpensyslogDeviceTimeline(self.slot_count)
+            device.add_count(int(event.timestamp // 3600))
+            if event.ip_address is not None and event.event_type == const.EVENT_DHCPACK:
+                device.add_ip(event.ip_address, int(event.timestamp), self.ip_history_size)
+            device.add_flap(event.timestamp, self.half_life_seconds)
+            self.update_ranking(event.mac_address, device)
+            self.version += 1
+
+    def update_ranking(self, mac_address, device):
+        """Push the new flap key of one device, caller must hold self.lock"""
+        flap_key = device.get_flap_key(self.half_life_seconds)
+        self.ranking_keys[mac_address] = flap_key
+        heapq.heappush(self.ranking, (-flap_key, mac_address))
+        if len(self.ranking) > 2 * len(self.ranking_keys) + 64:
+            # mostly stale entries, rebuild from the current keys (amortized O(1) per event)
+            self.ranking = [(-flap_key, mac_address) for mac_address, flap_key in self.ranking_keys.items()]
+            heapq.heapify(self.ranking)
+
+    def get_device(self, mac_address, empty_if_unknown=False):
+        """Timeline, IP history and flap score of one MAC as a dict, None (or an empty timeline) if it was never seen"""
+        now = time.time()
+        with self.lock:
+            device = self.devices.get(mac_address)
+            if device is None:
+                if not empty_if_unknown:
+                    return None
+                device = OpensyslogDeviceTimeline(self.slot_count)
+            current_hour = int(now // 3600)
+            return {"mac": mac_address,
+                    "flap_score": round(device.get_flap_score(now, self.half_life_seconds), 2),
+                    "first_hour": (current_hour - self.slot_count + 1) * 3600,
+                    "hourly_counts": device.get_hourly_counts(current_hour),
+                    "ip_history": [{"ip": ip_address, "first_seen": first_seen, "last_seen": last_seen} for ip_address, first_seen, last_seen in reversed(device.ip_history)]}
+
+    def get_top_flappers(self, count):
+        """[(mac, flap score)] highest first, popped from the ranking heap and pushed back"""
+        now = time.time()
+        with self.lock:
+            top = []
+            while self.ranking and len(top) < count:
+                entry = heapq.heappop(self.ranking)
+                if self.ranking_keys.get(entry[1]) == -entry[0] and (not top or top[-1][1] != entry[1]):
+                    top.append(entry) # stale entries stay popped
+            for entry in top:
+                heapq.heappush(self.ranking, entry)
+            return [(mac_address, round(self.devices[mac_address].get_flap_score(now, self.half_life_seconds), 2)) for negative_key, mac_address in top]
+
+    def clear(self):
+        with self.lock:
+            self.devices = {}
+            self.ranking = []
+            self.ranking_keys = {}
+            self.version += 1
+
+    def load(self):
+        json_data = self.helper.load_json_file(self.file_with_path)
+        for mac_address, device_data in json_data.get("devices", {}).items():
+            device = OpensyslogDeviceTimeline(self.slot_count)
+            for hour, count in device_data["counts"]:
+                device.add_count(hour)
+                device.counts[hour % self.slot_count] = min(count, 65535)
+            device.ip_history = device_data["ip_history"][-self.ip_history_size:]
+            device.flap_score, device.flap_time = device_data["flap"]
+            self.devices[mac_address] = device
+            self.update_ranking(mac_address, device)
+        self.helper.print(self.helper.log_level_debug, "OpensyslogTimeline: loaded %s devices", len(self.devices))
+
+    def save(self):
+        """Write the timelines if they changed, devices without connects in the retention are dropped first"""
+        with self.lock:
+            if self.version == self.saved_version:
+                return
+            version = self.version
+            oldest_hour = int(time.time() // 3600) - self.slot_count
+            for mac_address in [mac_address for mac_address, device in self.devices.items() if device.last_hour <= oldest_hour]:
+                del self.ranking_keys[mac_address] # its heap entries are stale now
+                del self.devices[mac_address]
+            devices = {}
+            for mac_address, device in self.devices.items():
+                counts = [[hour, device.counts[hour % self.slot_count]] for hour in range(device.last_hour - self.slot_count + 1, device.last_hour + 1) if device.counts[hour % self.slot_count]]
+                devices[mac_address] = {"counts": counts, "ip_history": [list(entry) for entry in device.ip_history], "flap": [device.flap_score, device.flap_time]}
+        # compact, unlike the client table this file is not meant to be edited by hand
+        if self.helper.save_text_file(self.file_with_path, json.dumps({"version": 1, "devices": devices}, separators=(",", ":"))):
+            self.saved_version = version
+
+    def save_thread(self):
+        while not self.stop_event.wait(const.TIMELINE_SAVE_INTERVAL_SECONDS):
+            try:
+                self.save()
+            except Exception as e:
+                exception_info = f"OpensyslogTimeline:save_thread(): exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+                self.helper.print(self.helper.log_level_error, exception_info)
+
+    def close(self):
+        self.stop_event.set()
+        if self.write_behind:
+            self.save()
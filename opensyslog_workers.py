@@ -0,0 +1,150 @@
+"""Module to spread syslog ingestion over several SO_REUSEPORT worker processes"""
+import contextlib
+import multiprocessing
+import multiprocessing.connection
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+
+import const
+from opensyslog_helper import OpensyslogHelper
+from opensyslog_parser import SyslogEvent
+from opensyslog_syslog import OpensyslogSyslog
+
+# docker stop and Ctrl-C, taken with signal.sigwait() by the main thread, every other thread keeps them blocked
+SHUTDOWN_SIGNALS = {signal.SIGTERM, signal.SIGINT}
+
+@contextlib.contextmanager
+def keep_signal_mask():
+    """multiprocessing unblocks SIGTERM/SIGINT in the calling thread whenever it starts its resource tracker"""
+    signal_mask = signal.pthread_sigmask(signal.SIG_BLOCK, [])
+    try:
+        yield
+    finally:
+        signal.pthread_sigmask(signal.SIG_SETMASK, signal_mask)
+
+class OpensyslogEventForwarder:
+    """Collects parsed events in a worker and sends them to the state owner once per receive batch"""
+    def __init__(self, opensysloghelper, event_queue, shared_log_level):
+        self.helper = opensysloghelper
+        self.event_queue = event_queue
+        self.shared_log_level = shared_log_level
+        self.next_metrics_time = 0.0
+        self.events = []
+
+    def add(self, event):
+        self.events.append(tuple(event)) # plain tuples pickle smaller than the NamedTuple
+
+    def flush(self):
+        if self.events:
+            self.event_queue.put(self.events)
+            self.events = []
+        if self.shared_log_level.value != self.helper.log_level:
+            self.helper.set_log_level(self.shared_log_level.value) # changed at runtime in the state owner
+        if time.monotonic() >= self.next_metrics_time:
+            # counters of this worker ride along so /metrics in the state owner covers every process
+            self.next_metrics_time = time.monotonic() + const.SYSLOG_WORKER_METRICS_INTERVAL_SECONDS
+            self.event_queue.put({"worker_index": self.helper.worker_index, "metrics": self.helper.metrics.get_samples()})
+
+def exit_with_parent():
+    """Leave when the state owner goes away, even if it was killed without a chance to stop us"""
+    multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    os._exit(0)
+
+def worker_ingest_thread(helper, syslog):
+    while not syslog.stop_event.is_set():
+        try:
+            syslog.monitor(reuse_port=True)
+        except Exception as e:
+            exception_info = f"OpensyslogWorkers:worker {helper.worker_index}: exception: {str(e)}\n Call Stack: {str(traceback.format_exc())}"
+            helper.print(helper.log_level_error, exception_info)
+
+def worker_process_main(config_folder, worker_index, event_queue, shared_log_level):
+    """Entry point of a worker process: receive, log and parse, forward events until SIGTERM"""
+    signal.pthread_sigmask(signal.SIG_BLOCK, SHUTDOWN_SIGNALS)
+    threading.Thread(target=exit_with_parent, name="parent-watch", daemon=True).start()
+    helper = OpensyslogHelper(config_folder, worker_index=worker_index)
+    helper.set_log_level(shared_log_level.value)
+    helper.print(helper.log_level_info, f"OpensyslogWorkers: worker {worker_index} started")
+    syslog = OpensyslogSyslog(helper, event_sink=OpensyslogEventForwarder(helper, event_queue, shared_log_level))
+    ingest_thread_handle = threading.Thread(target=worker_ingest_thread, args=(helper, syslog), name="syslog-ingest")
+    ingest_thread_handle.start()
+    signal.sigwait(SHUTDOWN_SIGNALS)
+    # the last events are forwarded before the process exits, the queue's feeder thread sends them on exit
+    syslog.stop()
+    ingest_thread_handle.join(timeout=const.SHUTDOWN_DRAIN_TIMEOUT_SECONDS)
+    helper.close()
+
+class OpensyslogWorkers:
+    """Runs N worker processes bound to the syslog port and applies their events in this (state owner) process"""
+    def __init__(self, opensysloghelper, worker_count):
+        self.helper = opensysloghelper
+        self.syslog = None # set by OpensyslogMonitor once the state is loaded, the workers already receive meanwhile
+        self.worker_count = worker_count
+        syslog_config = self.helper.config.get("syslog") or {}
+        # spawn, not fork: this process already runs flush, dispatcher and web server threads
+        self.context = multiprocessing.get_context("spawn")
+        with keep_signal_mask():
+            self.event_queue = self.context.Queue(maxsize=syslog_config.get("queue_size", const.SYSLOG_QUEUE_SIZE))
+            # workers pick up runtime log level changes from here, see OpensyslogHelper.set_log_level()
+            self.helper.shared_log_level = self.context.Value("i", self.helper.log_level, lock=False)
+        self.processes = [None] * self.worker_count
+        self.stop_event = threading.Event()
+
+    def start(self):
+        for worker_index in range(self.worker_count):
+            self.start_worker(worker_index)
+
+    def start_worker(self, worker_index):
+        process = self.context.Process(target=worker_process_main, args=(self.helper.config_folder, worker_index, self.event_queue, self.helper.shared_log_level), name=f"syslog-worker-{worker_index}", daemon=True)
+        with keep_signal_mask():
+            process.start()
+        self.processes[worker_index] = process
+        self.helper.print(self.helper.log_level_info, f"OpensyslogWorkers: started worker {worker_index}, pid: {process.pid}")
+
+    def monitor(self):
+        """Apply events from all workers, restarting any worker that died"""
+        if self.processes[0] is None:
+            self.start()
+        next_health_check = time.monotonic() + const.SYSLOG_WORKER_HEALTH_CHECK_SECONDS
+        while not self.stop_event.is_set():
+            self.apply_events(1)
+            if time.monotonic() >= next_health_check:
+                next_health_check = time.monotonic() + const.SYSLOG_WORKER_HEALTH_CHECK_SECONDS
+                for worker_index, process in enumerate(self.processes):
+                    if not process.is_alive():
+                        self.helper.print(self.helper.log_level_error, f"OpensyslogWorkers: worker {worker_index} exited with {process.exitcode}, restarting")
+                        self.start_worker(worker_index)
+        # stopping: SIGTERM makes each worker close its sockets and forward what it still holds, keep applying until all are gone
+        self.stop_workers()
+        deadline = time.monotonic() + const.SHUTDOWN_DRAIN_TIMEOUT_SECONDS
+        while any(process.is_alive() for process in self.processes) and time.monotonic() < deadline:
+            self.apply_events(0.1)
+        while self.apply_events(0.1):
+            pass
+        self.helper.print(self.helper.log_level_info, "OpensyslogWorkers: workers stopped, exit codes: %s", [process.exitcode for process in self.processes])
+
+    def apply_events(self, timeout):
+        """Apply one message of the event queue, False if none came within timeout seconds"""
+        try:
+            events = self.event_queue.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        if isinstance(events, dict):
+            self.helper.metrics.update_worker(events["worker_index"], events["metrics"])
+            return True
+        for event in events:
+            self.syslog.handle_event(SyslogEvent(*event))
+        return True
+
+    def stop(self):
+        """Make monitor() stop the workers, apply their last events and return"""
+        self.stop_event.set()
+
+    def stop_workers(self):
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
@@ -1,111 +1,351 @@
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, request, jsonify, make_response, stream_with_context
+from werkzeug.serving import make_server
 import traceback
-from threading import Thread
+from threading import Thread, Lock
 import datetime
+import html
 import json
-from collections import OrderedDict
+import time
+
+import const
+from opensyslog_client import FIELD_IP, FIELD_LAST_CONNECTED, FIELD_RECONNECT_COUNT, client_fields_to_dict, get_ip_sort_key, int_to_mac
+from opensyslog_lookup import normalize_mac
 
 restfulServerApp = Flask(__name__)
 restfulServerHelper = None
+restfulServerState = None
 server_ip = "0.0.0.0"
 server_port = 8080
-server_debug = False # must be false otherwise it gives runtime error!
 restful_server_thread_handle = None
+restful_server_handle = None # werkzeug server, shut down by restful_server_stop()
+
+# rendered pages and sorted client lists, keyed by view and request args, valid while the data version is unchanged
+RENDER_CACHE_MAX_ENTRIES = 64
+render_cache = {}
+render_cache_lock = Lock()
+render_cache_epoch = str(int(time.time()))
 
-def restful_server_start(CommonHelper):
+def restful_server_start(CommonHelper, DhcpackState):
     global restfulServerHelper
+    global restfulServerState
+    global restful_server_handle
 
     restfulServerHelper = CommonHelper
+    restfulServerState = DhcpackState
 
     try:
         restfulServerHelper.print(restfulServerHelper.log_level_debug, "restful_server_start: enter")
-        restful_server_thread_handle = Thread(target=restful_server_thread)
+        restful_server_handle = make_server(server_ip, server_port, restfulServerApp, threaded=True)
+        restful_server_thread_handle = Thread(target=restful_server_thread, name="restful-server", daemon=True)
         restful_server_thread_handle.start()
         restfulServerHelper.print(restfulServerHelper.log_level_debug, "restful_server_start: exit")
-    except Exception as e:
+    except (Exception, SystemExit) as e: # werkzeug exits when the port is taken, syslog keeps running without the web GUI
         exception_info = "restful_server_start:exception: {}\n Call Stack: {}".format(str(e), str(traceback.format_exc()))
         restfulServerHelper.print(restfulServerHelper.log_level_error, exception_info)
 
 def restful_server_thread():
     try:
-        restfulServerApp.run(host=server_ip, port=server_port, debug=server_debug)
+        restful_server_handle.serve_forever()
     except Exception as e:
         exception_info = "restful_server_thread:exception: {}\n Call Stack: {}".format(str(e), str(traceback.format_exc()))
         restfulServerHelper.print(restfulServerHelper.log_level_error, exception_info)
 
+def restful_server_stop():
+    """Stop accepting requests, serve_forever() returns once the request in progress is done"""
+    if restful_server_handle is not None:
+        restful_server_handle.shutdown()
+        restful_server_handle.server_close()
+
 @restfulServerApp.route('/', methods=['GET'])
 @restfulServerApp.route("/reconnect", methods=['GET'])
 def get_webpage_sortby_reconnect_count_desc():
-    html_str = "No data!"
-    dhcp_ack_json = restfulServerHelper.load_dhcpack_status_json()
-    if len(dhcp_ack_json) > 0:
-      sorted_json = OrderedDict(sorted(dhcp_ack_json.items(), key=get_reconnect_count, reverse=True))  # sorts by Max reconnect count
-      html_str = f"Count: {len(dhcp_ack_json)}, Sorted: reconnect count (desc)<br/>"
-      return html_str + generate_html(sorted_json)
-    return html_str
+    return get_clients_webpage("reconnect", "reconnect count (desc)")
 
 @restfulServerApp.route("/datetime", methods=['GET'])
 def get_webpage_sortby_datetime_desc():
-    html_str = "No data!"
-    dhcp_ack_json = restfulServerHelper.load_dhcpack_status_json()
-    if len(dhcp_ack_json) > 0:
-      sorted_json = OrderedDict(sorted(dhcp_ack_json.items(), key=lambda item: get_sorting_key_datetime(item[1]), reverse=True))
-      html_str = f"Count: {len(dhcp_ack_json)}, Sorted: datetime (desc)<br/>"
-      return html_str + generate_html(sorted_json)
-    return html_str
+    return get_clients_webpage("datetime", "datetime (desc)")
 
 @restfulServerApp.route("/ip", methods=['GET'])
 def get_webpage_sortby_ip_address():
-    html_str = "No data!"
-    dhcp_ack_json = restfulServerHelper.load_dhcpack_status_json()
-    if len(dhcp_ack_json) > 0:
-      sorted_json = OrderedDict(sorted(dhcp_ack_json.items(), key=lambda item: get_sorting_key_ip(item[1])))
-      html_str = f"Count: {len(dhcp_ack_json)}, Sorted: IP (asc)<br/>"
-      return html_str + generate_html(sorted_json)
-    return html_str
+    return get_clients_webpage("ip", "IP (asc)")
+
+def get_clients_webpage(sort_order, sort_title):
+    limit, offset = get_pagination_args()
+    def build_page():
+        total_count, page_items = get_sorted_clients_page(sort_order, limit, offset)
+        page_items = list(page_items) # the page is cached whole, the header needs its length
+        if total_count == 0:
+            return "No data!"
+        html_str = f"Count: {total_count}, Sorted: {sort_title}"
+        if limit is not None or offset > 0:
+            html_str += f", Showing: {min(offset + 1, total_count)}-{offset + len(page_items)}"
+        return html_str + "<br/>" + generate_html(page_items)
+    return get_cached_response(("clients", sort_order, limit, offset), get_clients_version(), build_page)
+
+def get_pagination_args():
+    limit = request.args.get('limit', "")
+    offset = request.args.get('offset', "")
+    return (int(limit) if limit.isdigit() else None), (int(offset) if offset.isdigit() else 0)
+
+def get_clients_version():
+    # the sqlite views read the database, which only changes when the state gets flushed
+    if restfulServerHelper.sqlite_store is not None:
+        return restfulServerState.flushed_version
+    return restfulServerState.version
 
-def generate_html(sorted_json):
-    html_str = "<table cellspacing=0px border=1><tr><th>MAC Address</th><th>IP Address</th><th>Client Name</th><th>Host Name</th><th>Reconnect Count Per Day</th><th>Last connected</th></tr>"
-    for key, value in sorted_json.items():
+def get_sorted_clients_page(sort_order, limit, offset):
+    """Return (total count, iterator of (mac, client)) for one page of the given sort order"""
+    # the sqlite backend sorts through its indexes, it trails the in-memory table by up to one state flush
+    if restfulServerHelper.sqlite_store is not None:
+        page_items = restfulServerHelper.sqlite_store.query_clients(sort_order, -1 if limit is None else limit, offset)
+        return restfulServerHelper.sqlite_store.count_clients(), iter(page_items)
+    sorted_items = get_cached_value(("sorted", sort_order), restfulServerState.version, lambda: get_sorted_clients(sort_order))
+    end = len(sorted_items) if limit is None else offset + limit
+    # only the page gets formatted back to strings, one client at a time as the caller iterates
+    return len(sorted_items), ((int_to_mac(mac), client_fields_to_dict(fields)) for mac, fields in sorted_items[offset:end])
+
+def get_sorted_clients(sort_order):
+    # ints compare without parsing: IP as a 32 bit number, last_connected as epoch seconds
+    clients = restfulServerState.snapshot()
+    if sort_order == "datetime":
+        return sorted(clients, key=lambda item: (item[1][FIELD_LAST_CONNECTED], item[1][FIELD_RECONNECT_COUNT]), reverse=True)
+    if sort_order == "ip":
+        return sorted(clients, key=lambda item: get_ip_sort_key(item[1][FIELD_IP]))
+    return sorted(clients, key=lambda item: item[1][FIELD_RECONNECT_COUNT], reverse=True)  # sorts by Max reconnect count
+
+def generate_html(sorted_items):
+    html_parts = ["<table cellspacing=0px border=1><tr><th>MAC Address</th><th>IP Address</th><th>Client Name</th><th>Host Name</th><th>Reconnect Count Per Day</th><th>Last connected</th></tr>"]
+    for key, value in sorted_items:
         host_name = value.get('host_name', value['name'])
-        html_str += f"<tr><td>{key}</td><td>{value['ip']}</td><td>{value['name']}</td><td>{host_name}</td><td>{value['reconnect_count_per_day']}</td><td>{value['last_connected']}</td></tr>"
-    html_str += "</table>"
-    return html_str
+        html_parts.append(f"<tr><td><a href=\"/device/{key}\">{key}</a></td><td>{value['ip']}</td><td>{value['name']}</td><td>{host_name}</td><td>{value['reconnect_count_per_day']}</td><td>{value['last_connected']}</td></tr>")
+    html_parts.append("</table>")
+    return "".join(html_parts)
 
 @restfulServerApp.route("/notifications", methods=['GET'])
 def get_webpage_notifications():
-    html_str = "No data!"
-    history_json = restfulServerHelper.load_notification_history_json()
-    if len(history_json) > 0:
-        requested = request.args.get('last', "")
-        max = len(history_json)
+    requested = request.args.get('last', "")
+    def build_page():
+        total_count = restfulServerHelper.notification_history.total_count
+        if total_count == 0:
+            return "No data!"
+        max = total_count
         if requested.isdigit():
             max = int(requested)
-        html_str = f"Count: {max}/{len(history_json)}, Sorted: datetime (desc)<br/>"
-        html_str += "<table cellspacing=0px border=1><tr><th>Datetime</th><th>Notification</th></tr>"
-        sorted_json = OrderedDict(sorted(history_json.items(), reverse=True))
-        counter = 1
-        for key, value in sorted_json.items():
-            html_str += "<tr><td>{}</td><td>{}</td></tr>".format(key, value)
-            counter += 1
-            if counter > max:
-                break
-        html_str += "</table>"
+        history_entries = restfulServerHelper.load_notification_history(max)
+        html_parts = [f"Count: {len(history_entries)}/{total_count}, Sorted: datetime (desc)<br/>"]
+        html_parts.append("<table cellspacing=0px border=1><tr><th>Datetime</th><th>Notification</th></tr>")
+        for key, value in history_entries:
+            html_parts.append("<tr><td>{}</td><td>{}</td></tr>".format(key, value))
+        html_parts.append("</table>")
+        return "".join(html_parts)
+    return get_cached_response(("notifications", requested), restfulServerHelper.notification_history.version, build_page)
+
+@restfulServerApp.route("/api/clients", methods=['GET'])
+def get_api_clients():
+    sort_order = request.args.get('sort', "reconnect")
+    if sort_order not in ("reconnect", "datetime", "ip"):
+        return make_response(jsonify({"error": f"unknown sort: {sort_order}"}), 400)
+    limit, offset = get_pagination_args()
+    etag = get_etag(("api-clients", sort_order, limit, offset), get_clients_version())
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    total_count, page_items = get_sorted_clients_page(sort_order, limit, offset)
+    def generate():
+        yield '{"count": %d, "clients": [' % total_count
+        for index, (mac_address, client) in enumerate(page_items):
+            yield ("," if index else "") + json.dumps({"mac": mac_address, **client})
+        yield "]}"
+    response = Response(stream_with_context(generate()), mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+@restfulServerApp.route("/api/notifications", methods=['GET'])
+def get_api_notifications():
+    requested = request.args.get('last', "")
+    history = restfulServerHelper.notification_history
+    etag = get_etag(("api-notifications", requested), history.version)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    # without last= every file is streamed, read one file at a time as the response goes out
+    history_entries = history.iter_recent(int(requested) if requested.isdigit() else None)
+    def generate():
+        yield '{"count": %d, "notifications": [' % history.total_count
+        for index, (date_time, notification_text) in enumerate(history_entries):
+            yield ("," if index else "") + json.dumps({"datetime": date_time, "notification": notification_text})
+        yield "]}"
+    response = Response(stream_with_context(generate()), mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+@restfulServerApp.route("/search", methods=['GET'])
+def get_webpage_search():
+    try:
+        results, truncated = run_search()
+    except ValueError as e:
+        return str(e), 400
+    if len(results) == 0:
+        return "No data!" + (" (search stopped at the max_scan_mb limit, narrow it down with mac, ip, host or a time range)" if truncated else "")
+    html_parts = [f"Count: {len(results)}{' (search stopped at the max_scan_mb limit)' if truncated else ''}, Sorted: datetime (desc)<br/>"]
+    html_parts.append("<table cellspacing=0px border=1><tr><th>File</th><th>Datetime</th><th>Syslog</th></tr>")
+    for file_date, line_time, line in results:
+        line_datetime = datetime.datetime.fromtimestamp(line_time).strftime("%Y-%m-%d %H:%M:%S") if line_time is not None else ""
+        html_parts.append(f"<tr><td>{file_date}</td><td>{line_datetime}</td><td>{html.escape(line)}</td></tr>")
+    html_parts.append("</table>")
+    return "".join(html_parts)
+
+@restfulServerApp.route("/api/search", methods=['GET'])
+def get_api_search():
+    try:
+        results, truncated = run_search()
+    except ValueError as e:
+        return make_response(jsonify({"error": str(e)}), 400)
+    lines = [{"file_date": str(file_date), "time": line_time, "line": line} for file_date, line_time, line in results]
+    return jsonify({"count": len(lines), "truncated": truncated, "lines": lines})
+
+def run_search():
+    if restfulServerHelper.search is None:
+        raise ValueError("Search is not available")
+    requested = request.args.get('limit', "")
+    limit = min(int(requested), const.SEARCH_MAX_LIMIT) if requested.isdigit() else const.SEARCH_DEFAULT_LIMIT
+    return restfulServerHelper.search.search(mac_address=request.args.get('mac'), ip_address=request.args.get('ip'), host_name=request.args.get('host'),
+                                             text=request.args.get('q'), start_time=get_search_time('from'), end_time=get_search_time('to'), limit=limit)
+
+def get_search_time(arg_name):
+    # YYYY-MM-DD, YYYY-MM-DD HH:MM or YYYY-MM-DDTHH:MM:SS, a date alone for 'to' means the end of that day
+    value = request.args.get(arg_name, "").strip()
+    if not value:
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f"{arg_name}: expected YYYY-MM-DD or YYYY-MM-DD HH:MM[:SS], got: {value}")
+    if arg_name == 'to' and len(value) == 10:
+        parsed += datetime.timedelta(days=1, microseconds=-1)
+    return parsed.timestamp()
+
+def get_etag(cache_key, version):
+    # process start time keeps versions from a previous run from matching
+    return f"{render_cache_epoch}-{version}-" + "-".join(str(part) for part in cache_key)
+
+def get_cached_value(cache_key, version, build_value):
+    """Return the cached value for cache_key if it was built for this version, otherwise build and cache it"""
+    cached = render_cache.get(cache_key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    value = build_value()
+    with render_cache_lock:
+        if len(render_cache) >= RENDER_CACHE_MAX_ENTRIES:
+            render_cache.clear() # only a handful of keys are hot, odd limit/offset combinations just age out
+        render_cache[cache_key] = (version, value)
+    return value
+
+def get_cached_response(cache_key, version, build_page):
+    """Serve a rendered page from cache, answering 304 when the client already has this version"""
+    etag = get_etag(cache_key, version)
+    if request.if_none_match.contains(etag):
+        return Response(status=304, headers={"ETag": f'"{etag}"'})
+    response = make_response(get_cached_value(("page",) + cache_key, version, build_page))
+    response.set_etag(etag)
+    return response
+
+@restfulServerApp.route("/events", methods=['GET'])
+def get_webpage_events():
+    if restfulServerHelper.sqlite_store is None:
+        return "No data! Event history needs state backend: sqlite"
+    mac_address = request.args.get('mac', "").strip().upper()
+    requested = request.args.get('last', "")
+    max = int(requested) if requested.isdigit() else 100
+    events = restfulServerHelper.sqlite_store.query_events(mac_address, max)
+    if len(events) == 0:
+        return "No data!"
+    html_str = f"Count: {len(events)}, MAC: {mac_address if mac_address else 'all'}, Sorted: datetime (desc)<br/>"
+    html_str += "<table cellspacing=0px border=1><tr><th>Datetime</th><th>Event</th><th>MAC Address</th><th>IP Address</th><th>Host Name</th></tr>"
+    for event_time, event_type, mac, ip, host_name in events:
+        html_str += f"<tr><td>{event_time}</td><td>{event_type}</td><td>{mac}</td><td>{ip}</td><td>{host_name}</td></tr>"
+    html_str += "</table>"
     return html_str
-  
-def get_reconnect_count(item):
-    reconnect_count = 0
-    reconnect_count_str = item[1].get("reconnect_count_per_day")
-    if reconnect_count_str != None:
-        reconnect_count = int(reconnect_count_str)
-    return reconnect_count
-
-def get_sorting_key_datetime(item):
-    return (item['last_connected'], item['reconnect_count_per_day'])
-
-def get_sorting_key_ip(item):
-    split_ip = item["ip"].split(".")
-    return (int(split_ip[0]), int(split_ip[1]), int(split_ip[2]), int(split_ip[3]))
+
+@restfulServerApp.route("/device/<mac_address>", methods=['GET'])
+def get_webpage_device(mac_address):
+    device, client = get_device(mac_address)
+    if device is None:
+        return "No data!"
+    html_parts = [f"MAC: {device['mac']}, Name: {client.get('name')}, IP: {client.get('ip')}, Last connected: {client.get('last_connected')}, Reconnects today: {client.get('reconnect_count_per_day')}, Flap score: {device['flap_score']}<br/><br/>"]
+    html_parts.append("IP history (newest first)<br/><table cellspacing=0px border=1><tr><th>IP Address</th><th>First seen</th><th>Last seen</th></tr>")
+    for entry in device["ip_history"]:
+        html_parts.append(f"<tr><td>{entry['ip']}</td><td>{format_epoch(entry['first_seen'])}</td><td>{format_epoch(entry['last_seen'])}</td></tr>")
+    html_parts.append("</table><br/>Connects per hour<br/><table cellspacing=0px border=1><tr><th>Date</th>")
+    html_parts.extend(f"<th>{hour:02d}</th>" for hour in range(24))
+    html_parts.append("<th>Total</th></tr>")
+    days = {} # local date -> 24 hourly counts
+    for index, count in enumerate(device["hourly_counts"]):
+        hour_datetime = datetime.datetime.fromtimestamp(device["first_hour"] + index * 3600)
+        days.setdefault(hour_datetime.date(), [0] * 24)[hour_datetime.hour] += count
+    for day, counts in sorted(days.items(), reverse=True):
+        html_parts.append(f"<tr><td>{day}</td>" + "".join(f"<td>{count if count else ''}</td>" for count in counts) + f"<td>{sum(counts)}</td></tr>")
+    html_parts.append("</table>")
+    return "".join(html_parts)
+
+@restfulServerApp.route("/api/device/<mac_address>", methods=['GET'])
+def get_api_device(mac_address):
+    device, client = get_device(mac_address)
+    if device is None:
+        return make_response(jsonify({"error": f"unknown mac: {mac_address}"}), 404)
+    return jsonify({**device, "client": client})
+
+def get_device(mac_address):
+    """(timeline dict, client table entry) of one MAC, (None, None) if it is neither in the timeline nor in the client table"""
+    mac_address = normalize_mac(mac_address)
+    client = restfulServerState.get_client(mac_address)
+    # a client from before the timeline existed (or after a purge) still gets its page, with an empty timeline
+    device = restfulServerHelper.timeline.get_device(mac_address, empty_if_unknown=client is not None)
+    if device is None:
+        return None, None
+    return device, client or {}
+
+@restfulServerApp.route("/flappers", methods=['GET'])
+def get_webpage_flappers():
+    flappers = get_top_flappers()
+    if len(flappers) == 0:
+        return "No data!"
+    html_parts = [f"Count: {len(flappers)}, Sorted: flap score (desc)<br/>"]
+    html_parts.append("<table cellspacing=0px border=1><tr><th>MAC Address</th><th>IP Address</th><th>Client Name</th><th>Flap Score</th><th>Last connected</th></tr>")
+    for mac_address, flap_score, client in flappers:
+        html_parts.append(f"<tr><td><a href=\"/device/{mac_address}\">{mac_address}</a></td><td>{client.get('ip')}</td><td>{client.get('name')}</td><td>{flap_score}</td><td>{client.get('last_connected')}</td></tr>")
+    html_parts.append("</table>")
+    return "".join(html_parts)
+
+@restfulServerApp.route("/api/flappers", methods=['GET'])
+def get_api_flappers():
+    flappers = [{"mac": mac_address, "flap_score": flap_score, **client} for mac_address, flap_score, client in get_top_flappers()]
+    return jsonify({"count": len(flappers), "flappers": flappers})
+
+def get_top_flappers():
+    requested = request.args.get('last', "")
+    top_flappers = restfulServerHelper.timeline.get_top_flappers(int(requested) if requested.isdigit() else const.TIMELINE_TOP_FLAPPERS)
+    return [(mac_address, flap_score, restfulServerState.get_client(mac_address) or {}) for mac_address, flap_score in top_flappers]
+
+def format_epoch(epoch_seconds):
+    return datetime.datetime.fromtimestamp(epoch_seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+@restfulServerApp.route("/metrics", methods=['GET'])
+def get_metrics():
+    return Response(restfulServerHelper.metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@restfulServerApp.route("/log_level", methods=['GET', 'POST'])
+def get_set_log_level():
+    # GET only shows it, a crawler or prefetched link must not switch production to debug
+    if request.method == 'GET':
+        if request.args.get('level'):
+            return "Changing the log level needs a POST, e.g. curl -X POST -d level=debug .../log_level", 405
+        return f"Log level: {restfulServerHelper.get_log_level_name()}"
+    level = request.values.get('level', "").strip().lower()
+    if level:
+        if level not in restfulServerHelper.log_level_names:
+            return f"Unknown log level: {level}, use one of: {', '.join(restfulServerHelper.log_level_names)}", 400
+        restfulServerHelper.set_log_level(restfulServerHelper.log_level_names[level])
+        restfulServerHelper.print(restfulServerHelper.log_level_warning, f"Log level changed to: {level}")
+    return f"Log level: {restfulServerHelper.get_log_level_name()}"
 
 #############################################################################################################
 